@@ -3,11 +3,12 @@ MQ module
 '''
 from .connection import MTQConnection
 from . import defaults
-from .queue import Queue
+from .queue import Queue, EnqueueResult
 from .worker import Worker, WorkerProxy
 from .job import Job
 from .schedule import Scheduler
 from mtq.defaults import _task_map
+from mtq.utils import check_timeout
 
 try:
     from _version import __version__
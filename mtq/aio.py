@@ -0,0 +1,414 @@
+'''
+asyncio support (Python 3.7+)
+
+AsyncioPool runs coroutine tasks concurrently on an event loop in a thread
+of the worker. The worker's main loop keeps doing all of the mongo I/O
+(popping, finishing and writing job logs) so the event loop never blocks on
+pymongo, and thousands of network bound jobs can share one process::
+
+    @mtq.task
+    async def fetch(url):
+        ...
+
+    $ mtq-worker --pool asyncio --concurrency 500
+
+AsyncMTQConnection enqueues jobs from asyncio applications::
+
+    conn = AsyncMTQConnection(mtq.default_connection())
+    queue = conn.queue('default')
+    job = await queue.enqueue(fetch, 'http://binstar.org')
+'''
+import asyncio
+import contextvars
+import io
+import logging
+import sys
+import threading
+import time
+from queue import Queue, Empty
+
+from mtq import errors, metrics
+from mtq.job import Job
+from mtq.log import BufferedWriter
+from mtq.retry import error_info
+from mtq.queue import EnqueueResult, QueueError
+from mtq.utils import UnicodeFormatter, mgs_template, now
+
+logger = logging.getLogger('mq.Worker')
+
+#: The log buffer of the job run by the current asyncio task
+_job_record = contextvars.ContextVar('mtq_job_record', default=None)
+
+
+class _JobLogHandler(logging.Handler):
+    '''
+    Route log records to the buffer of the job that logged them
+
+    setup_logging attaches one handler per job and filters records by thread,
+    every job run by an AsyncioPool shares the event loop thread so records
+    are routed by context variable instead.
+    '''
+    def __init__(self):
+        logging.Handler.__init__(self, logging.INFO)
+        self.setFormatter(UnicodeFormatter())
+
+    def emit(self, record):
+        stream = _job_record.get()
+        if stream is None:
+            return
+        try:
+            stream.write(self.format(record) + '\n')
+        except Exception:
+            self.handleError(record)
+
+
+class AsyncioPool(object):
+    '''
+    Run up to `concurrency` jobs at once on an event loop
+
+    :param worker: the Worker that owns this pool
+    :param concurrency: the maximum number of jobs in flight
+
+    max_jobs_per_child and max_rss are accepted for compatibility with
+    PreforkPool and ignored.
+
+    Coroutine functions are awaited with asyncio.wait_for, so a job that
+    times out is cancelled. Other tasks are run in the loop's default
+    executor, their timeouts are not enforced.
+    '''
+    def __init__(self, worker, concurrency=1, max_jobs_per_child=None, max_rss=None):
+        self.worker = worker
+        self.concurrency = concurrency
+        self.loop = None
+        self._thread = None
+        self._semaphore = None
+        self._handler = None
+        self._writer = None
+        self._results = Queue()
+        self._futures = {}
+        self._submitted = 0
+
+    def __repr__(self):
+        return '<mtq.AsyncioPool concurrency=%i busy=%i>' % (self.concurrency, self.busy)
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='mtq-asyncio')
+        self._thread.daemon = True
+        self._thread.start()
+
+        self._writer = BufferedWriter(self.worker.factory.logging_collection)
+        self._handler = _JobLogHandler()
+        root = logging.getLogger()
+        root.setLevel(logging.INFO)
+        root.addHandler(self._handler)
+
+    @property
+    def busy(self):
+        'The number of jobs submitted and not collected'
+        return self._submitted
+
+    @property
+    def idle(self):
+        'The number of jobs that can be submitted before the pool is full'
+        return max(0, self.concurrency - self.busy)
+
+    def submit(self, job):
+        'Schedule a job on the event loop'
+        self._submitted += 1
+        self._futures[job.id] = job, asyncio.run_coroutine_threadsafe(self._run(job), self.loop)
+
+    async def _run(self, job):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        async with self._semaphore:
+            record = io.StringIO()
+            _job_record.set(record)
+            job_log = logging.getLogger('job')
+            job_log.info('Starting Job %s' % job.id)
+            error = None
+            try:
+                await self._apply(job)
+            except BaseException as exc:
+                if isinstance(exc, asyncio.TimeoutError):
+                    job_log.error('Job %s timed out' % job.id)
+                    metrics.inc('jobs_timed_out')
+                    exc = errors.Timeout()
+                else:
+                    job_log.exception(exc)
+                error = error_info(exc, job.attempts)
+            else:
+                job_log.info('Job %s finished successfully' % job.id)
+            finally:
+                _job_record.set(None)
+
+        self._results.put((job, error, record.getvalue()))
+
+    async def _apply(self, job):
+        worker = self.worker
+        try:
+            worker._pre(job)
+            start = time.time()
+            func = job.func
+            job.record_timing('import', start)
+            if asyncio.iscoroutinefunction(func):
+                start = time.time()
+                try:
+                    await asyncio.wait_for(func(*job.args, **job.kwargs), job.doc.get('timeout'))
+                finally:
+                    job.record_timing('run', start)
+            else:
+                # Copy the context so the job's log records are still routed to it
+                context = contextvars.copy_context()
+                await self.loop.run_in_executor(None, context.run, job.apply)
+        except BaseException:
+            if worker._handler:
+                worker._handler(job, *sys.exc_info())
+            raise
+        finally:
+            worker._post(job)
+
+    def collect(self, timeout=0):
+        '''
+        Wait up to `timeout` seconds for jobs to finish, writing their logs
+
+        :returns: a list of (job, failed) tuples
+        '''
+        results = []
+        if not self.busy:
+            return results
+
+        try:
+            if timeout:
+                results.append(self._results.get(timeout=timeout))
+            while 1:
+                results.append(self._results.get_nowait())
+        except Empty:
+            pass
+
+        finished = []
+        for job, error, message in results:
+            self._futures.pop(job.id, None)
+            failed = error is not None
+            if failed:
+                self.worker.record_error(job, error)
+            if failed and message:
+                logger.error(mgs_template % (job.id, message.replace('\n', '\n   | ')))
+            self._writer.write({'job_id': job.id, 'message': message,
+                                'timestamp': now(), 'eof': True})
+            finished.append((job, failed))
+
+        if finished:
+            self._writer.flush()
+        self._submitted -= len(finished)
+        return finished
+
+    def stop(self, timeout=None):
+        '''
+        Stop the event loop, waiting up to `timeout` seconds for running jobs
+
+        Jobs that are still running are cancelled, jobs that have not
+        started are put back on the queue.
+
+        :returns: a list of (job, failed) tuples for the jobs that were running
+        '''
+        results = []
+        deadline = None if timeout is None else time.time() + timeout
+        while self.busy and (deadline is None or time.time() < deadline):
+            results.extend(self.collect(timeout=1))
+
+        if self.loop is None:
+            return results
+
+        for _, future in list(self._futures.values()):
+            future.cancel()
+        # Cancelled jobs still report their result and log
+        while self.busy:
+            collected = self.collect(timeout=5)
+            if not collected:
+                break
+            results.extend(collected)
+        # Jobs cancelled before they started go back on the queue
+        for job, _ in self._futures.values():
+            self.worker.requeue_job(job)
+        self._futures.clear()
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+        self.loop.close()
+        self.loop = None
+
+        logging.getLogger().removeHandler(self._handler)
+        self._writer.close()
+        self._submitted = 0
+        return results
+
+
+
+class AsyncMTQConnection(object):
+    '''
+    Enqueue jobs without blocking the event loop
+
+    :param factory: the MTQConnection to write to
+    :param window: seconds to wait for more jobs before a bulk write
+    :param max_batch: the maximum number of jobs per bulk write
+    :param max_pending: the maximum number of jobs waiting to be written,
+        enqueueing blocks while there are this many
+    :param executor: the concurrent.futures executor that runs the writes
+        (default: the loop's default executor)
+
+    Jobs enqueued within `window` seconds of each other are written with
+    one bulk insert in the executor. Writes are done one at a time, so a
+    slow mongo makes callers wait instead of growing memory without limit.
+    '''
+    def __init__(self, factory, window=0.005, max_batch=1000, max_pending=10000, executor=None):
+        self.factory = factory
+        self.window = window
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.executor = executor
+        self._pending = None
+        self._writer_task = None
+
+    def __repr__(self):
+        pending = self._pending.qsize() if self._pending is not None else 0
+        return '<mtq.AsyncMTQConnection pending=%i>' % pending
+
+    def queue(self, name='default', tags=(), priority=0, retry=None):
+        '''
+        Create an AsyncQueue, see MTQConnection.queue
+        '''
+        return AsyncQueue(self, self.factory.queue(name, tags, priority, retry))
+
+    async def insert(self, doc):
+        '''
+        Write a job document with the next bulk write
+
+        :returns: the Job once it is written
+        :raises QueueError: if the job could not be written
+        '''
+        return await (await self.submit(doc))
+
+    async def submit(self, doc):
+        '''
+        Queue a job document for the next bulk write, waiting while there
+        are max_pending jobs queued
+
+        :returns: a future for the Job
+        '''
+        if self._pending is None:
+            self._pending = asyncio.Queue(self.max_pending)
+        if self._writer_task is None or self._writer_task.done():
+            self._writer_task = asyncio.ensure_future(self._write_loop())
+
+        future = asyncio.get_event_loop().create_future()
+        await self._pending.put((doc, future))
+        return future
+
+    async def _write_loop(self):
+        while 1:
+            batch = [await self._pending.get()]
+            # Coalesce the jobs enqueued in the next window
+            await asyncio.sleep(self.window)
+            while len(batch) < self.max_batch and not self._pending.empty():
+                batch.append(self._pending.get_nowait())
+
+            try:
+                await self._write(batch)
+            finally:
+                for _ in batch:
+                    self._pending.task_done()
+
+    async def _write(self, batch):
+        docs = [doc for doc, _ in batch]
+        loop = asyncio.get_event_loop()
+        try:
+            result = await loop.run_in_executor(self.executor, self.factory.insert_jobs, docs, len(docs))
+        except Exception as err:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+
+        errors = {error['index']: error['errmsg'] for error in result.errors}
+        written = set(result.job_ids)
+        for index, (doc, future) in enumerate(batch):
+            if future.done():
+                # The caller was cancelled
+                continue
+            if doc['_id'] in written:
+                future.set_result(Job(self.factory, doc))
+            else:
+                errmsg = errors.get(index, errors.get(None))
+                future.set_exception(QueueError('could not enqueue job: %s' % errmsg))
+
+    async def flush(self):
+        '''
+        Wait until every enqueued job has been written
+        '''
+        if self._pending is not None:
+            await self._pending.join()
+
+    async def close(self):
+        '''
+        Write the pending jobs and stop the writer task
+        '''
+        await self.flush()
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            self._writer_task = None
+
+
+class AsyncQueue(object):
+    '''
+    The asyncio version of mtq.Queue, enqueueing returns an awaitable
+
+    Do not create directly use AsyncMTQConnection.queue
+    '''
+    def __init__(self, connection, queue):
+        self.connection = connection
+        self.queue = queue
+
+    def __repr__(self):
+        return '<mtq.AsyncQueue name:%s tags:%r>' % (self.queue.name, self.queue.tags)
+
+    @property
+    def name(self):
+        return self.queue.name
+
+    async def enqueue(self, func_or_str, *args, **kwargs):
+        '''
+        Enqueue a call of `func_or_str`, see mtq.Queue.enqueue
+        '''
+        return await self.enqueue_call(func_or_str, args, kwargs)
+
+    async def enqueue_call(self, func_or_str, args=(), kwargs=None, tags=(), priority=None, timeout=None, mutex=None,
+                           on_lost=None, retry=None, process_after=None, profile=False):
+        '''
+        Enqueue a call of `func_or_str`, see mtq.Queue.enqueue_call
+        '''
+        doc = self.queue.make_job_doc(func_or_str, args, kwargs, tags, priority, timeout, mutex, on_lost, retry,
+                                      process_after, profile)
+        return await self.connection.insert(doc)
+
+    async def enqueue_many(self, func_or_str, iterable_of_args, kwargs=None, tags=(), priority=None,
+                           timeout=None, mutex=None, on_lost=None, retry=None, process_after=None, profile=False):
+        '''
+        Enqueue one call of `func_or_str` for every args tuple, see mtq.Queue.enqueue_many
+
+        :returns: an EnqueueResult
+        '''
+        futures = []
+        for args in iterable_of_args:
+            doc = self.queue.make_job_doc(func_or_str, args, kwargs, tags, priority, timeout, mutex, on_lost,
+                                          retry, process_after, profile)
+            futures.append(await self.connection.submit(doc))
+
+        result = EnqueueResult()
+        for index, outcome in enumerate(await asyncio.gather(*futures, return_exceptions=True)):
+            if isinstance(outcome, Exception):
+                result.errors.append({'chunk': None, 'index': index, 'errmsg': str(outcome)})
+            else:
+                result.job_ids.append(outcome.id)
+        return result
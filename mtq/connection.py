@@ -6,11 +6,56 @@ Created on Aug 2, 2013
 import mtq
 from pymongo.mongo_client import MongoClient
 from mtq.defaults import _collection_base, _qsize, _workersize, _logsize, \
-    _task_map
-from mtq.utils import ensure_capped_collection, now
+    _task_map, _signalsize, _mutex_lease, _heartbeat_interval, _stale_worker_age, \
+    _latency_retention, _profilesize
+from mtq.utils import ensure_capped_collection, now, chunked, parse_queue_weights
 from time import mktime
-from pymongo import ASCENDING
+import time
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, PyMongoError, DuplicateKeyError
+from datetime import timedelta
+import pytz
 from mtq.pymongo3compat import find
+from mtq.notify import JobNotifier
+from mtq.log import LogFollower
+from mtq.reaper import Reaper
+from mtq.stats import QueueStats
+
+#: Indexes on the queue collection. Each one matches the shape of a query
+#: that mtq issues, see MTQConnection.query_shapes
+QUEUE_INDEXES = [
+    # make_query: pop_item, items, Queue.count
+    # Equality on processed and qname, then the POP_SORT keys, then the range on process_after
+    ('mtq_priority_pop', [('processed', ASCENDING), ('qname', ASCENDING), ('priority', DESCENDING),
+                          ('enqueued_at', ASCENDING), ('process_after', ASCENDING)]),
+    # next_due, and pops while most of the waiting jobs are delayed
+    ('mtq_due', [('processed', ASCENDING), ('qname', ASCENDING), ('process_after', ASCENDING)]),
+    # make_query(failed=True): pop_item(failed=True), Queue.num_failed
+    ('mtq_failed', [('failed', ASCENDING), ('qname', ASCENDING), ('enqueued_at', ASCENDING)]),
+    # WorkerProxy.num_processed and utils.last_job
+    ('mtq_worker', [('worker_id', ASCENDING), ('enqueued_at', DESCENDING)]),
+    # utils.job_stats and mtq-info -j
+    ('mtq_finished', [('finished', ASCENDING), ('finished_at', ASCENDING)]),
+]
+
+#: Indexes on the workers collection
+WORKER_INDEXES = [
+    # Reaper.stale_workers
+    ('mtq_stale', [('working', ASCENDING), ('check-in', ASCENDING)]),
+]
+
+#: Indexes on the latency histogram collection
+LATENCY_INDEXES = [
+    # QueueStats.latency, and expire old histograms
+    ('mtq_latency_period', [('period', ASCENDING)], {'expireAfterSeconds': _latency_retention}),
+]
+
+#: Jobs are popped highest priority first, then in FIFO order
+POP_SORT = [('priority', DESCENDING), ('enqueued_at', ASCENDING)]
+
+# Full names of the queue collections that have been indexed by this process
+_indexed_collections = set()
 
 
 class MTQConnection(object):
@@ -36,10 +81,33 @@ class MTQConnection(object):
         self._task_map = _task_map.copy()
         self.extra_lognames = extra_lognames
 
+        self._collections = {}
+        #: number of metadata commands (listCollections, createIndexes)
+        #: issued to resolve collections
+        self.metadata_commands = 0
+
     def _destroy(self):
         'Destroy ALL data'
+        self.invalidate_collections()
         self.db.connection.drop_database(self.db)
 
+    def invalidate_collections(self):
+        '''
+        Forget the cached collection handles, capped collection checks
+        and indexes, e.g. after the collections were dropped
+        '''
+        self._collections.clear()
+        _indexed_collections.discard(self.db[self.queue_collection_name].full_name)
+
+    def _capped_collection(self, collection_name, size):
+        'A capped collection, only checked for on first use'
+        collection = self._collections.get(collection_name)
+        if collection is None:
+            self.metadata_commands += 1
+            collection = ensure_capped_collection(self.db, collection_name, size)
+            self._collections[collection_name] = collection
+        return collection
+
     @classmethod
     def default(cls):
         '''
@@ -88,24 +156,150 @@ class MTQConnection(object):
         worker = self.get_worker(worker_name, worker_id)
         return worker.stream()
 
+    def log_follower(self, job_ids=(), worker_ids=()):
+        '''
+        Get a LogFollower to read the output of many jobs and workers with one cursor
+        '''
+        sources = [('job_id', job_id) for job_id in job_ids]
+        sources.extend(('worker_id', worker_id) for worker_id in worker_ids)
+        return LogFollower(self.logging_collection, sources, finished=self._log_source_finished)
+
+    def _log_source_finished(self, key, value):
+        if key == 'job_id':
+            cursor = self.queue_collection.find({'_id': value, 'finished': False})
+        else:
+            cursor = self.worker_collection.find({'_id': value, 'working': True})
+        return not cursor.count()
+
+    @property
+    def queue_collection_name(self):
+        'The name of the queue collection'
+        return '%s.queue' % (self.collection_base)
+
     @property
     def queue_collection(self):
         'The collection to push jobs to'
-        collection_name = '%s.queue' % (self.collection_base)
-        return self.db[collection_name]
+        collection = self._collections.get(self.queue_collection_name)
+        if collection is None:
+            collection = self.db[self.queue_collection_name]
+            if collection.full_name not in _indexed_collections:
+                self.ensure_indexes(collection)
+            self._collections[self.queue_collection_name] = collection
+        return collection
+
+    def ensure_indexes(self, collection=None):
+        '''
+        Create the indexes in QUEUE_INDEXES on the queue collection and
+        WORKER_INDEXES on the workers collection.
+
+        This is called once per process by the queue_collection property,
+        creating an index that already exists is a no-op.
+        '''
+        if collection is None:
+            collection = self.db[self.queue_collection_name]
+
+        for name, keys in QUEUE_INDEXES:
+            self.metadata_commands += 1
+            collection.create_index(keys, name=name, background=True)
+
+        for name, keys in WORKER_INDEXES:
+            self.metadata_commands += 1
+            self.worker_collection.create_index(keys, name=name, background=True)
+
+        for name, keys, options in LATENCY_INDEXES:
+            self.metadata_commands += 1
+            self.latency_collection.create_index(keys, name=name, background=True, **options)
+
+        _indexed_collections.add(collection.full_name)
+
+    def query_shapes(self):
+        '''
+        Example queries for every shape of query mtq issues against the queue collection
+
+        :returns: a list of (name, query, sort) tuples
+        '''
+        worker_id = ObjectId('000000000000000000000000')
+        pop_sort = POP_SORT
+        due_query = self.make_query(['default'], None)
+        due_query['process_after'] = {'$gt': now()}
+        return [
+            ('pop_item', self.make_query(['default'], ['tag']), pop_sort),
+            ('next_due', due_query, [('process_after', ASCENDING)]),
+            ('pop_item(failed)', self.make_query(['default'], None, failed=True), pop_sort),
+            ('items', self.make_query(['default'], None, processed=None), [('enqueued_at', DESCENDING)]),
+            ('num_processed', {'worker_id': worker_id}, None),
+            ('lost_jobs', {'worker_id': worker_id, 'processed': True, 'finished': False}, None),
+            ('last_job', {'worker_id': worker_id}, [('enqueued_at', DESCENDING)]),
+            ('job_stats', {'finished': True, 'finished_at': {'$gt': now()}}, None),
+        ]
+
+    @property
+    def stats_collection(self):
+        'The collection of materialized queue statistics, see mtq.stats'
+        return self.db['%s.stats' % self.collection_base]
+
+    @property
+    def stats(self):
+        'A QueueStats object to read and update the counters in the stats collection'
+        return QueueStats(self.stats_collection, self.latency_collection)
+
+    @property
+    def latency_collection(self):
+        'The collection of wait and run time histograms, see mtq.stats'
+        return self.db['%s.latency' % self.collection_base]
 
     @property
     def finished_jobs_collection(self):
         'The collection to push jobs to'
         collection_name = '%s.finished_jobs' % (self.collection_base)
-        return ensure_capped_collection(self.db, collection_name, self.qsize)
+        return self._capped_collection(collection_name, self.qsize)
 
     @property
     def logging_collection(self):
         'The collection to push log lines to'
-        db = self.db
         collection_name = '%s.log' % self.collection_base
-        return ensure_capped_collection(db, collection_name, self.logsize)
+        return self._capped_collection(collection_name, self.logsize)
+
+    @property
+    def profile_collection(self):
+        'The collection of job profiles, see mtq.profiling'
+        collection_name = '%s.profiles' % self.collection_base
+        indexed = collection_name in self._collections
+        collection = self._capped_collection(collection_name, _profilesize)
+        if not indexed:
+            # mtq-ctrl profile looks up the profiles of a job or of a task
+            self.metadata_commands += 2
+            collection.create_index([('job_id', ASCENDING)], name='mtq_profile_job', background=True)
+            collection.create_index([('func', ASCENDING), ('created', DESCENDING)], name='mtq_profile_func',
+                                    background=True)
+        return collection
+
+    @property
+    def signal_collection(self):
+        'The collection to signal idle workers that jobs were enqueued'
+        collection_name = '%s.signal' % self.collection_base
+        return self._capped_collection(collection_name, _signalsize)
+
+    def notify(self, docs):
+        '''
+        Signal idle workers that the jobs in `docs` were enqueued
+
+        One signal is written for each distinct queue and set of tags
+        '''
+        signals = {}
+        for doc in docs:
+            key = doc['qname'], tuple(sorted(doc.get('tags') or ()))
+            signals.setdefault(key, {'qname': doc['qname'], 'tags': list(key[1]), 'time': now()})
+
+        if signals:
+            # Unacknowledged, workers fall back to polling if a signal is lost
+            self.signal_collection.insert(list(signals.values()), w=0)
+
+    def notifier(self, queues=(), tags=()):
+        '''
+        Create a JobNotifier to wait for jobs on `queues` with `tags`
+        '''
+        return JobNotifier(self.signal_collection, queues, tags)
 
     @property
     def schedule_collection(self):
@@ -136,6 +330,26 @@ class MTQConnection(object):
         query.update(self.make_tag_query(tags))
         return query
 
+    def next_due(self, queues, tags, priority=0):
+        '''
+        The time the next delayed job on `queues` becomes due
+
+        :returns: a timezone aware datetime, or None if no job is waiting
+        '''
+        query = self.make_query(queues, tags, priority)
+        # Due jobs that could not be popped (e.g. their mutex is full) must not
+        # wake the worker again at once, it waits for a signal or max_idle
+        query['process_after'] = {'$gt': now()}
+        cursor = find(query, projection={'process_after': 1}, collection=self.queue_collection)
+        doc = next(iter(cursor.sort('process_after', ASCENDING).limit(1)), None)
+        if doc is None:
+            return None
+
+        due = doc['process_after']
+        if due.tzinfo is None:
+            due = due.replace(tzinfo=pytz.utc)
+        return due
+
     def make_tag_query(self, tags):
         'Query for tags'
         if not tags:
@@ -149,35 +363,75 @@ class MTQConnection(object):
 
         return tag_query
 
-    def add_mutex(self, query):
-        running_query = self.make_query(None, None, processed=True)
-        cursor = find(running_query, projection={'mutex':1, '_id':0},
-                      collection=self.queue_collection)
+    @property
+    def mutex_collection(self):
+        'The collection of mutex semaphores'
+        collection_name = '%s.mutex' % self.collection_base
+        return self.db[collection_name]
 
-        if not cursor.count():
-            return
+    def acquire_mutex(self, doc):
+        '''
+        Take a slot of a job's mutex semaphore
 
-        # Populate dictionary of mutex_key:count
-        mutex = {}
+        Each semaphore document has one entry in `holders` per running job,
+        a slot is free while the array has fewer than `mutex.count` entries.
+        A slot expires after the job's timeout (or `mtq.defaults._mutex_lease`
+        seconds) so that slots held by crashed workers are reclaimed.
 
-        # Iterate over running jobs
-        for item in cursor:
-            item_mutex = item.get('mutex', {})
-            if not item_mutex: continue
-            mutext_key = item_mutex.get('key')
-            if not mutext_key: continue
-            mutex.setdefault(mutext_key, 0)
-            mutex[mutext_key] += 1
+        :param doc: the job document
+        :returns: True if a slot was taken or the job has no mutex
+        '''
+        mutex = doc.get('mutex')
+        if not mutex or not mutex.get('key'):
+            return True
+
+        count = max(1, int(mutex.get('count') or 1))
+        lease = doc.get('timeout') or _mutex_lease
+        holder = {'job_id': doc['_id'], 'expires': now() + timedelta(seconds=lease)}
+        query = {'_id': mutex['key'], 'holders.%i' % (count - 1): {'$exists': False}}
+        update = {'$push': {'holders': holder}}
+
+        for _ in range(2):
+            try:
+                self.mutex_collection.update(query, update, upsert=True)
+                return True
+            except DuplicateKeyError:
+                # The semaphore exists and is full
+                pass
+
+            result = self.mutex_collection.update({'_id': mutex['key']},
+                                                  {'$pull': {'holders': {'expires': {'$lt': now()}}}})
+            if not result.get('nModified', result.get('n')):
+                break
+
+        return False
+
+    def release_mutex(self, doc):
+        '''
+        Free the slot of a job's mutex semaphore
 
-        # Query should inclue jobs with no mutex key or where its key is not in any running jobs
-        _or = [{'mutex': None}, {'mutex': {'$exists': False}},
-               {'mutex.key': {'$nin': list(mutex.keys())}}]
+        :param doc: the job document
+        '''
+        mutex = doc.get('mutex')
+        if not mutex or not mutex.get('key'):
+            return
 
-        # Query should inclue jobs where the mutex.count is > the # already running
-        for key, already_running in mutex.items():
-            _or.append({'mutex.key': key, 'mutex.count': {'$gt': already_running}})
+        self.mutex_collection.update({'_id': mutex['key']},
+                                     {'$pull': {'holders': {'job_id': doc['_id']}}})
 
-        query['$or'] = _or
+    def renew_mutex(self, doc):
+        '''
+        Extend the lease on the slot of a running job's mutex semaphore
+
+        :param doc: the job document
+        '''
+        mutex = doc.get('mutex')
+        if not mutex or not mutex.get('key'):
+            return
+
+        lease = doc.get('timeout') or _mutex_lease
+        self.mutex_collection.update({'_id': mutex['key'], 'holders.job_id': doc['_id']},
+                                     {'$set': {'holders.$.expires': now() + timedelta(seconds=lease)}})
 
     def pop_item(self, worker_id, queues, tags, priority=0, failed=False):
         'Pop an item from the queue'
@@ -188,21 +442,177 @@ class MTQConnection(object):
                           'worker_id':worker_id}
                   }
 
-        query = self.make_query(queues, tags, priority, failed)
-        self.add_mutex(query)
+        query = self.make_query(queues, tags, priority, failed=failed)
 
-        doc = self.queue_collection.find_and_modify(query, update, sort=[('enqueued_at', ASCENDING)])
+        blocked = []
+        while 1:
+            doc = self.queue_collection.find_and_modify(query, update, sort=POP_SORT, new=True)
+            if doc is None:
+                return None
 
-        if doc is None:
-            return None
-        else:
-            return mtq.Job(self, doc)
+            start = time.time()
+            if self.acquire_mutex(doc):
+                self.stats.popped([doc])
+                job = mtq.Job(self, doc)
+                if doc.get('mutex'):
+                    job.record_timing('mutex', start)
+                return job
+
+            # The job's mutex is full: put it back and skip jobs with that key
+            self.push_item(doc['_id'])
+            blocked.append(doc['mutex']['key'])
+            query['mutex.key'] = {'$nin': blocked}
+
+    def pop_items(self, worker_id, queues, tags, n, priority=0, failed=False):
+        '''
+        Claim up to `n` jobs for a worker
+
+        The ids of the next `n` jobs are read in pop order and claimed with a
+        single multi-update that only matches jobs that are still eligible,
+        tagging them with a claim id. The claimed jobs are then read back, so
+        this takes three round-trips however many jobs are claimed. Jobs whose
+        mutex is full are put back.
+
+        :returns: a list of Job objects in pop order
+        '''
+        query = self.make_query(queues, tags, priority, failed=failed)
+        cursor = find(query, projection={'_id': 1}, collection=self.queue_collection)
+        ids = [doc['_id'] for doc in cursor.sort(POP_SORT).limit(n)]
+        if not ids:
+            return []
+
+        started = now()
+        claim_id = ObjectId()
+        update = {'$set':{'processed':True,
+                          'started_at': started,
+                          'started_at_': mktime(started.timetuple()),
+                          'worker_id':worker_id,
+                          'claim_id': claim_id}
+                  }
+        query['_id'] = {'$in': ids}
+        self.queue_collection.update(query, update, multi=True)
+
+        cursor = self.queue_collection.find({'_id': {'$in': ids}, 'claim_id': claim_id})
+        jobs = []
+        for doc in cursor.sort(POP_SORT):
+            start = time.time()
+            if self.acquire_mutex(doc):
+                job = mtq.Job(self, doc)
+                if doc.get('mutex'):
+                    job.record_timing('mutex', start)
+                jobs.append(job)
+            else:
+                self.push_item(doc['_id'])
+        if jobs:
+            self.stats.popped(job.doc for job in jobs)
+        return jobs
+
+    def age_priorities(self, interval, max_priority, queues=None):
+        '''
+        Raise the priority of jobs that have waited too long
+
+        Every waiting job that has not been aged (or become due) in the last
+        `interval` seconds gets its priority incremented by one, up to
+        `max_priority`, so low priority jobs are not starved forever. Delayed
+        and retried jobs only age once they are due.
+
+        :param queues: only age jobs in these queues
+        :returns: the number of jobs that were aged
+        '''
+        n = now()
+        cutoff = n - timedelta(seconds=interval)
+        query = {'processed': False,
+                 'priority': {'$lt': max_priority},
+                 # process_after is never before enqueued_at
+                 'process_after': {'$lte': cutoff},
+                 '$or': [{'aged_at': {'$lte': cutoff}},
+                         {'aged_at': {'$exists': False}}],
+                 }
+        if queues:
+            query['qname'] = {'$in': list(queues)}
+
+        # Count the jobs that are aged for the priority counters of mtq-info
+        groups = self.queue_collection.aggregate([
+            {'$match': query},
+            {'$group': {'_id': {'qname': '$qname', 'func': '$execute.func_str', 'priority': '$priority'},
+                        'count': {'$sum': 1}}}], cursor={})
+        groups = [(group['_id']['qname'], group['_id']['func'], group['_id']['priority'], group['count'])
+                  for group in groups]
+        if not groups:
+            return 0
+
+        update = {'$inc': {'priority': 1}, '$set': {'aged_at': n}}
+        result = self.queue_collection.update(query, update, multi=True)
+        self.stats.aged(groups)
+        return result.get('n', 0) if result else 0
 
     def push_item(self, job_id):
+        'Put a claimed job that was not started back on the queue'
         query = {'_id': job_id}
-        update = {'$set':{'processed':False}}
+        update = {'$set':{'processed':False,
+                          'worker_id': ObjectId('000000000000000000000000')}}
         doc = self.queue_collection.find_and_modify(query, update)
 
+    def insert_jobs(self, docs, chunk_size=1000):
+        '''
+        Write job documents to the queue with unordered bulk inserts
+
+        :param docs: an iterable of documents created with Job.new
+        :param chunk_size: the number of documents to send per round-trip
+        :returns: an mtq.EnqueueResult, errors are reported per chunk
+        '''
+        result = mtq.EnqueueResult()
+        collection = self.queue_collection
+
+        for chunk_num, chunk in enumerate(chunked(docs, chunk_size)):
+            bulk = collection.initialize_unordered_bulk_op()
+            for doc in chunk:
+                doc.setdefault('_id', ObjectId())
+                bulk.insert(doc)
+            try:
+                bulk.execute()
+            except BulkWriteError as err:
+                failed = set()
+                for write_error in err.details.get('writeErrors', ()):
+                    failed.add(write_error['index'])
+                    result.errors.append({'chunk': chunk_num,
+                                          'index': chunk_num * chunk_size + write_error['index'],
+                                          'errmsg': write_error.get('errmsg')})
+                written = [doc for i, doc in enumerate(chunk) if i not in failed]
+            except PyMongoError as err:
+                result.errors.append({'chunk': chunk_num, 'index': None, 'errmsg': str(err)})
+                continue
+            else:
+                written = chunk
+
+            # Only the ids are kept so large batches are not held in memory
+            self.notify(written)
+            self.stats.enqueued(written)
+            result.job_ids.extend(doc['_id'] for doc in written)
+
+        return result
+
+    def enqueue_many(self, calls, chunk_size=1000):
+        '''
+        Enqueue many calls across queues in bulk
+
+        :param calls: an iterable of (queue_name, func_or_str, args) or
+            (queue_name, func_or_str, args, kwargs) tuples
+        :param chunk_size: the number of documents to send per round-trip
+        :returns: an mtq.EnqueueResult
+        '''
+        queues = {}
+
+        def docs():
+            for call in calls:
+                qname, func_or_str, args = call[:3]
+                kwargs = call[3] if len(call) > 3 else None
+                if qname not in queues:
+                    queues[qname] = self.queue(qname)
+                yield queues[qname].make_job_doc(func_or_str, args, kwargs)
+
+        return self.insert_jobs(docs(), chunk_size)
+
     def _items_cursor(self, queues, tags, priority=0, processed=False, limit=None, reverse=False):
         query = self.make_query(queues, tags, priority, processed=processed)
         cursor = self.queue_collection.find(query)
@@ -218,30 +628,42 @@ class MTQConnection(object):
         cursor = self._items_cursor(queues, tags, priority, processed, limit, reverse)
         return [mtq.Job(self, doc) for doc in cursor]
 
-    def queue(self, name='default', tags=(), priority=0):
+    def queue(self, name='default', tags=(), priority=0, retry=None):
         '''
         Create a queue object
 
         :param name: the name of the queue
         :param tags: default tags to give to jobs
-        :param priority: (not implemented yet)
+        :param priority: default priority of jobs, higher priority jobs are popped first
+        :param retry: default retry policy of jobs, see mtq.retry
         '''
 
-        return mtq.Queue(self, name, tags, priority)
+        return mtq.Queue(self, name, tags, priority, retry)
 
     def new_worker(self, queues=(), tags=(), priority=0, silence=False,
-                   log_worker_output=False, poll_interval=3, args=None):
+                   log_worker_output=False, poll_interval=3, args=None, notify=True, prefetch=0,
+                   heartbeat_interval=_heartbeat_interval, profile_sample=None):
         '''
         Create a worker object
 
-        :param queues: names of queues to pop from (these are OR'd)
+        :param queues: names of queues to pop from (these are OR'd). A name may be
+            given a weight as 'name:weight', the worker then shares its pops between
+            the queues in proportion to their weights (the default weight is 1)
         :param tags: jobs *must* have all these tags to be processed by this worker
-        :param priority: (not implemented yet)
+        :param priority: only process jobs with at least this priority
         :param log_worker_output: if true, log worker output to the db
+        :param notify: if true, idle workers wait for enqueue signals instead of
+            polling every `poll_interval` seconds
+        :param prefetch: claim this many jobs at a time and buffer them in the worker
+        :param heartbeat_interval: seconds between the worker's check-ins
+        :param profile_sample: the fraction of jobs to run under cProfile, see mtq.profiling
         '''
+        queues, weights = parse_queue_weights(queues)
         worker = mtq.Worker(self, queues, tags, priority,
                             log_worker_output=log_worker_output,
-                            silence=silence, extra_lognames=self.extra_lognames, poll_interval=poll_interval)
+                            silence=silence, extra_lognames=self.extra_lognames, poll_interval=poll_interval,
+                            notify=notify, prefetch=prefetch, weights=weights,
+                            heartbeat_interval=heartbeat_interval, profile_sample=profile_sample)
 
         self.args = args
         self.worker = worker
@@ -307,3 +729,9 @@ class MTQConnection(object):
 
     def scheduler(self):
         return mtq.Scheduler(self)
+
+    def reaper(self, max_age=_stale_worker_age, on_lost='requeue'):
+        '''
+        Create a Reaper to recover the jobs of dead workers, see mtq.reaper.Reaper
+        '''
+        return Reaper(self, max_age, on_lost)
@@ -4,5 +4,14 @@ Default values for the queue
 _collection_base = 'mq'
 _qsize = 50
 _logsize = 1000
+_profilesize = 50
 _workersize = 5
+_signalsize = 1
+_max_idle = 30
+_heartbeat_interval = 10
+_stale_worker_age = 5 * 60
+_mutex_lease = 60 * 60
+_max_aged_priority = 10
+_latency_period = 5 * 60
+_latency_retention = 7 * 24 * 60 * 60
 _task_map = {}
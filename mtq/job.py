@@ -3,10 +3,16 @@ Created on Aug 2, 2013
 
 @author: sean
 '''
-from mtq.utils import import_string, now, nulltime
+from mtq.utils import import_string, now, nulltime, is_coroutine, run_coroutine
+from mtq.retry import make_policy, is_retryable, retry_delay
+from mtq.stats import wait_time
+from mtq.pymongo3compat import find_one
+from datetime import timedelta
 from mtq.log import MongoStream
 from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
 from time import mktime
+import time
 
 class Job(object):
     '''
@@ -17,6 +23,9 @@ class Job(object):
     def __init__(self, factory, doc):
         self.factory = factory
         self.doc = doc
+        #: Seconds spent in each phase of this run of the job, see mtq.stats.PHASES.
+        #: They are saved with the finished job.
+        self.timings = {}
     def __repr__(self):
         return '<job queue=%r tags=%r func_name=%r>' % (self.qname, self.tags, self.func_name)
 
@@ -75,33 +84,124 @@ class Job(object):
         'The keyword arguments to call func with'
         return self.doc['execute']['kwargs']
 
+    def record_timing(self, phase, start):
+        'Set the time of a phase to the seconds since `start`'
+        self.timings[phase] = time.time() - start
+
     def apply(self):
         'Execute this task syncronusly'
-        return self.func(*self.args, **self.kwargs)
+        start = time.time()
+        func = self.func
+        self.record_timing('import', start)
+
+        start = time.time()
+        try:
+            result = func(*self.args, **self.kwargs)
+            if is_coroutine(result):
+                # A coroutine task run outside of the asyncio pool
+                result = run_coroutine(result)
+        finally:
+            self.record_timing('run', start)
+        return result
 
     def set_finished(self, failed=False):
         '''
         Mark this jog as finished.
-        
+
+        A successful job is moved to the finished jobs collection. The queue
+        document is removed and read back in one operation, so the fields
+        written after the job was popped (heartbeats, mutex leases, the errors
+        of earlier attempts) are kept. The insert is keyed by the job's _id so
+        it is never counted twice.
+
+        The job's timings are saved with it. The time of the `finish` phase,
+        these writes, is only added to the stats counters.
+
         :param failed: if true, this was a failed job
         '''
+        start = time.time()
         n = now()
 
-        update = {'$set':{'processed':True,
-                          'failed':failed,
-                          'finished':True,
-                          'finished_at': n,
-                          'finished_at_': mktime(n.timetuple())
-                          }
-                  }
+        timings = self.timings.copy()
+        wait = wait_time(self.doc)
+        if wait is not None:
+            timings['wait'] = wait
+
+        finished = {'processed':True,
+                    'failed':failed,
+                    'finished':True,
+                    'finished_at': n,
+                    'finished_at_': mktime(n.timetuple()),
+                    'timings': dict((phase, round(seconds, 6)) for phase, seconds in timings.items())
+                    }
+
+        if failed:
+            self.factory.queue_collection.update({'_id':self.id}, {'$set':finished})
+        else:
+            doc = self.factory.queue_collection.find_and_modify({'_id':self.id}, remove=True)
+            if doc is not None:
+                self.doc = doc
+            self.doc.update(finished)
+            try:
+                self.factory.finished_jobs_collection.insert(self.doc)
+            except DuplicateKeyError:
+                pass
+
+        self.factory.release_mutex(self.doc)
+
+        if self.doc.get('mutex'):
+            # A mutex slot was freed, wake the workers waiting on this queue
+            self.factory.notify([self.doc])
+
+        timings['finish'] = time.time() - start
+        self.factory.stats.finished([dict(self.doc, **dict(finished, timings=timings))], failed)
+
+    @property
+    def attempts(self):
+        'The number of times this job was retried'
+        return self.doc.get('attempts', 0)
+
+    def retry(self):
+        '''
+        Put this failed job back on the queue if its retry policy allows it
+
+        The same document is rescheduled in place: `process_after` is pushed
+        back by the policy's backoff and `attempts` is incremented.
+
+        :returns: the delay in seconds, or None if the job should not be retried
+        '''
+        policy = self.doc.get('retry')
+        if not policy:
+            return None
+
+        attempt = self.attempts + 1
+        if attempt >= policy['max_attempts']:
+            return None
+
+        if policy.get('retry_on') is not None:
+            doc = find_one({'_id': self.id}, projection={'last_error': 1},
+                           collection=self.factory.queue_collection)
+            error = doc.get('last_error') if doc else None
+            if error is not None and error.get('attempt') != self.attempts:
+                # Left over from an earlier attempt
+                error = None
+            if not is_retryable(policy, error):
+                return None
 
-        self.factory.queue_collection.update({'_id':self.id}, update)
+        delay = retry_delay(policy, attempt)
+        process_after = now() + timedelta(seconds=delay)
+        query = {'_id': self.id, 'finished': False}
+        update = {'$set': {'processed': False,
+                           'failed': False,
+                           'process_after': process_after},
+                  '$inc': {'attempts': 1}}
+        self.factory.queue_collection.update(query, update)
+        self.factory.release_mutex(self.doc)
+        self.factory.stats.requeued([self.doc])
 
-        if not failed:
-            data = self.factory.queue_collection.find_one({'_id':self.id})
-            if data:
-                self.factory.queue_collection.remove({'_id':self.id})
-                self.factory.finished_jobs_collection.insert(data)
+        self.doc.update(update['$set'])
+        self.doc['attempts'] = attempt
+        return delay
 
     def stream(self):
         '''
@@ -124,14 +224,15 @@ class Job(object):
 
 
     @classmethod
-    def new(cls, name, tags, priority, execute, timeout, mutex=None):
+    def new(cls, name, tags, priority, execute, timeout, mutex=None, on_lost=None, retry=None,
+            process_after=None, profile=False):
 
         n = now()
         no = mktime(n.timetuple())
         return {
                'qname':name,
                'tags': tags,
-               'process_after': n,
+               'process_after': process_after or n,
                'priority': priority,
 
                'execute': execute,
@@ -147,6 +248,10 @@ class Job(object):
                'timeout':timeout,
                'worker_id': ObjectId('000000000000000000000000'),
                'mutex': mutex,
+               'on_lost': on_lost,
+               'retry': make_policy(retry),
+               'attempts': 0,
+               'profile': bool(profile),
                }
 
 
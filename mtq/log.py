@@ -4,10 +4,24 @@ Created on Aug 1, 2013
 @author: sean
 '''
 from mtq.utils import now
+from mtq.pymongo3compat import find, tailable_find
+from pymongo.errors import DuplicateKeyError, PyMongoError
 import io
 import logging
 import sys
+import threading
 import time
+import weakref
+
+from mtq import metrics
+
+# Every BufferedWriter of this process, for the log_records_buffered metric
+_writers = weakref.WeakSet()
+
+
+def buffered_records():
+    'The number of log records buffered by the writers of this process'
+    return sum(len(writer) for writer in list(_writers))
 
 class ColorStreamHandler(logging.Handler):
     '''
@@ -73,16 +87,116 @@ class BSONFormatter(object):
         data.update(logLevel=record.levelname, logModule=record.module, logName=record.name, **self.extra_tags)
         return data
 
+class BufferedWriter(object):
+    '''
+    Buffer log documents and insert them into a collection in bulk
+
+    :param collection: the collection to insert into
+    :param max_records: flush when this many records are buffered
+    :param max_age: flush on write when the oldest record is this many seconds old
+    :param max_buffer: the most records to hold while mongo is unavailable
+    :param policy: what to do with a full buffer, 'drop' discards new records
+        and 'block' retries the flush until there is room (backpressure)
+
+    Dropped records are reported as a warning on the mq.Worker logger.
+    '''
+    def __init__(self, collection, max_records=100, max_age=1.0, max_buffer=10000, policy='drop'):
+        if policy not in ('drop', 'block'):
+            raise ValueError('policy must be one of "drop" or "block" (got %r)' % (policy,))
+
+        self.collection = collection
+        self.max_records = max_records
+        self.max_age = max_age
+        self.max_buffer = max_buffer
+        self.policy = policy
+
+        self.dropped = 0
+        self._reported = 0
+        self._reporting = False
+        self._buffer = []
+        self._oldest = None
+        self._lock = threading.RLock()
+        _writers.add(self)
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def write(self, doc):
+        'Buffer a document, flushing if the size or age threshold is reached'
+        with self._lock:
+            if len(self._buffer) >= self.max_buffer:
+                if self.policy == 'drop':
+                    self.dropped += 1
+                    metrics.inc('log_records_dropped')
+                    return
+                while not self.flush():
+                    time.sleep(1)
+
+            self._buffer.append(doc)
+            if self._oldest is None:
+                self._oldest = time.time()
+
+            due = (len(self._buffer) >= self.max_records or
+                   time.time() - self._oldest >= self.max_age)
+            if due:
+                self.flush()
+
+    def flush(self):
+        '''
+        Insert the buffered documents
+
+        :returns: False if mongo was unavailable, the documents stay buffered
+        '''
+        with self._lock:
+            if self._buffer:
+                try:
+                    # Keep going past documents written by an earlier partial flush
+                    self.collection.insert(self._buffer, continue_on_error=True)
+                except DuplicateKeyError:
+                    pass
+                except PyMongoError:
+                    return False
+                metrics.inc('log_records_written', len(self._buffer))
+                self._buffer = []
+                self._oldest = None
+
+        self._report_dropped()
+        return True
+
+    def _report_dropped(self):
+        if self._reporting or self.dropped == self._reported:
+            return
+        self._reporting = True
+        try:
+            dropped, self._reported = self.dropped - self._reported, self.dropped
+            logging.getLogger('mq.Worker').warning('Dropped %i log records for %s (log buffer full)',
+                                                   dropped, self.collection.full_name)
+        finally:
+            self._reporting = False
+
+    def close(self):
+        'Flush, reporting (and dropping) the documents that could not be written'
+        if not self.flush():
+            with self._lock:
+                self.dropped += len(self._buffer)
+                self._buffer = []
+                self._oldest = None
+            self._report_dropped()
+
+
 class MongoHandler(logging.Handler):
     '''
     Log to monog db
+
+    Records are written in bulk by a BufferedWriter, call flush to write them
     '''
-    def __init__(self, collection, doc):
+    def __init__(self, collection, doc, writer=None):
 
         logging.Handler.__init__(self, logging.INFO)
 
         self.collection = collection
         self.doc = doc
+        self.writer = writer or BufferedWriter(collection)
         self.setFormatter(BSONFormatter())
 
 
@@ -90,7 +204,14 @@ class MongoHandler(logging.Handler):
         doc = self.doc.copy()
         data = self.format(record)
         doc.update(data)
-        self.collection.insert(doc)
+        self.writer.write(doc)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+        logging.Handler.close(self)
 
 class TextIOWrapperSmart(io.TextIOWrapper):
     '''
@@ -138,9 +259,10 @@ class MongoStream(object):
     '''
     File like object to read/write to mongodb
     '''
-    def __init__(self, collection, doc, stream=None, finished=None, silence=False):
+    def __init__(self, collection, doc, stream=None, finished=None, silence=False, writer=None):
         self.collection = collection
         self.doc = doc
+        self.writer = writer or BufferedWriter(collection)
         self.stream = stream
         self._finished = finished
         self.silence = silence
@@ -163,32 +285,128 @@ class MongoStream(object):
         doc = self.doc.copy()
         doc.update(message=message, time=now())
 
-        self.collection.insert(doc)
+        self.writer.write(doc)
 
         if self.stream and not self.silence:
             self.stream.write(message)
         return len(message)
 
     def flush(self):
-        pass
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
 
     def loglines(self, follow=False):
-        starting_finished = not follow or self._finished()
+        finished = None
+        if self._finished is not None:
+            finished = lambda key, value: self._finished()
+
+        follower = LogFollower(self.collection, self.doc.items(), finished=finished)
+        for item in follower.docs(follow):
+            yield item.get('message', '')
+
 
-        cursor = self.collection.find(self.doc,
-                                      await_data=not starting_finished,
-                                      tailable=not starting_finished)
-        while 1:
-            for item in cursor:
-                text = item.get('message', '')
-                yield text
+class LogFollower(object):
+    '''
+    Read the log lines of many jobs and workers, optionally following them
 
-            if starting_finished or self._finished():
-                return
+    :param collection: the (capped) log collection
+    :param sources: (key, value) pairs such as ('job_id', job_id) or ('worker_id', worker_id)
+    :param finished: a callable finished(key, value) -> bool, only consulted
+        for sources that stop without writing an end of log record
+    :param check_interval: seconds without new log records before consulting `finished`
 
-            time.sleep(1)
+    All the sources are followed with a single tailable cursor, a source is
+    done when its end of log record (`'eof': True`) is read.
+    '''
+    def __init__(self, collection, sources, finished=None, check_interval=30):
+        self.collection = collection
+        self.sources = set(sources)
+        self.pending = set(self.sources)
+        self.finished = finished
+        self.check_interval = check_interval
+        self.last_id = None
+
+    def query(self):
+        values = {}
+        for key, value in self.pending:
+            values.setdefault(key, []).append(value)
+
+        clauses = [{key: {'$in': items}} for key, items in values.items()]
+        query = clauses[0] if len(clauses) == 1 else {'$or': clauses}
+        if self.last_id is not None:
+            # Always match the last document seen so a reopened cursor can skip to it
+            query = {'$or': [query, {'_id': self.last_id}]}
+        return query
+
+    def _skip_to(self):
+        '''
+        The _id to skip to when reopening the tailable cursor
+
+        ObjectIds are generated by each writer so they are not ordered across
+        hosts, the collection is tailed in natural (insertion) order instead.
+        Returns None if the last document seen has rolled out of the collection.
+        '''
+        if self.last_id is None:
+            return None
+        marker = next(find({'_id': self.last_id}, collection=self.collection).limit(1), None)
+        return self.last_id if marker is not None else None
+
+    def _seen(self, doc):
+        self.last_id = doc['_id']
+        if doc.get('eof'):
+            for key in ('job_id', 'worker_id'):
+                self.pending.discard((key, doc.get(key)))
+
+    def _check_finished(self):
+        if self.finished is not None:
+            self.pending = set(source for source in self.pending if not self.finished(*source))
+
+    def docs(self, follow=False):
+        '''
+        Yield the log documents of the sources
+
+        :param follow: if true, wait for new documents until every source is done
+        '''
+        if not self.pending:
+            return
+
+        for doc in find(self.query(), collection=self.collection):
+            self._seen(doc)
+            yield doc
+
+        if not follow:
+            return
+
+        self._check_finished()
+        while self.pending:
+            skip_to = self._skip_to()
+            cursor = tailable_find(self.query(), collection=self.collection)
+            last_data = time.time()
+            while self.pending and cursor.alive:
+                # Blocks server side until data arrives or the await times out
+                for doc in cursor:
+                    last_data = time.time()
+                    if skip_to is not None:
+                        if doc['_id'] == skip_to:
+                            skip_to = None
+                        continue
+
+                    self._seen(doc)
+                    yield doc
+                    if not self.pending:
+                        break
+
+                if self.pending and time.time() - last_data > self.check_interval:
+                    self._check_finished()
+                    last_data = time.time()
+
+            cursor.close()
+            if self.pending:
+                # The capped collection is empty or rolled over our position
+                time.sleep(1)
 
-        return
 
 def mstream(collection, doc, stream=None, silence=False):
     '''
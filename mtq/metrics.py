@@ -0,0 +1,228 @@
+'''
+In-process metrics for workers and the scheduler
+
+Counters are kept in memory and cost an increment under a lock, nothing is
+written to mongo. `serve` exposes them over HTTP in the Prometheus text
+format::
+
+    $ mtq-worker --metrics-port 9100
+    $ curl localhost:9100/metrics
+    # TYPE mtq_jobs_popped_total counter
+    mtq_jobs_popped_total 12
+    # TYPE mtq_pop_seconds summary
+    mtq_pop_seconds_count 15
+    mtq_pop_seconds_sum 0.0421
+    ...
+
+Jobs run by the 'process' and 'prefork' pools run in child processes, their
+own mongo operations are not counted.
+'''
+from __future__ import division
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger('mtq.metrics')
+
+#: Prefix of every metric name
+PREFIX = 'mtq_'
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in labels)
+
+
+class Registry(object):
+    '''
+    Counters, summaries (a count, sum and max of observed values) and gauges
+
+    Metric names are given without the `mtq_` prefix, counters get a
+    `_total` suffix when they are exposed.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._summaries = {}
+        self._gauges = {}
+
+    def inc(self, name, n=1, **labels):
+        'Increment a counter'
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def observe(self, name, value, **labels):
+        'Add a value, usually a duration in seconds, to a summary'
+        key = _key(name, labels)
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                self._summaries[key] = [1, value, value]
+            else:
+                summary[0] += 1
+                summary[1] += value
+                summary[2] = max(summary[2], value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        'Observe the number of seconds the block takes'
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def gauge(self, name, func):
+        'Register a function that returns the current value of a gauge'
+        self._gauges[name] = func
+
+    def get(self, name, **labels):
+        'The value of a counter'
+        return self._counters.get(_key(name, labels), 0)
+
+    def summary(self, name, **labels):
+        'The (count, sum, max) of a summary, or None'
+        summary = self._summaries.get(_key(name, labels))
+        return tuple(summary) if summary else None
+
+    def clear(self):
+        'Reset the counters and summaries'
+        with self._lock:
+            self._counters.clear()
+            self._summaries.clear()
+
+    def exposition(self):
+        'The metrics in the Prometheus text format'
+        with self._lock:
+            counters = sorted(self._counters.items())
+            summaries = sorted((key, tuple(value)) for key, value in self._summaries.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            metric = '%s%s_total' % (PREFIX, name)
+            if metric not in typed:
+                typed.add(metric)
+                lines.append('# TYPE %s counter' % metric)
+            lines.append('%s%s %s' % (metric, _format_labels(labels), value))
+
+        for (name, labels), (count, total, maximum) in summaries:
+            metric = '%s%s' % (PREFIX, name)
+            if metric not in typed:
+                typed.add(metric)
+                lines.append('# TYPE %s summary' % metric)
+            lines.append('%s_count%s %s' % (metric, _format_labels(labels), count))
+            lines.append('%s_sum%s %r' % (metric, _format_labels(labels), total))
+            lines.append('%s_max%s %r' % (metric, _format_labels(labels), maximum))
+
+        for name, func in sorted(self._gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                logger.exception('Could not read gauge %s', name)
+                continue
+            if value is None:
+                continue
+            metric = '%s%s' % (PREFIX, name)
+            lines.append('# TYPE %s gauge' % metric)
+            lines.append('%s %r' % (metric, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+#: The registry of this process
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+
+
+def _empty_pop_ratio():
+    pops = registry.get('pops')
+    return registry.get('pops_empty') / pops if pops else None
+
+
+def _log_records_buffered():
+    from mtq.log import buffered_records
+    return buffered_records()
+
+registry.gauge('empty_pop_ratio', _empty_pop_ratio)
+registry.gauge('log_records_buffered', _log_records_buffered)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = self.server.registry.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve(port, host='127.0.0.1', registry=registry):
+    '''
+    Serve the metrics over HTTP from a daemon thread
+
+    The metrics name queues and functions and are not authenticated, by
+    default they are only served on the loopback interface.
+
+    :returns: the HTTPServer, call its shutdown method to stop it
+    '''
+    server = HTTPServer((host, port), _Handler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever, name='mtq-metrics')
+    thread.daemon = True
+    thread.start()
+    logger.info('Serving metrics on %s:%i', *server.server_address[:2])
+    return server
+
+
+def monitor_mongo(registry=registry):
+    '''
+    Count the operations of every MongoClient created after this is called,
+    and their latency, by command name
+
+    Needs pymongo 3.1 or later, with older versions nothing is counted.
+
+    :returns: True if the operations are monitored
+    '''
+    try:
+        from pymongo import monitoring
+    except ImportError:
+        import pymongo
+        logger.warning('pymongo %s does not support monitoring, mongo operations are not counted',
+                       pymongo.version)
+        return False
+
+    class CommandListener(monitoring.CommandListener):
+
+        def started(self, event):
+            pass
+
+        def succeeded(self, event):
+            registry.inc('mongo_ops', command=event.command_name)
+            registry.observe('mongo_op_seconds', event.duration_micros / 1e6, command=event.command_name)
+
+        def failed(self, event):
+            registry.inc('mongo_op_errors', command=event.command_name)
+            registry.observe('mongo_op_seconds', event.duration_micros / 1e6, command=event.command_name)
+
+    monitoring.register(CommandListener())
+    return True
@@ -0,0 +1,98 @@
+'''
+Wake idle workers when jobs are enqueued
+
+Queue.enqueue_call writes a small signal document to the capped
+`<base>.signal` collection. Idle workers follow that collection with a
+tailable await cursor instead of polling the queue.
+'''
+import time
+
+from mtq.pymongo3compat import find, tailable_find
+from mtq.utils import now
+
+
+class JobNotifier(object):
+    '''
+    Block until a job for a set of queues and tags is enqueued
+
+    Do not create directly, use MTQConnection.notifier
+    '''
+    def __init__(self, collection, queues=(), tags=()):
+        self.collection = collection
+        self.queues = list(queues or ())
+        self.tags = set(tags or ())
+        self.last_id = None
+        self._skip_to = None
+        self._cursor = None
+
+    def __repr__(self):
+        return '<mtq.JobNotifier queues=%r tags=%r>' % (self.queues, sorted(self.tags))
+
+    def start(self):
+        '''
+        Start following signals, only signals written after this are waited for
+
+        Call this before checking the queue so a job enqueued in between is not missed.
+        '''
+        if self._cursor is None:
+            self._open()
+
+    def _open(self):
+        if self.last_id is None:
+            cursor = find({}, collection=self.collection).sort('$natural', -1).limit(1)
+            latest = next(cursor, None)
+            if latest is None:
+                # A tailable cursor on an empty capped collection dies at once
+                self.last_id = self.collection.insert({'seed': True, 'time': now()})
+            else:
+                self.last_id = latest['_id']
+
+        # ObjectIds are generated by each producer so they are not ordered
+        # across hosts. Tail in natural (insertion) order and skip up to the
+        # last signal seen, unless it has already rolled out of the collection
+        marker = next(find({'_id': self.last_id}, collection=self.collection).limit(1), None)
+        self._skip_to = self.last_id if marker is not None else None
+
+        query = {}
+        if self.queues:
+            query = {'$or': [{'qname': {'$in': self.queues}}, {'_id': self.last_id}]}
+
+        self._cursor = tailable_find(query, collection=self.collection)
+
+    def relevant(self, signal):
+        'test if a signal is for a job that this worker can process'
+        if not self.tags:
+            return True
+        return set(signal.get('tags', ())).issubset(self.tags)
+
+    def wait(self, timeout):
+        '''
+        Wait up to `timeout` seconds for a relevant job to be enqueued
+
+        :returns: True if a job was enqueued, False on timeout
+        '''
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self._cursor is None or not self._cursor.alive:
+                self._open()
+
+            # Blocks server side until data arrives or the await times out
+            for signal in self._cursor:
+                if self._skip_to is not None:
+                    if signal['_id'] == self._skip_to:
+                        self._skip_to = None
+                    continue
+
+                self.last_id = signal['_id']
+                if self.relevant(signal):
+                    return True
+
+            if not self._cursor.alive:
+                time.sleep(max(0, min(1, deadline - time.time())))
+
+        return False
+
+    def close(self):
+        if self._cursor is not None:
+            self._cursor.close()
+            self._cursor = None
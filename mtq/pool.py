@@ -0,0 +1,523 @@
+'''
+Pools of long-lived processes or threads that execute jobs for a worker
+
+The default worker forks a new process for every job. A pool keeps
+`concurrency` children alive and sends them jobs over a pipe, so short jobs
+do not pay for a fork, re-importing their task and reconnecting to mongo.
+The thread pool runs jobs in the worker process itself, for jobs that spend
+their time waiting on I/O.
+'''
+import ctypes
+import logging
+import os
+import signal
+import threading
+import time
+from multiprocessing import Process, Pipe
+
+try:
+    from queue import Queue, Empty
+except ImportError:  # Python 2
+    from Queue import Queue, Empty
+
+from mtq.job import Job
+from mtq.utils import handle_signals, current_rss
+from mtq import errors, metrics
+
+try:
+    from multiprocessing.connection import wait as _wait
+except ImportError:  # Python 2
+    import select
+
+    def _wait(conns, timeout):
+        readable, _, _ = select.select(conns, [], [], timeout)
+        return readable
+
+# Seconds to wait for a job to exit after it was interrupted
+_timeout_grace = 2 * 60
+
+logger = logging.getLogger('mq.Worker')
+
+
+def _child_main(worker, conn, max_jobs, max_rss):
+    '''
+    Main loop of a pool process: run jobs received from the pipe until told to exit
+    '''
+    handle_signals()
+    num_jobs = 0
+    while 1:
+        try:
+            doc = conn.recv()
+        except errors.Timeout:
+            # The alarm for a job that has just finished
+            continue
+        except EOFError:
+            break
+
+        if doc is None:
+            break
+
+        job = Job(worker.factory, doc)
+        # Tell the parent the job started, a job that was never started is requeued on stop
+        conn.send((job.id,))
+        try:
+            worker._run_job(job)
+            failed = False
+        except Exception:
+            failed = True
+
+        num_jobs += 1
+        recycle = bool(max_jobs and num_jobs >= max_jobs)
+        if max_rss and not recycle:
+            rss = current_rss()
+            recycle = bool(rss and rss > max_rss)
+
+        conn.send((job.id, failed, recycle, job.timings))
+        if recycle:
+            break
+
+
+class _Child(object):
+    'A pool process and the job it is running'
+    def __init__(self, proc, conn):
+        self.proc = proc
+        self.conn = conn
+        self.job = None
+        self.started = None
+        self.interrupted = None
+        #: True once the process has started running the job
+        self.running = False
+
+    @property
+    def deadline(self):
+        timeout = self.job.doc.get('timeout') if self.job else None
+        if not timeout:
+            return None
+        return self.started + timeout
+
+
+class PreforkPool(object):
+    '''
+    A pool of `concurrency` prefork processes
+
+    :param worker: the Worker that owns this pool
+    :param concurrency: number of child processes
+    :param max_jobs_per_child: replace a child after it has run this many jobs
+    :param max_rss: replace a child once its resident memory exceeds this many bytes
+
+    Job timeouts are enforced like Worker.process_job: the child is sent
+    SIGALRM (raising mtq.errors.Timeout in the job) and is terminated and
+    replaced if it does not finish the job within two minutes.
+    '''
+    def __init__(self, worker, concurrency=1, max_jobs_per_child=None, max_rss=None):
+        self.worker = worker
+        self.concurrency = concurrency
+        self.max_jobs_per_child = max_jobs_per_child
+        self.max_rss = max_rss
+        self.children = []
+
+    def __repr__(self):
+        return '<mtq.PreforkPool concurrency=%i busy=%i>' % (self.concurrency, self.busy)
+
+    def start(self):
+        while len(self.children) < self.concurrency:
+            self._spawn()
+
+    def _spawn(self):
+        parent_conn, child_conn = Pipe()
+        proc = Process(target=_child_main,
+                       args=(self.worker, child_conn, self.max_jobs_per_child, self.max_rss))
+        with self.worker.heartbeat.lock, metrics.timer('fork_seconds'):
+            # Do not fork while the heartbeat thread is using the mongo client
+            proc.start()
+        child_conn.close()
+        self.children.append(_Child(proc, parent_conn))
+
+    def _replace(self, child):
+        child.conn.close()
+        if child.proc.is_alive():
+            child.proc.terminate()
+        child.proc.join()
+        self.children.remove(child)
+        self._spawn()
+
+    @property
+    def idle(self):
+        'The number of processes without a job'
+        return sum(1 for child in self.children if child.job is None)
+
+    @property
+    def busy(self):
+        'The number of processes running a job'
+        return len(self.children) - self.idle
+
+    def submit(self, job):
+        'Send a job to an idle process'
+        child = next(child for child in self.children if child.job is None)
+        child.job = job
+        child.started = time.time()
+        child.interrupted = None
+        child.running = False
+        child.conn.send(job.doc)
+
+    def collect(self, timeout=0):
+        '''
+        Wait up to `timeout` seconds for jobs to finish
+
+        :returns: a list of (job, failed) tuples
+        '''
+        results = []
+        busy = [child for child in self.children if child.job is not None]
+        if not busy:
+            return results
+
+        readable = _wait([child.conn for child in busy], self._wait_time(busy, timeout))
+        for child in busy:
+            if child.conn not in readable:
+                continue
+            job = child.job
+            try:
+                message = child.conn.recv()
+                if len(message) == 1:
+                    child.running = True
+                    if not child.conn.poll():
+                        continue
+                    message = child.conn.recv()
+            except (EOFError, IOError, OSError):
+                child.job = None
+                logger.error('Pool process %s died running job %s', child.proc.pid, job.id)
+                results.append((job, True))
+                self._replace(child)
+                continue
+
+            child.job = None
+            _, failed, recycle, timings = message
+            job.timings.update(timings)
+            results.append((job, failed))
+            if recycle:
+                logger.info('Recycling pool process %s', child.proc.pid)
+                self._replace(child)
+
+        self._enforce_timeouts(results)
+        return results
+
+    def _wait_time(self, busy, timeout):
+        'do not sleep past the next job timeout'
+        deadlines = [child.deadline for child in busy if child.deadline]
+        if deadlines:
+            timeout = max(0, min(timeout, min(deadlines) - time.time()))
+        return timeout
+
+    def _enforce_timeouts(self, results):
+        n = time.time()
+        for child in list(self.children):
+            deadline = child.deadline
+            if deadline is None or n < deadline:
+                continue
+            if child.interrupted is None:
+                logger.error('Timeout occurred: interrupting job %s', child.job.id)
+                metrics.inc('jobs_timed_out')
+                child.interrupted = n
+                try:
+                    os.kill(child.proc.pid, signal.SIGALRM)
+                except OSError:
+                    pass
+            elif n - child.interrupted > min(child.job.doc['timeout'], _timeout_grace):
+                logger.error('Process did not shut down after interrupt: terminating job %s', child.job.id)
+                results.append((child.job, True))
+                self._replace(child)
+
+    def stop(self, timeout=None):
+        '''
+        Stop all processes, waiting up to `timeout` seconds for running jobs
+
+        Jobs that were sent to a process that never started them are put back
+        on the queue.
+
+        :returns: a list of (job, failed) tuples for the jobs that were running
+        '''
+        results = []
+        deadline = None if timeout is None else time.time() + timeout
+        while self.busy and (deadline is None or time.time() < deadline):
+            results.extend(self.collect(timeout=1))
+
+        for child in self.children:
+            try:
+                child.conn.send(None)
+            except (IOError, OSError):
+                pass
+
+        for child in self.children:
+            child.proc.join(timeout=5)
+            if child.proc.is_alive():
+                child.proc.terminate()
+                child.proc.join()
+            if child.job is not None:
+                self._stopped_job(child, results)
+            child.conn.close()
+
+        self.children = []
+        return results
+
+    def _stopped_job(self, child, results):
+        'Read what a process that has exited did with its job'
+        try:
+            while child.conn.poll():
+                message = child.conn.recv()
+                if len(message) == 1:
+                    child.running = True
+                    continue
+                _, failed, _, timings = message
+                child.job.timings.update(timings)
+                results.append((child.job, failed))
+                return
+        except (EOFError, IOError, OSError):
+            pass
+
+        if child.running:
+            results.append((child.job, True))
+        else:
+            self.worker.requeue_job(child.job)
+
+
+def _async_raise(ident, exc_type):
+    '''
+    Raise `exc_type` in the thread `ident` the next time it runs python code
+
+    :returns: True if the thread was found
+    '''
+    found = ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(ident), ctypes.py_object(exc_type))
+    if found > 1:
+        # Should never happen, undo it
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(ident), None)
+    return found == 1
+
+
+def _clear_async_exc(ident):
+    'Cancel an exception set by _async_raise that has not been raised yet'
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(ident), None)
+
+
+class _Running(object):
+    'A job running in a pool thread'
+    def __init__(self, job, ident):
+        self.job = job
+        self.ident = ident
+        self.started = time.time()
+        self.interrupted = None
+        self.abandoned = False
+
+    @property
+    def deadline(self):
+        timeout = self.job.doc.get('timeout')
+        if not timeout:
+            return None
+        return self.started + timeout
+
+
+class ThreadPool(object):
+    '''
+    A pool of `concurrency` threads in the worker process
+
+    :param worker: the Worker that owns this pool
+    :param concurrency: number of threads
+
+    max_jobs_per_child and max_rss are accepted for compatibility with
+    PreforkPool and ignored, threads can not be recycled.
+
+    Timeouts are cooperative: a job can not be interrupted while it is
+    blocked in C code (a socket read for example). Tasks should call
+    mtq.check_timeout() regularly, as a best effort mtq.errors.Timeout is also
+    raised asynchronously in the thread when the job times out. A job that
+    still has not finished two minutes later is reported as failed and its
+    thread is abandoned and replaced.
+    '''
+    def __init__(self, worker, concurrency=1, max_jobs_per_child=None, max_rss=None):
+        self.worker = worker
+        self.concurrency = concurrency
+        self.threads = []
+        self._tasks = Queue()
+        self._results = Queue()
+        self._running = {}
+        self._submitted = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<mtq.ThreadPool concurrency=%i busy=%i>' % (self.concurrency, self.busy)
+
+    def start(self):
+        while len(self.threads) < self.concurrency:
+            self._spawn()
+
+    def _spawn(self):
+        thread = threading.Thread(target=self._thread_main, name='mtq-pool-%i' % len(self.threads))
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def _thread_main(self):
+        while 1:
+            try:
+                if not self._run_next():
+                    break
+            except errors.Timeout:
+                # A late interrupt for a job that had just finished
+                continue
+
+    def _run_next(self):
+        '''
+        Run the next job from the task queue
+
+        :returns: False if the thread should exit
+        '''
+        job = self._tasks.get()
+        if job is None:
+            return False
+
+        with self._lock:
+            running = self._running[job.id] = _Running(job, threading.current_thread().ident)
+
+        failed = True
+        try:
+            try:
+                # Other jobs log from the pool's other threads
+                self.worker._run_job(job, thread_filter=True)
+                failed = False
+            except BaseException:
+                pass
+
+            with self._lock:
+                del self._running[job.id]
+                if running.interrupted is not None:
+                    # The job returned before the interrupt was delivered
+                    _clear_async_exc(running.ident)
+        except errors.Timeout:
+            # The interrupt landed after the job returned, it is only raised once
+            with self._lock:
+                self._running.pop(job.id, None)
+
+        if running.abandoned:
+            # The job was already reported and this thread replaced
+            return False
+        self._results.put((job, failed))
+        return True
+
+    @property
+    def busy(self):
+        'The number of jobs submitted and not collected'
+        return self._submitted
+
+    @property
+    def idle(self):
+        'The number of threads without a job'
+        return max(0, self.concurrency - self.busy)
+
+    def submit(self, job):
+        'Send a job to an idle thread'
+        self._submitted += 1
+        self._tasks.put(job)
+
+    def collect(self, timeout=0):
+        '''
+        Wait up to `timeout` seconds for jobs to finish
+
+        :returns: a list of (job, failed) tuples
+        '''
+        results = []
+        if not self.busy:
+            return results
+
+        try:
+            if timeout:
+                results.append(self._results.get(timeout=self._wait_time(timeout)))
+            while 1:
+                results.append(self._results.get_nowait())
+        except Empty:
+            pass
+
+        self._submitted -= len(results)
+        self._enforce_timeouts(results)
+        return results
+
+    def _wait_time(self, timeout):
+        'do not sleep past the next job timeout'
+        with self._lock:
+            deadlines = [running.deadline for running in self._running.values()
+                         if running.deadline and not running.abandoned]
+        if deadlines:
+            timeout = max(0.01, min(timeout, min(deadlines) - time.time()))
+        return timeout
+
+    def _enforce_timeouts(self, results):
+        n = time.time()
+        with self._lock:
+            running_jobs = [running for running in self._running.values() if not running.abandoned]
+
+        for running in running_jobs:
+            deadline = running.deadline
+            if deadline is None or n < deadline:
+                continue
+            with self._lock:
+                if running.job.id not in self._running:
+                    # It finished in the meantime
+                    continue
+                if running.interrupted is None:
+                    logger.error('Timeout occurred: interrupting job %s', running.job.id)
+                    metrics.inc('jobs_timed_out')
+                    running.interrupted = n
+                    _async_raise(running.ident, errors.Timeout)
+                    continue
+                if n - running.interrupted <= min(running.job.doc['timeout'], _timeout_grace):
+                    continue
+                logger.error('Thread did not stop after interrupt: abandoning job %s', running.job.id)
+                running.abandoned = True
+
+            self._submitted -= 1
+            results.append((running.job, True))
+            self._spawn()
+
+    def stop(self, timeout=None):
+        '''
+        Stop all threads, waiting up to `timeout` seconds for running jobs
+
+        Jobs that no thread has started are put back on the queue.
+
+        :returns: a list of (job, failed) tuples for the jobs that were running
+        '''
+        results = []
+        deadline = None if timeout is None else time.time() + timeout
+        while self.busy and (deadline is None or time.time() < deadline):
+            results.extend(self.collect(timeout=1))
+
+        try:
+            while 1:
+                job = self._tasks.get_nowait()
+                if job is not None:
+                    # No thread started it
+                    self.worker.requeue_job(job)
+        except Empty:
+            pass
+
+        with self._lock:
+            for running in self._running.values():
+                if not running.abandoned:
+                    running.abandoned = True
+                    results.append((running.job, True))
+
+        for _ in self.threads:
+            self._tasks.put(None)
+        for thread in self.threads:
+            thread.join(timeout=5)
+
+        self.threads = []
+        self._submitted = 0
+        return results
+
+
+def AsyncioPool(*args, **kwargs):
+    'Create a mtq.aio.AsyncioPool (Python 3.7+)'
+    from mtq.aio import AsyncioPool
+    return AsyncioPool(*args, **kwargs)
+
+
+POOLS = {'prefork': PreforkPool, 'threads': ThreadPool, 'asyncio': AsyncioPool}
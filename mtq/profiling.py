@@ -0,0 +1,122 @@
+'''
+Sampled cProfile capture of jobs
+
+A worker started with `--profile-sample 0.01` runs one job in a hundred under
+cProfile, and jobs enqueued with `profile=True` are always profiled. The
+profile is written where the job runs (the forked child of the 'process'
+mode, a prefork child or a worker thread) to a capped collection::
+
+    {'job_id': ObjectId(...), 'func': 'execute.this', 'qname': 'default',
+     'worker_id': ObjectId(...), 'attempt': 0, 'created': datetime(...),
+     'duration': 2.9,
+     'stats': Binary(...)}  # zlib compressed marshal of the pstats dict
+
+`mtq-ctrl profile` merges the profiles of a job or of the sampled runs of a
+task and prints the functions the time was spent in.
+
+The asyncio pool does not profile jobs.
+'''
+import cProfile
+import logging
+import marshal
+import pstats
+import random
+import time
+import zlib
+
+from bson.binary import Binary
+from pymongo import DESCENDING
+
+from mtq.utils import now
+
+logger = logging.getLogger('mq.Worker')
+
+
+def should_profile(job, sample=None):
+    'Test if a job should be profiled, it was enqueued with profile=True or it is sampled'
+    if job.doc.get('profile'):
+        return True
+    return bool(sample) and random.random() < sample
+
+
+def profile_apply(job, collection, worker_id=None):
+    '''
+    Run job.apply under cProfile and save the profile, even if the job fails
+
+    A profile that can not be taken or saved is logged, it never changes the
+    outcome of the job. Only one profiler can be enabled at a time (Python
+    3.12+), a job run while another thread is profiling is not profiled.
+
+    :returns: the result of the job
+    '''
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as err:
+        logger.warning('Could not profile job %s, running it without the profiler (%s)', job.id, err)
+        return job.apply()
+
+    start = time.time()
+    try:
+        return job.apply()
+    finally:
+        profiler.disable()
+        try:
+            save_profile(collection, job, profiler, time.time() - start, worker_id)
+        except Exception:
+            logger.exception('Could not save the profile of job %s', job.id)
+
+
+def save_profile(collection, job, profiler, duration, worker_id=None):
+    'Write the stats of a profiler to the profile collection'
+    profiler.create_stats()
+    doc = {'job_id': job.id,
+           'func': job.func_name,
+           'qname': job.qname,
+           'worker_id': worker_id,
+           'attempt': job.attempts,
+           'created': now(),
+           'duration': duration,
+           'stats': Binary(zlib.compress(marshal.dumps(profiler.stats))),
+           }
+    collection.insert(doc)
+    return doc
+
+
+def load_profiles(collection, job_id=None, func=None, limit=100):
+    '''
+    The latest profile documents of a job or of a task
+
+    :param limit: the most documents to load, 0 for all
+    '''
+    query = {}
+    if job_id is not None:
+        query['job_id'] = job_id
+    if func is not None:
+        query['func'] = func
+    return list(collection.find(query).sort('created', DESCENDING).limit(limit))
+
+
+class _LoadedProfile(object):
+    'Stands in for a profiler so pstats.Stats can load stats that were saved'
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def merge_profiles(docs, stream=None):
+    '''
+    Merge the stats of profile documents, the time of each function is summed
+
+    :returns: a pstats.Stats, or None if there are no documents
+    '''
+    merged = None
+    for doc in docs:
+        loaded = _LoadedProfile(marshal.loads(zlib.decompress(doc['stats'])))
+        if merged is None:
+            merged = pstats.Stats(loaded, stream=stream)
+        else:
+            merged.add(loaded)
+    return merged
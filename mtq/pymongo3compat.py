@@ -141,6 +141,21 @@ def find_one(*args, **kwargs):
     return _find_like_method(*args, **kwargs)
 
 
+def tailable_find(*args, **kwargs):
+    """
+    Wraps the find method to open a tailable cursor that awaits data
+    (on a capped collection).
+    """
+    if PYMONGO_28:
+        kwargs.update(tailable=True, await_data=True)
+    elif PYMONGO_3:
+        kwargs['cursor_type'] = pymongo.cursor.CursorType.TAILABLE_AWAIT
+    else:
+        raise PyMongoVersionError
+
+    return find(*args, **kwargs)
+
+
 def with_options(codec_options=None, collection=None):
     """
     Helper method for using a document_class (as_class) in pymongo 2.8.
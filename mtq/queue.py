@@ -1,9 +1,39 @@
+from datetime import timedelta
+
 from mtq.job import Job
-from mtq.utils import is_str
+from mtq.utils import is_str, now
 
 class QueueError(Exception):
     pass
 
+
+class EnqueueResult(object):
+    '''
+    The outcome of a bulk enqueue.
+
+    :attr job_ids: list of the ids of the jobs that were written to the
+        queue, use MTQConnection.get_job to load one
+    :attr errors: list of dicts, one per failed write, with the keys
+        `chunk` (chunk number), `index` (position in the input or None if the
+        whole chunk failed) and `errmsg`
+    '''
+    def __init__(self):
+        self.job_ids = []
+        self.errors = []
+
+    def __repr__(self):
+        return '<mtq.EnqueueResult inserted:%i errors:%i>' % (self.inserted, len(self.errors))
+
+    @property
+    def inserted(self):
+        'Number of jobs written to the queue'
+        return len(self.job_ids)
+
+    @property
+    def ok(self):
+        'True if every job was written'
+        return not self.errors
+
 class Queue(object):
     '''
     A queue to enqueue an pop tasks
@@ -15,12 +45,13 @@ class Queue(object):
     def __repr__(self):
         return '<mtq.Queue name:%s tags:%r>' % (self.name, self.tags)
 
-    def __init__(self, factory, name='default', tags=(), priority=0):
+    def __init__(self, factory, name='default', tags=(), priority=0, retry=None):
 
         self.name = name or 'default'
         self.factory = factory
         self.tags = tuple(tags) if tags else ()
         self.priority = priority
+        self.retry = retry
 
 
     def enqueue(self, func_or_str, *args, **kwargs):
@@ -35,7 +66,24 @@ class Queue(object):
         '''
         return self.enqueue_call(func_or_str, args, kwargs)
 
-    def enqueue_call(self, func_or_str, args=(), kwargs=None, tags=(), priority=None, timeout=None, mutex=None):
+    def enqueue_at(self, when, func_or_str, *args, **kwargs):
+        '''
+        Like `.enqueue()`, but the job is not processed before the datetime
+        `when` (naive datetimes are in UTC)
+        '''
+        return self.enqueue_call(func_or_str, args, kwargs, process_after=when)
+
+    def enqueue_in(self, delay, func_or_str, *args, **kwargs):
+        '''
+        Like `.enqueue()`, but the job is not processed for `delay` (a
+        timedelta or a number of seconds)
+        '''
+        if not isinstance(delay, timedelta):
+            delay = timedelta(seconds=delay)
+        return self.enqueue_call(func_or_str, args, kwargs, process_after=now() + delay)
+
+    def enqueue_call(self, func_or_str, args=(), kwargs=None, tags=(), priority=None, timeout=None, mutex=None,
+                     on_lost=None, retry=None, process_after=None, profile=False):
         '''
         Creates a job to represent the delayed function call and enqueues
         it.
@@ -43,6 +91,45 @@ class Queue(object):
         It is much like `.enqueue()`, except that it takes the function's args
         and kwargs as explicit arguments.  Any kwargs passed to this function
         contain options for MQ itself.
+
+        :param on_lost: what mtq.reaper.Reaper does with the job if its worker
+            dies while running it, 'requeue' or 'fail' (default: the reaper's policy)
+        :param retry: the retry policy if the job fails, see mtq.retry (default:
+            the queue's policy)
+        :param process_after: a datetime, the job is not processed before it (default: now)
+        :param profile: if true, run the job under cProfile, see mtq.profiling
+        '''
+        doc = self.make_job_doc(func_or_str, args, kwargs, tags, priority, timeout, mutex, on_lost, retry,
+                                process_after, profile)
+        collection = self.factory.queue_collection
+        collection.insert(doc)
+        self.factory.notify([doc])
+        self.factory.stats.enqueued([doc])
+
+        return Job(self.factory, doc)
+
+    def enqueue_many(self, func_or_str, iterable_of_args, kwargs=None, tags=(), priority=None,
+                     timeout=None, mutex=None, on_lost=None, retry=None, process_after=None, profile=False,
+                     chunk_size=1000):
+        '''
+        Enqueue one call of `func_or_str` for every args tuple in `iterable_of_args`.
+
+        Jobs are written with unordered bulk inserts of `chunk_size` documents,
+        so a failure in one chunk does not abort the rest of the batch. The
+        other options are shared by every call, see `.enqueue_call()`.
+
+        :param kwargs: keyword arguments shared by every call
+        :returns: an EnqueueResult
+        '''
+        docs = (self.make_job_doc(func_or_str, args, kwargs, tags, priority, timeout, mutex, on_lost, retry,
+                                  process_after, profile)
+                for args in iterable_of_args)
+        return self.factory.insert_jobs(docs, chunk_size)
+
+    def make_job_doc(self, func_or_str, args=(), kwargs=None, tags=(), priority=None, timeout=None, mutex=None,
+                     on_lost=None, retry=None, process_after=None, profile=False):
+        '''
+        Validate the arguments of a call and build the job document for it
         '''
         if not is_str(func_or_str):
             name = getattr(func_or_str, '__name__', None)
@@ -67,12 +154,12 @@ class Queue(object):
         if priority is None:
             priority = self.priority
 
-        tags = self.tags + tuple(tags)
-        doc = Job.new(self.name, tags, priority, execute, timeout, mutex)
-        collection = self.factory.queue_collection
-        collection.insert(doc)
+        if retry is None:
+            retry = self.retry
 
-        return Job(self.factory, doc)
+        tags = self.tags + tuple(tags)
+        return Job.new(self.name, tags, priority, execute, timeout, mutex, on_lost, retry, process_after,
+                       profile)
 
 
     @property
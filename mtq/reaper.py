@@ -0,0 +1,135 @@
+'''
+Recover the jobs of workers that died
+
+A worker checks in from its heartbeat thread every few seconds. When a
+worker host dies its jobs stay processed but unfinished and keep holding
+their mutex slots. The reaper finds workers that have not checked in for
+`max_age` seconds and requeues or fails their jobs.
+'''
+from datetime import timedelta
+from time import mktime
+import logging
+
+from mtq.defaults import _stale_worker_age
+from mtq.pymongo3compat import find
+from mtq.utils import now
+
+#: What to do with the jobs of a dead worker
+ON_LOST_POLICIES = ('requeue', 'fail')
+
+
+class Reaper(object):
+    '''
+    Requeue or fail the jobs of workers that stopped checking in
+
+    :param factory: an MTQConnection
+    :param max_age: seconds since the last check-in before a worker is dead
+    :param on_lost: the policy for jobs that were not enqueued with their own
+        `on_lost`, 'requeue' or 'fail'
+    '''
+    def __init__(self, factory, max_age=_stale_worker_age, on_lost='requeue'):
+        if on_lost not in ON_LOST_POLICIES:
+            raise ValueError('on_lost must be one of %r (got %r)' % (ON_LOST_POLICIES, on_lost))
+        self.factory = factory
+        self.max_age = max_age
+        self.on_lost = on_lost
+        self.logger = logging.getLogger('mtq.Reaper')
+
+    def __repr__(self):
+        return '<mtq.Reaper max_age=%s on_lost=%s>' % (self.max_age, self.on_lost)
+
+    def stale_query(self):
+        'query for workers that are working but have not checked in'
+        cutoff = now() - timedelta(seconds=self.max_age)
+        return {'working': True, 'check-in': {'$lt': cutoff}}
+
+    def stale_workers(self):
+        'The documents of the workers that have not checked in for max_age seconds'
+        return list(self.factory.worker_collection.find(self.stale_query()))
+
+    def claim_worker(self, worker_id):
+        '''
+        Atomically mark a stale worker as not working
+
+        The worker is also asked to terminate, in case it was only cut off
+        and checks in again later.
+
+        :returns: the worker document, or None if it checked in or was
+            reaped by someone else in the meantime
+        '''
+        query = self.stale_query()
+        query['_id'] = worker_id
+        update = {'$set': {'working': False,
+                           'finished': now(),
+                           'reaped': True,
+                           'terminate': True,
+                           'terminate_status': 1}}
+        return self.factory.worker_collection.find_and_modify(query, update)
+
+    def lost_jobs(self, worker_id):
+        'The unfinished jobs of a worker'
+        query = {'worker_id': worker_id, 'processed': True, 'finished': False}
+        projection = {'_id': 1, 'qname': 1, 'tags': 1, 'mutex': 1, 'on_lost': 1,
+                      'execute.func_str': 1, 'started_at': 1, 'started_at_': 1}
+        return list(find(query, projection=projection, collection=self.factory.queue_collection))
+
+    def reap_worker(self, worker_id):
+        '''
+        Claim a stale worker and requeue or fail its jobs
+
+        :returns: a (requeued, failed) tuple of job ids, or None if the
+            worker could not be claimed
+        '''
+        if self.claim_worker(worker_id) is None:
+            return None
+
+        docs = self.lost_jobs(worker_id)
+        requeued = [doc['_id'] for doc in docs if (doc.get('on_lost') or self.on_lost) == 'requeue']
+        failed = [doc['_id'] for doc in docs if (doc.get('on_lost') or self.on_lost) == 'fail']
+
+        coll = self.factory.queue_collection
+        # Only touch jobs that are still unfinished and owned by this worker
+        guard = {'worker_id': worker_id, 'processed': True, 'finished': False}
+        if requeued:
+            query = dict(guard, _id={'$in': requeued})
+            coll.update(query, {'$set': {'processed': False}, '$inc': {'lost_count': 1}}, multi=True)
+        n = now()
+        finished = {'failed': True,
+                    'finished': True,
+                    'finished_at': n,
+                    'finished_at_': mktime(n.timetuple())}
+        if failed:
+            query = dict(guard, _id={'$in': failed})
+            coll.update(query, {'$set': finished, '$inc': {'lost_count': 1}}, multi=True)
+
+        job_ids = requeued + failed
+        if any(doc.get('mutex') for doc in docs):
+            self.factory.mutex_collection.update({'holders.job_id': {'$in': job_ids}},
+                                                 {'$pull': {'holders': {'job_id': {'$in': job_ids}}}},
+                                                 multi=True)
+
+        self.factory.notify(doc for doc in docs if doc['_id'] in set(requeued))
+        self.factory.stats.requeued(doc for doc in docs if doc['_id'] in set(requeued))
+        self.factory.stats.finished([dict(doc, **finished) for doc in docs if doc['_id'] in set(failed)],
+                                    failed=True)
+        return requeued, failed
+
+    def reap(self):
+        '''
+        Reap every stale worker
+
+        :returns: a dict with the number of `workers`, `requeued` and `failed` jobs
+        '''
+        result = {'workers': 0, 'requeued': 0, 'failed': 0}
+        for worker in self.stale_workers():
+            reaped = self.reap_worker(worker['_id'])
+            if reaped is None:
+                continue
+            requeued, failed = reaped
+            self.logger.warning('Reaped worker %s (%s), last checked in %s: requeued %i jobs, failed %i jobs'
+                                % (worker.get('name'), worker['_id'], worker.get('check-in'),
+                                   len(requeued), len(failed)))
+            result['workers'] += 1
+            result['requeued'] += len(requeued)
+            result['failed'] += len(failed)
+        return result
@@ -0,0 +1,96 @@
+'''
+Retry policies for failed jobs
+
+A policy is stored in the job document when it is enqueued::
+
+    {'max_attempts': 5,     # attempts in total, including the first one
+     'delay': 1.0,          # base delay in seconds
+     'max_delay': 3600,     # cap on the delay
+     'jitter': True,        # full jitter: a random delay between 0 and the backoff
+     'retry_on': ['socket.error', 'mtq.errors.Timeout']}  # None retries any failure
+
+A failed job that may be retried is put back on the queue with
+`process_after` set to now plus an exponential backoff of `delay * 2 ** n`.
+With jitter the retries of jobs that failed together are spread out instead
+of hitting a recovering service at the same time.
+'''
+import random
+
+from mtq.utils import is_str
+
+#: Defaults for the keys a policy does not set
+DEFAULT_POLICY = {'max_attempts': 3,
+                  'delay': 1.0,
+                  'max_delay': 60 * 60,
+                  'jitter': True,
+                  'retry_on': None,
+                  }
+
+
+def _type_name(exc_type):
+    return '%s.%s' % (exc_type.__module__, exc_type.__name__)
+
+
+def make_policy(retry):
+    '''
+    Normalize a retry policy so it can be stored in a job document
+
+    :param retry: None, the maximum number of attempts or a dict with the
+        keys of DEFAULT_POLICY. `retry_on` may list exception classes or
+        their import strings.
+    :returns: a policy dict or None
+    '''
+    if retry is None or retry is False:
+        return None
+    if isinstance(retry, int) and not isinstance(retry, bool):
+        retry = {'max_attempts': retry}
+    if not isinstance(retry, dict):
+        raise TypeError('retry must be a number of attempts or a dict (got %r)' % (retry,))
+
+    unknown = set(retry) - set(DEFAULT_POLICY)
+    if unknown:
+        raise TypeError('unknown retry options %s' % ', '.join(sorted(unknown)))
+
+    policy = dict(DEFAULT_POLICY, **retry)
+    if policy['retry_on'] is not None:
+        policy['retry_on'] = [name if is_str(name) else _type_name(name) for name in policy['retry_on']]
+    return policy
+
+
+def error_info(exc, attempt=0):
+    '''
+    Describe an exception for the `last_error` field of a job
+
+    The names of all of the exception's base classes are kept so that a
+    policy that retries on a class also retries on its subclasses.
+    '''
+    return {'type': _type_name(type(exc)),
+            'types': [_type_name(cls) for cls in type(exc).__mro__],
+            'message': str(exc),
+            'attempt': attempt,
+            }
+
+
+def is_retryable(policy, error):
+    '''
+    Test if a policy retries a failure
+
+    :param error: the job's last_error for this attempt, or None if the job
+        did not record one (it was killed)
+    '''
+    retry_on = policy.get('retry_on')
+    if retry_on is None:
+        return True
+    if error is None:
+        return False
+    return bool(set(error.get('types', ())).intersection(retry_on))
+
+
+def retry_delay(policy, attempt):
+    '''
+    The number of seconds to wait before retrying after `attempt` failed attempts
+    '''
+    delay = min(policy['max_delay'], policy['delay'] * 2 ** (attempt - 1))
+    if policy['jitter']:
+        delay = random.uniform(0, delay)
+    return delay
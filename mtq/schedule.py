@@ -4,21 +4,35 @@ Created on Aug 5, 2013
 @author: sean
 '''
 from dateutil.rrule import rrulestr
+import heapq
 import time
-from datetime import timedelta
 from mtq.utils import now
+from mtq.defaults import _max_aged_priority
 import logging
 
+from mtq import metrics
 from mtq.pymongo3compat import find_and_modify
 
 
 class Scheduler(object):
+    '''
+    Enqueue tasks from rules in the schedule collection
+
+    Parsed rules are cached by _id and modified time, and the main loop is
+    driven by a heap of next fire times so each tick only touches the rules
+    that are due.
+    '''
     
     def __init__(self, factory):
         self.factory = factory
         
         self.logger = logging.getLogger('mtq.Scheduler')
 
+        self._rules = {}
+        self._rrules = {}
+        self._heap = []
+        self._loaded_until = None
+
     
     def add_job(self, rule, task, queue, tags=(), timeout=None):
         collection = self.factory.schedule_collection
@@ -66,37 +80,160 @@ class Scheduler(object):
     def enqueue_from_rule(self, rule):
         queue = self.factory.queue(rule['queue'], tags=rule['tags'])
         queue.enqueue_call(rule['task'], timeout=rule.get('timeout'))
+        metrics.inc('scheduled_jobs', queue=rule['queue'])
+
+    def compile_rule(self, rule):
+        'The parsed rrule of a rule document, cached by _id and modified time'
+        cached = self._rrules.get(rule['_id'])
+        if cached is None or cached[0] != rule['modified']:
+            cached = rule['modified'], rrulestr(rule['rule'], dtstart=rule['created'])
+            self._rrules[rule['_id']] = cached
+        return cached[1]
+
+    def _schedule(self, rule):
+        'Push the next fire time of a rule onto the heap'
+        next_event = self.compile_rule(rule).after(rule['checked'])
+        if next_event is not None:
+            heapq.heappush(self._heap, (next_event, rule['_id'], rule['modified']))
+
+    def _forget(self, _id):
+        self._rules.pop(_id, None)
+        self._rrules.pop(_id, None)
+
+    def reload_rules(self, full=False):
+        '''
+        Load the rules that were modified since the last reload
+
+        :param full: reload every rule, this also notices removed rules
+        '''
+        collection = self.factory.schedule_collection
+        query = {}
+        if full:
+            self._loaded_until = None
+        elif self._loaded_until is not None:
+            query['modified'] = {'$gte': self._loaded_until}
+
+        seen = set()
+        for rule in collection.find(query):
+            seen.add(rule['_id'])
+            if self._loaded_until is None or rule['modified'] > self._loaded_until:
+                self._loaded_until = rule['modified']
+
+            if rule.get('paused') or not rule.get('active', True):
+                self._forget(rule['_id'])
+                continue
+
+            cached = self._rules.get(rule['_id'])
+            if cached is not None and cached['modified'] == rule['modified']:
+                continue
+
+            self._rules[rule['_id']] = rule
+            self._schedule(rule)
+
+        if full:
+            for _id in set(self._rules) - seen:
+                self._forget(_id)
+
+    @property
+    def next_event(self):
+        'The next time a rule is due, or None'
+        while self._heap:
+            next_event, _id, modified = self._heap[0]
+            rule = self._rules.get(_id)
+            if rule is not None and rule['modified'] == modified:
+                return next_event
+            # A stale heap entry for a rule that was modified or removed
+            heapq.heappop(self._heap)
+        return None
+
+    def run_due(self, n=None):
+        '''
+        Enqueue the tasks of the rules that are due at time `n`
+        '''
+        if n is None:
+            n = now()
+
+        while self.next_event is not None and self.next_event <= n:
+            _, _id, _ = heapq.heappop(self._heap)
+            rule = self._rules[_id]
+
+            items = self.compile_rule(rule).between(rule['checked'], n)
+            if len(items) > 1:
+                self.logger.warn("Schedular missed %i tasks! Enqueuing latest" % (len(items)))
+                metrics.inc('scheduled_jobs_missed', len(items) - 1)
+            if items:
+                if self.check_rule(rule, n):
+                    self.logger.info("Enqueueing task %r (%s)" % (rule['task'], items[0].ctime()))
+                    self.enqueue_from_rule(rule)
+                    rule['checked'] = n
+                else:
+                    self.logger.warn("Another schedular has already run this task. moving on")
+                    rule = self.factory.schedule_collection.find_one({'_id': _id})
+                    if rule is None:
+                        self._forget(_id)
+                        continue
+                    self._rules[_id] = rule
+            else:
+                rule['checked'] = n
+
+            self._schedule(rule)
     
-    def run(self):
+    def age_priorities(self, interval, max_priority=_max_aged_priority):
+        '''
+        Age the priority of waiting jobs, see MTQConnection.age_priorities
+        '''
+        aged = self.factory.age_priorities(interval, max_priority)
+        metrics.inc('jobs_aged', aged)
+        if aged:
+            self.logger.info("Raised the priority of %i waiting jobs" % aged)
+
+    def run(self, poll_interval=5, full_reload_interval=60, priority_aging=None,
+            max_aged_priority=_max_aged_priority, reaper=None, reap_interval=60):
+        '''
+        Enqueue tasks until interrupted
+
+        :param priority_aging: if set, raise the priority of jobs that have been
+            waiting for this many seconds (see MTQConnection.age_priorities)
+        :param reaper: if set, a mtq.reaper.Reaper to run every `reap_interval` seconds
+        '''
         self.logger.info('Running Scheduler')
-        poll_interval = 5
         try:
+            self.reload_rules(full=True)
+            last_full_reload = time.time()
+            last_aging = time.time()
+            last_reap = 0
             while 1:
-                
-                next_event = now() + timedelta(1)
-                 
-                for rule in self.rules:
-                    n = now() 
-                    rrule = rrulestr(rule['rule'], dtstart=rule['created'])
-                    items = rrule.between(rule['checked'], n)
-                    if len(items) > 1:
-                        self.logger.warn("Schedular missed %i tasks! Enqueuing latest" % (len(items)))
-                    if items:
-                        if self.check_rule(rule, n):
-                            self.logger.info("Enqueueing task %r (%s)" % (rule['task'], items[0].ctime()))
-                            self.enqueue_from_rule(rule)
-                        else:
-                            self.logger.warn("Another schedular has already run this task. moving on")
-                    
-                    next_event = min(next_event, rrule.after(n))
-                
-                self.logger.debug("Next event %s" % next_event.ctime())
-                next_event = (next_event - now()).total_seconds()
-                self.logger.debug("Next event in %i seconds" % next_event)
-                
-                sleep = max(1, min(next_event, poll_interval)) 
+                self.run_due()
+
+                if priority_aging and time.time() - last_aging >= priority_aging:
+                    last_aging = time.time()
+                    self.age_priorities(priority_aging, max_aged_priority)
+
+                if reaper is not None and time.time() - last_reap >= reap_interval:
+                    last_reap = time.time()
+                    reaped = reaper.reap()
+                    metrics.inc('workers_reaped', reaped['workers'])
+                    metrics.inc('jobs_requeued', reaped['requeued'])
+                    metrics.inc('jobs_lost', reaped['failed'])
+
+                next_event = self.next_event
+                if next_event is None:
+                    sleep = poll_interval
+                else:
+                    self.logger.debug("Next event %s" % next_event.ctime())
+                    sleep = max(1, min((next_event - now()).total_seconds(), poll_interval))
+                if priority_aging:
+                    sleep = max(0, min(sleep, last_aging + priority_aging - time.time()))
+                if reaper is not None:
+                    sleep = max(0, min(sleep, last_reap + reap_interval - time.time()))
+
                 self.logger.debug("Sleping for %i seconds" % sleep)
                 time.sleep(sleep)
+
+                full = time.time() - last_full_reload > full_reload_interval
+                if full:
+                    last_full_reload = time.time()
+                self.reload_rules(full=full)
         
         except KeyboardInterrupt:
             self.logger.exception('Exiting main loop')
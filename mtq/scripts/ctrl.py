@@ -5,8 +5,12 @@ from __future__ import print_function
 from argparse import ArgumentParser
 from mtq.connection import MTQConnection
 from mtq.utils import config_dict, now
+from mtq.defaults import _stale_worker_age
+from mtq.reaper import ON_LOST_POLICIES
+from mtq.profiling import load_profiles, merge_profiles
 from bson import ObjectId
 from time import mktime
+from pymongo.errors import OperationFailure
 import mtq
 
 def working(conn, args):
@@ -62,6 +66,84 @@ def shutdown(conn, args):
     coll.update(query, update, multi=True)
     print('Done')
 
+def reap(conn, args):
+    reaper = conn.reaper(args.max_age, args.on_lost)
+    if args.dry_run:
+        for worker in reaper.stale_workers():
+            jobs = reaper.lost_jobs(worker['_id'])
+            print('Would reap worker %s (%s), last checked in %s, with %i unfinished jobs'
+                  % (worker.get('name'), worker['_id'], worker.get('check-in'), len(jobs)))
+        return
+
+    result = reaper.reap()
+    print('Reaped %(workers)i workers: requeued %(requeued)i jobs, failed %(failed)i jobs' % result)
+
+def profile(conn, args):
+    if args.job_id is None and args.func is None:
+        raise SystemExit('give a job id or --func')
+
+    docs = load_profiles(conn.profile_collection, job_id=args.job_id, func=args.func, limit=args.runs)
+    if not docs:
+        raise SystemExit('No profiles found')
+
+    total = sum(doc['duration'] for doc in docs)
+    print('Merged %i profiles of %s (%.3f seconds in total)'
+          % (len(docs), ', '.join(sorted(set(doc['func'] for doc in docs))), total))
+    stats = merge_profiles(docs)
+    stats.sort_stats(*args.sort).print_stats(args.limit)
+
+def plan_stages(plan):
+    'yield the names of all the stages in an explain plan'
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            for stage in plan_stages(value):
+                yield stage
+    elif isinstance(plan, list):
+        for item in plan:
+            for stage in plan_stages(item):
+                yield stage
+
+def indexes(conn, args):
+    # Don't use conn.queue_collection, it would create the indexes
+    coll = conn.db[conn.queue_collection_name]
+    if args.ensure:
+        conn.ensure_indexes(coll)
+
+    print('Indexes on %s:' % coll.full_name)
+    try:
+        usage = {item['name']: item['accesses'] for item in coll.aggregate([{'$indexStats': {}}], cursor={})}
+    except OperationFailure:
+        usage = {}
+
+    for name, info in sorted(coll.index_information().items()):
+        accesses = usage.get(name)
+        if accesses:
+            ops = '%(ops)i ops since %(since)s' % accesses
+        else:
+            ops = 'usage not available'
+        print(' * %-15s %-60s %s' % (name, info['key'], ops))
+
+    print()
+    print('Query shapes:')
+    missing = 0
+    for name, query, sort in conn.query_shapes():
+        cursor = coll.find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = cursor.explain()
+        stages = set(plan_stages(explain.get('queryPlanner', {}).get('winningPlan', {})))
+        if 'COLLSCAN' in stages or explain.get('cursor') == 'BasicCursor':
+            missing += 1
+            print(' * %-18s MISSING INDEX (collection scan)' % name)
+        else:
+            print(' * %-18s ok' % name)
+
+    if missing:
+        print()
+        print('%i query shapes do not use an index, try `mtq-ctrl indexes --ensure`' % missing)
+
 
 def main():
 
@@ -112,6 +194,38 @@ def main():
     group.add_argument('-i', '--id', type=ObjectId,
                        help='Worker Id')
 
+    rparser = sp.add_parser('reap',
+                            help=('Requeue or fail the jobs of workers that '
+                                  'have stopped checking in'))
+    rparser.add_argument('-m', '--max-age', type=int, default=_stale_worker_age, metavar='SECONDS',
+                         help='A worker is dead if it has not checked in for SECONDS (default: %(default)s)')
+    rparser.add_argument('--on-lost', choices=ON_LOST_POLICIES, default='requeue',
+                         help='What to do with jobs that were enqueued without a policy (default: %(default)s)')
+    rparser.add_argument('-n', '--dry-run', action='store_true',
+                         help='Only list the workers that would be reaped')
+    rparser.set_defaults(main=reap)
+
+    pparser = sp.add_parser('profile',
+                            help=('Print the merged profiles of a job, or of the sampled '
+                                  'runs of a task (see mtq-worker --profile-sample)'))
+    pparser.add_argument('job_id', type=ObjectId, nargs='?',
+                         help='Job Id')
+    pparser.add_argument('-f', '--func',
+                         help='Merge the profiles of all of the jobs of this task')
+    pparser.add_argument('-r', '--runs', type=int, default=100, metavar='N',
+                         help='Merge the latest N profiles (default: %(default)s, 0 for all)')
+    pparser.add_argument('-s', '--sort', nargs='+', default=['cumulative'],
+                         help='pstats sort keys (default: cumulative)')
+    pparser.add_argument('-l', '--limit', type=int, default=30, metavar='N',
+                         help='Print the top N functions (default: %(default)s)')
+    pparser.set_defaults(main=profile)
+
+    iparser = sp.add_parser('indexes',
+                            help='Report index usage and query shapes that do not use an index')
+    iparser.add_argument('-e', '--ensure', action='store_true',
+                         help='Create any missing indexes first')
+    iparser.set_defaults(main=indexes)
+
     args = parser.parse_args()
 
     config = config_dict(args.config)
@@ -4,7 +4,8 @@ Print stats on workers, queues and jobs
 from __future__ import print_function, division
 from argparse import ArgumentParser
 from mtq.connection import MTQConnection
-from mtq.utils import config_dict, wait_times, last_job, now, job_stats
+from mtq.utils import config_dict, wait_times, last_job, now, job_stats, priority_depths, phase_stats
+from mtq.stats import PHASES
 from datetime import timedelta, datetime
 
 def reltime(dt):
@@ -20,15 +21,35 @@ def reltime(dt):
         return '%.1f minutes ago' % minutes
     return '%.1f seconds ago' % s
 
+def seconds(value):
+    return '%.2f seconds' % value if value is not None else 'n/a'
+
 def queue_stats(factory, args):
     print('Queues:')
-    latancy = wait_times(factory)
-    for queue in factory.queues:
-        tags = queue.all_tags
-        print(' * Name: %s' % (queue.name))
+    depths = {}
+    if args.exact:
+        depths = priority_depths(factory)
+        latancy = wait_times(factory)
+        queues = [(queue.name, queue.all_tags, queue.count, latancy.get(queue.name, -1), None)
+                  for queue in factory.queues]
+    else:
+        queues = [(name, sorted(stats['tags']), stats['waiting'], stats['wait'], stats)
+                  for name, stats in sorted(factory.stats.by_queue().items())]
+
+    for name, tags, count, latancy, stats in queues:
+        print(' * Name: %s' % (name))
         print('   Tags: [%s]' % (', '.join(tags)))
-        print('   Count: %i' % queue.count)
-        print('   Latancy: %.2f seconds' % latancy.get(queue.name, -1))
+        print('   Count: %i' % count)
+        print('   Latancy: %s' % seconds(latancy))
+        if stats:
+            print('   Running: %i' % stats['running'])
+            print('   Finished: %i (%i failed)' % (stats['finished'] + stats['failed'], stats['failed']))
+            print('   Duration: %s' % seconds(stats['duration']))
+        bands = stats['waiting_by_priority'] if stats else depths.get(name)
+        if bands:
+            print('   Waiting by priority:')
+            for priority, count in sorted(bands.items(), reverse=True):
+                print('      - %s: %i' % (priority, count))
 
 t = lambda tm:  (tm.ctime(), reltime(tm))
 
@@ -38,6 +59,12 @@ def worker_stats(factory, args):
         print(' * %-10s' % (worker.name))
         print('   + Last Checked In: %s (%s)' % t(worker.last_check_in))
         print('   + Num-Processed: %i' % worker.num_processed)
+        stats = worker.stats
+        if stats:
+            print('   + Running: %i (current job %s)' % (stats.get('running', 0), stats.get('current_job')))
+            print('   + Jobs Done: %i (%i failed)' % (stats.get('jobs_done', 0), stats.get('jobs_failed', 0)))
+            if stats.get('rss'):
+                print('   + RSS: %.1f MB' % (stats['rss'] / 1024. ** 2))
         print('   + Backlog: %i' % worker.num_backlog)
         print('   + Queues:[%s]' % ', '.join(worker.qnames))
         print('   + Tags:[%s]' % ', '.join(worker.tags))
@@ -55,7 +82,36 @@ def worker_stats(factory, args):
         else:
             print('   *** Worker has not processed any jobs')
 
+def print_latency(name, latency):
+    if not latency:
+        return
+    ms = lambda key: '%.1fms' % (latency[key] * 1000) if latency.get(key) is not None else 'n/a'
+    print('   - %s: %i jobs, p50 %s, p95 %s, p99 %s, max %s' % (
+        name, latency['count'], ms('p50'), ms('p95'), ms('p99'), ms('max')))
+
+def print_func_stats(factory, args):
+    # The counters cover all time, with --max-age only the histograms of that window are shown
+    counters = factory.stats.by_func() if args.since is None else {}
+    latency = factory.stats.latency(since=args.since)
+    for func in sorted(set(counters) | set(latency)):
+        print('+', func)
+        stats = counters.get(func)
+        if stats:
+            print('   - queues: [%s]' % ', '.join(sorted(stats['queues'])))
+            print('   - tags: [%s]' % ', '.join(sorted(stats['tags'])))
+            print('   - enqueued: %i' % stats['enqueued'])
+            print('   - waiting: %i' % stats['waiting'])
+            print('   - running: %i' % stats['running'])
+            print('   - count: %i' % (stats['finished'] + stats['failed']))
+            print('   - failed: %i' % stats['failed'])
+            print('   - wait_in_queue: %s' % seconds(stats['wait']))
+            print('   - duration: %s' % seconds(stats['duration']))
+        print_latency('wait_in_queue latency', latency.get(func, {}).get('wait'))
+        print_latency('duration latency', latency.get(func, {}).get('run'))
+
 def print_job_stats(factory, args):
+    if not args.exact:
+        return print_func_stats(factory, args)
 
     stats = job_stats(factory, since=args.since)
     for key, value in stats.items():
@@ -86,6 +142,19 @@ def print_job_stats(factory, args):
             print(' *', job['execute']['func_str'], job['_id'])
 
 
+def print_phase_stats(factory, args):
+    if args.exact or args.since is not None:
+        # The finish phase is only in the counters
+        phases = phase_stats(factory, [phase for phase in PHASES if phase != 'finish'], since=args.since)
+    else:
+        phases = dict((func, stats['phase_avgs']) for func, stats in factory.stats.by_func().items())
+
+    print('Average milliseconds per job in each phase:')
+    print('%-40s %s' % ('', ' '.join('%9s' % phase for phase in PHASES)))
+    for func, avgs in sorted(phases.items()):
+        columns = ['%9.1f' % (avgs[phase] * 1000) if phase in avgs else '%9s' % '-' for phase in PHASES]
+        print('%-40s %s' % (func, ' '.join(columns)))
+
 def max_age(arg):
     if arg.lower().endswith('s'):
         return now() - timedelta(0, int(arg[:-1]))
@@ -120,6 +189,9 @@ def main():
                         help='Maximum age of jobs (e.g. 1d) unit may be one of s (seconds), m (minutes), h (hours) or d (days) ',
                         type=max_age, dest='since', metavar='AGE',
                         default=None)
+    parser.add_argument('--exact', action='store_true',
+                        help='Aggregate over the queue collection instead of reading the counters '
+                             'in the stats collection (slow on a large queue)')
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('-q', '--queues', action='store_const',
                        const=queue_stats, dest='action',
@@ -128,6 +200,8 @@ def main():
                        help='print stats on workers')
     group.add_argument('-j', '--jobs', action='store_const', const=print_job_stats, dest='action',
                        help='print stats on jobs')
+    group.add_argument('-p', '--phases', action='store_const', const=print_phase_stats, dest='action',
+                       help='print where the time of the jobs of each task went')
     group.add_argument('-s', '--storage', '--db', action='store_const', const=print_db_stats, dest='action',
                        help='print stats on database')
 
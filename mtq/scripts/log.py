@@ -5,6 +5,7 @@ Created on Aug 1, 2013
 '''
 from argparse import ArgumentParser
 from mtq.connection import MTQConnection
+from mtq.utils import config_dict
 from bson.objectid import ObjectId
 import sys
 
@@ -13,10 +14,12 @@ import sys
 def main():
     
     parser = ArgumentParser(description=__doc__, version='0.0')
-    group = parser.add_mutually_exclusive_group(required=True)
-    group.add_argument('-j','--job-id', type=ObjectId)
-    group.add_argument('-w','--worker-name')
-    group.add_argument('--worker-id', type=ObjectId)
+    parser.add_argument('-c', '--config', help='Python module containing MTQ settings.')
+    parser.add_argument('-j','--job-id', type=ObjectId, action='append', default=[],
+                        help='Job to tail (may be given more than once)')
+    parser.add_argument('-w','--worker-name', action='append', default=[],
+                        help='Worker to tail (may be given more than once)')
+    parser.add_argument('--worker-id', type=ObjectId, action='append', default=[])
     
     parser.add_argument('-f', '--follow', action='store_true', 
                        help=('Dont stop when end of file is reached, but '
@@ -24,16 +27,26 @@ def main():
                              'appended to the input.'))
     
     args = parser.parse_args()
-    
-    factory = MTQConnection.from_config()
-    
-    if args.job_id:
-        stream = factory.job_stream(args.job_id)
-    elif args.worker_name or  args.worker_id:
-        stream = factory.worker_stream(args.worker_name, args.worker_id)
-        
+
+    if not (args.job_id or args.worker_name or args.worker_id):
+        parser.error('one of the arguments -j/--job-id -w/--worker-name --worker-id is required')
+
+    config = config_dict(args.config)
+    factory = MTQConnection.from_config(config)
+
+    worker_ids = list(args.worker_id)
+    worker_ids.extend(factory.get_worker(worker_name=name).id for name in args.worker_name)
+    follower = factory.log_follower(args.job_id, worker_ids)
+
+    # Prefix lines with their source when tailing more than one
+    prefix = len(follower.sources) > 1
+
     try:
-        for line in stream.loglines(args.follow):
+        for doc in follower.docs(args.follow):
+            line = doc.get('message', '')
+            if prefix:
+                source = doc.get('job_id') or doc.get('worker_id')
+                line = ''.join('[%s] %s\n' % (source, text) for text in line.splitlines())
             sys.stdout.write(line)
     except KeyboardInterrupt:
         pass
@@ -43,4 +56,3 @@ def main():
 if __name__ == '__main__':
     main()
 
-
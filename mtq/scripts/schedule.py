@@ -18,6 +18,10 @@ Schedule a task to be run every hour:
 Run a schedule server **should only ever be one running!**:
     
  mtq-scheduler --serve-forever   
+
+Also raise the priority of jobs that have been waiting for more than 5 minutes:
+
+ mtq-scheduler --serve-forever --priority-aging 300
 '''
 
 from __future__ import print_function
@@ -25,7 +29,9 @@ from argparse import ArgumentParser, RawDescriptionHelpFormatter
 from dateutil.rrule import rrulestr
 from bson.objectid import ObjectId
 from mtq.utils import config_dict
+from mtq.defaults import _max_aged_priority, _stale_worker_age
 import mtq
+from mtq import metrics
 import logging
 from mtq.log import ColorStreamHandler
 
@@ -71,8 +77,28 @@ def main():
     parser.add_argument('--tags', help='tag the job with these tags')
     parser.add_argument('--timeout', type=int, default=None,
                         help='Timeout after N seconds', metavar='N')
+    parser.add_argument('--priority-aging', type=int, default=None, metavar='SECONDS',
+                        help='With --run, raise the priority of jobs that have waited this many seconds '
+                             'so low priority jobs are not starved')
+    parser.add_argument('--reap-interval', type=int, default=None, metavar='SECONDS',
+                        help='With --run, requeue the jobs of dead workers every SECONDS (see mtq-ctrl reap)')
+    parser.add_argument('--reap-after', type=int, default=_stale_worker_age, metavar='SECONDS',
+                        help='A worker is dead if it has not checked in for SECONDS (default: %(default)s)')
+    parser.add_argument('--max-aged-priority', type=int, default=_max_aged_priority, metavar='P',
+                        help='Do not age jobs past this priority (default: %(default)s)')
+    parser.add_argument('--metrics-port', type=int, default=None, metavar='PORT',
+                        help='With --run, serve the counters of the scheduler over HTTP in the '
+                             'Prometheus text format')
+    parser.add_argument('--metrics-host', default='127.0.0.1', metavar='HOST',
+                        help='The address to serve the metrics on, e.g. 0.0.0.0 for every interface '
+                             '(default: %(default)s)')
     args = parser.parse_args()
     
+    if args.run and args.metrics_port is not None:
+        # Before the mongo client is created, listeners only apply to new clients
+        metrics.monitor_mongo()
+        metrics.serve(args.metrics_port, args.metrics_host)
+
     config = config_dict(args.config)
     factory = mtq.from_config(config)
         
@@ -97,7 +123,9 @@ def main():
         queue = factory.queue(args.queue, tags=args.tags)
         queue.enqueue_call(args.now, timeout=args.timeout)
     elif args.run:
-        scheduler.run()
+        reaper = factory.reaper(args.reap_after) if args.reap_interval else None
+        scheduler.run(priority_aging=args.priority_aging, max_aged_priority=args.max_aged_priority,
+                      reaper=reaper, reap_interval=args.reap_interval)
     
         
         
@@ -4,7 +4,10 @@ Starts an MTQ worker.
 from argparse import ArgumentParser
 
 from mtq.connection import MTQConnection
+from mtq.defaults import _heartbeat_interval
+from mtq import metrics
 from mtq.log import ColorStreamHandler
+from mtq.pool import POOLS
 from mtq.utils import config_dict, object_id
 import logging
 import mtq
@@ -23,9 +26,17 @@ def aux(args):
     tags = config.get('TAGS', ()) or args.tags
     queues = config.get('QUEUES', ()) or args.queues
 
+    if args.metrics_port is not None:
+        # Before the mongo client is created, listeners only apply to new clients
+        metrics.monitor_mongo()
+        metrics.serve(args.metrics_port, args.metrics_host)
+
     factory = MTQConnection.from_config(config)
     worker = factory.new_worker(queues=queues, tags=tags, log_worker_output=args.log_output,
-                                poll_interval=args.poll_interval, args=args)
+                                poll_interval=args.poll_interval, args=args,
+                                notify=args.notify, prefetch=args.prefetch,
+                                heartbeat_interval=args.heartbeat_interval,
+                                profile_sample=args.profile_sample)
 
     if args.backlog:
         print(worker.num_backlog)
@@ -47,7 +58,10 @@ def aux(args):
         worker.process_job(job)
         return
 
-    worker.work(one=args.one, batch=args.batch, failed=args.failed)
+    max_rss = args.max_rss * 1024 ** 2 if args.max_rss else None
+    worker.work(one=args.one, batch=args.batch, failed=args.failed,
+                pool=args.pool, concurrency=args.concurrency,
+                max_jobs_per_child=args.max_jobs_per_child, max_rss=max_rss)
 
 
 def main():
@@ -64,9 +78,18 @@ def main():
                             version='Mongo Task Queue (mtq) v%s' % mtq.__version__, add_help=True)
     parser.add_argument('-c', '--config', help='Python module containing MTQ settings.')
 
-    parser.add_argument('queues', nargs='*', default=['default'], help='The queues to listen on (default: %(default)r)')
+    parser.add_argument('queues', nargs='*', default=['default'], help='The queues to listen on (default: %(default)r). '
+                        'Give queues weights as name:weight to share jobs between them in that ratio, '
+                        'e.g. q1:5 q2:1')
     parser.add_argument('-r', '--reloader', action='store_true', help='Reload the worker when it detects a change')
     parser.add_argument('-p', '--poll-interval', help='Sleep interval to check for jobs', default=3, type=int)
+    parser.add_argument('--no-notify', action='store_false', dest='notify',
+                        help=('Poll for jobs every POLL_INTERVAL seconds instead of '
+                              'waiting for enqueue notifications'))
+    parser.add_argument('--prefetch', type=int, default=0, metavar='N',
+                        help='Claim N jobs per round-trip and buffer them in the worker')
+    parser.add_argument('--heartbeat-interval', type=float, default=_heartbeat_interval, metavar='SECONDS',
+                        help='Check in with the database every SECONDS (default: %(default)s)')
     parser.add_argument('-t', '--tags', nargs='*', help='only process jobs which contain all of the tags', default=[])
     parser.add_argument('-l', '--log-output', action='store_true', help='Store job and woker ouput in the db, seealso mtq-tail')
     parser.add_argument('-1', '--one', action='store_true',
@@ -79,6 +102,25 @@ def main():
                         help='Process the job (even if it has already been processed)')
     parser.add_argument('-f', '--failed', action='store_true',
                         help='Process failed jobs')
+    parser.add_argument('--pool', choices=['process'] + sorted(POOLS), default='process',
+                        help=('How to run jobs: "process" forks a new process for every job, '
+                              '"prefork" keeps CONCURRENCY long-lived processes, '
+                              '"threads" runs CONCURRENCY jobs in threads of the worker, '
+                              '"asyncio" runs up to CONCURRENCY coroutine tasks on an event loop (Python 3.7+) '
+                              '(default: %(default)s)'))
+    parser.add_argument('-n', '--concurrency', type=int, default=1, metavar='N',
+                        help='Number of jobs to run at the same time in a pool (default: %(default)s)')
+    parser.add_argument('--max-jobs-per-child', type=int, default=None, metavar='M',
+                        help='Replace a pool process after it has run M jobs')
+    parser.add_argument('--max-rss', type=int, default=None, metavar='MB',
+                        help='Replace a pool process after a job leaves it using more than MB megabytes')
+    parser.add_argument('--profile-sample', type=float, default=None, metavar='FRACTION',
+                        help='Run this fraction of the jobs (e.g. 0.01) under cProfile, see mtq-ctrl profile')
+    parser.add_argument('--metrics-port', type=int, default=None, metavar='PORT',
+                        help='Serve the counters of this worker over HTTP in the Prometheus text format')
+    parser.add_argument('--metrics-host', default='127.0.0.1', metavar='HOST',
+                        help='The address to serve the metrics on, e.g. 0.0.0.0 for every interface '
+                             '(default: %(default)s)')
 
     if add_extra_arguments:
         add_extra_arguments(parser)
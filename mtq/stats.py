@@ -0,0 +1,352 @@
+'''
+Materialized queue statistics
+
+Counting the jobs of a large queue with aggregations is slow and competes
+with the workers, so mtq keeps running counters instead. There is one small
+document per queue and function in the stats collection::
+
+    {'_id': 'default execute.this',
+     'qname': 'default', 'func': 'execute.this', 'tags': ['tag1'],
+     'enqueued': 10,     # jobs enqueued
+     'popped': 8,        # jobs claimed by a worker
+     'requeued': 1,      # claimed jobs that were put back (prefetch, retry, reaped)
+     'cancelled': 0,     # jobs finished before they were started
+     'finished': 5,      # jobs that succeeded
+     'failed': 1,        # jobs that failed
+     'wait_sum': 12.5,   # seconds from enqueue (or process_after) to start, summed over popped jobs
+     'run_sum': 30.2,    # seconds from start to finish, summed over finished and failed jobs
+     'phases': {'import': 0.3, 'run': 27.1, ...},   # seconds summed over the jobs' timings
+     'phase_counts': {'import': 6, 'run': 6, ...},  # the number of jobs timed in each phase
+     'priorities': {'0': 3, '5': 1}}  # the number of waiting jobs at each priority
+
+The `timings` of a job document break the time it took down into PHASES,
+see Job.timings.
+
+The wait and run times are also recorded in histograms, so the tail latency
+can be reported and not only the averages. The latency collection has one
+document per queue, function and period of `_latency_period` seconds::
+
+    {'_id': 'default execute.this 1400000100',
+     'qname': 'default', 'func': 'execute.this', 'period': datetime(...),
+     'wait': {'0': 3, '17': 1},   # number of jobs in each bucket
+     'wait_max': 0.021,
+     'run': {'41': 4},
+     'run_max': 2.9}
+
+The buckets are log-linear: every power of two above `MIN_LATENCY` is split
+into `SUB_BUCKETS` linear buckets, so a percentile is reported to within
+1 / SUB_BUCKETS of its value. Histograms expire after `_latency_retention`
+seconds.
+
+The documents are updated with `$inc` and an unacknowledged write concern,
+so they cost the worker no round-trip but are only approximate: a lost write
+or a job changed by hand is not counted. Use `mtq-info --exact` to run the
+aggregations over the queue collection instead.
+'''
+from __future__ import division
+from datetime import datetime, timedelta
+import math
+import time
+
+import pytz
+
+from mtq.defaults import _latency_period
+
+#: The counters kept for each queue and function
+COUNTERS = ('enqueued', 'popped', 'requeued', 'cancelled', 'finished', 'failed', 'wait_sum', 'run_sum')
+
+#: Durations below this many seconds all go to bucket 0
+MIN_LATENCY = 0.001
+
+#: The number of linear buckets each power of two is split into
+SUB_BUCKETS = 8
+
+#: The phases of a job that are timed, in order
+PHASES = ('wait', 'mutex', 'fork', 'import', 'run', 'log', 'finish')
+
+#: The percentiles reported by QueueStats.latency
+PERCENTILES = (50, 95, 99)
+
+
+def _key(doc):
+    return doc['qname'], doc['execute']['func_str']
+
+
+def elapsed(doc, start, end):
+    '''
+    Seconds between two datetimes of a job document
+
+    The datetimes are used rather than the `<field>_` timestamps, which are
+    rounded to the second. Documents read back without tz_aware are naive UTC.
+    '''
+    if not doc.get(start + '_') or not doc.get(end + '_'):
+        # Not set yet, the job documents are created with 0 timestamps
+        return None
+    start, end = [dt if dt.tzinfo else pytz.utc.localize(dt) for dt in (doc[start], doc[end])]
+    return (end - start).total_seconds()
+
+
+def wait_time(doc):
+    '''
+    Seconds a job waited in the queue, from when it became due to its start
+
+    Delayed and retried jobs become due at their `process_after`, the planned
+    delay is not counted as waiting.
+    '''
+    wait = elapsed(doc, 'enqueued_at', 'started_at')
+    due = doc.get('process_after')
+    if wait is None or due is None:
+        return wait
+    due, started = [dt if dt.tzinfo else pytz.utc.localize(dt) for dt in (due, doc['started_at'])]
+    return max(0, min(wait, (started - due).total_seconds()))
+
+
+def _run(doc):
+    return elapsed(doc, 'started_at', 'finished_at')
+
+
+def _waiting(change):
+    'An `extra` for QueueStats._count, change the waiting count at the priority of a job'
+    return lambda doc: {'priorities.%i' % doc.get('priority', 0): change}
+
+
+def _phases(doc):
+    inc = {}
+    for phase, seconds in (doc.get('timings') or {}).items():
+        inc['phases.%s' % phase] = seconds
+        inc['phase_counts.%s' % phase] = 1
+    return inc
+
+
+def bucket_index(seconds):
+    'The histogram bucket of a duration'
+    if seconds < MIN_LATENCY:
+        return 0
+    exponent = int(math.floor(math.log(seconds / MIN_LATENCY, 2)))
+    fraction = seconds / (MIN_LATENCY * 2 ** exponent) - 1
+    return 1 + exponent * SUB_BUCKETS + min(int(fraction * SUB_BUCKETS), SUB_BUCKETS - 1)
+
+
+def bucket_limit(index):
+    'The upper limit of a histogram bucket in seconds'
+    if index == 0:
+        return MIN_LATENCY
+    exponent, sub = divmod(index - 1, SUB_BUCKETS)
+    return MIN_LATENCY * 2 ** exponent * (1 + (sub + 1) / SUB_BUCKETS)
+
+
+def percentiles(buckets, maximum=None):
+    '''
+    Estimate PERCENTILES from histogram buckets
+
+    :param buckets: a dict of {bucket index: count}
+    :param maximum: the largest value recorded, estimates are capped to it
+    :returns: a dict with the `count` and p50, p95, ...
+    '''
+    total = sum(buckets.values())
+    result = {'count': total, 'max': maximum}
+    cumulative = 0
+    remaining = list(PERCENTILES)
+    for index in sorted(buckets):
+        cumulative += buckets[index]
+        while remaining and cumulative >= total * remaining[0] / 100:
+            value = bucket_limit(index)
+            if maximum is not None:
+                value = min(value, maximum)
+            result['p%s' % remaining.pop(0)] = value
+    return result
+
+
+class QueueStats(object):
+    '''
+    Read and update the counters in the stats collection
+
+    :param collection: the stats collection
+    :param latency_collection: the collection of histograms, None to not record them
+    :param period: the number of seconds each histogram document covers
+    '''
+    def __init__(self, collection, latency_collection=None, period=_latency_period):
+        self.collection = collection
+        self.latency_collection = latency_collection
+        self.period = period
+
+    def _inc(self, increments, tags=None):
+        '''
+        Apply {(qname, func): {counter: value}} increments with one upsert per key
+        '''
+        for (qname, func), inc in increments.items():
+            update = {'$inc': inc, '$setOnInsert': {'qname': qname, 'func': func}}
+            if tags and tags.get((qname, func)):
+                update['$addToSet'] = {'tags': {'$each': sorted(tags[(qname, func)])}}
+            self.collection.update({'_id': '%s %s' % (qname, func)}, update, upsert=True, w=0)
+
+    def _observe(self, name, durations):
+        '''
+        Add [((qname, func), seconds)] durations to the `name` histograms of the current period
+        '''
+        if self.latency_collection is None:
+            return
+        period = int(time.time() // self.period * self.period)
+        updates = {}
+        for key, seconds in durations:
+            update = updates.setdefault(key, {'$inc': {}, '$max': {}})
+            field = '%s.%i' % (name, bucket_index(seconds))
+            update['$inc'][field] = update['$inc'].get(field, 0) + 1
+            update['$max'][name + '_max'] = max(seconds, update['$max'].get(name + '_max', seconds))
+
+        for (qname, func), update in updates.items():
+            update['$setOnInsert'] = {'qname': qname, 'func': func,
+                                      'period': datetime.fromtimestamp(period, pytz.utc)}
+            self.latency_collection.update({'_id': '%s %s %i' % (qname, func, period)}, update,
+                                           upsert=True, w=0)
+
+    def _count(self, docs, counter, name=None, duration=None, extra=None):
+        '''
+        Increment `counter` for each document. The durations are summed in
+        `<name>_sum` and added to the `name` histograms, `extra` returns more
+        {field: value} increments for a document.
+        '''
+        increments = {}
+        durations = []
+        for doc in docs:
+            key = _key(doc)
+            inc = increments.setdefault(key, {})
+            inc[counter] = inc.get(counter, 0) + 1
+            seconds = duration(doc) if duration is not None else None
+            if seconds is not None:
+                inc[name + '_sum'] = inc.get(name + '_sum', 0) + seconds
+                durations.append((key, seconds))
+            if extra is not None:
+                for field, value in extra(doc).items():
+                    inc[field] = inc.get(field, 0) + value
+        self._inc(increments)
+        if durations:
+            self._observe(name, durations)
+
+    def enqueued(self, docs):
+        'Count jobs that were enqueued'
+        increments = {}
+        tags = {}
+        for doc in docs:
+            key = _key(doc)
+            inc = increments.setdefault(key, {})
+            inc['enqueued'] = inc.get('enqueued', 0) + 1
+            field = 'priorities.%i' % doc.get('priority', 0)
+            inc[field] = inc.get(field, 0) + 1
+            tags.setdefault(key, set()).update(doc.get('tags') or ())
+        self._inc(increments, tags)
+
+    def popped(self, docs):
+        'Count jobs that were claimed by a worker and the time they waited'
+        self._count(docs, 'popped', 'wait', wait_time, _waiting(-1))
+
+    def requeued(self, docs):
+        'Count claimed jobs that were put back on the queue'
+        self._count(docs, 'requeued', extra=_waiting(1))
+
+    def aged(self, groups):
+        '''
+        Move waiting jobs up one priority
+
+        :param groups: a list of (qname, func, priority, count), the number of
+            jobs of a queue and function whose priority was incremented
+        '''
+        increments = {}
+        for qname, func, priority, count in groups:
+            inc = increments.setdefault((qname, func), {})
+            for field, change in (('priorities.%i' % priority, -count), ('priorities.%i' % (priority + 1), count)):
+                inc[field] = inc.get(field, 0) + change
+        self._inc(increments)
+
+    def finished(self, docs, failed=False):
+        '''
+        Count jobs that finished, the time they ran and their phase timings
+
+        Jobs that were never started (their `started_at_` is still 0) count
+        as cancelled
+        '''
+        started = [doc for doc in docs if doc.get('started_at_')]
+        cancelled = [doc for doc in docs if doc not in started]
+
+        if started:
+            self._count(started, 'failed' if failed else 'finished', 'run', _run, _phases)
+        if cancelled:
+            self._count(cancelled, 'cancelled', extra=_waiting(-1))
+
+    def _group(self, field, queues=None):
+        result = {}
+        for doc in self.collection.find({'qname': {'$in': list(queues)}} if queues else {}):
+            total = result.setdefault(doc[field], {'tags': set(), 'queues': set(), 'funcs': set(),
+                                                   'phases': {}, 'phase_counts': {}, 'priorities': {}})
+            for counter in COUNTERS:
+                total[counter] = total.get(counter, 0) + doc.get(counter, 0)
+            for sums in ('phases', 'phase_counts', 'priorities'):
+                for phase, value in (doc.get(sums) or {}).items():
+                    total[sums][phase] = total[sums].get(phase, 0) + value
+            total['tags'].update(doc.get('tags') or ())
+            total['queues'].add(doc['qname'])
+            total['funcs'].add(doc['func'])
+        return {name: summarize(total) for name, total in result.items()}
+
+    def by_queue(self, queues=None):
+        'Totals for each queue'
+        return self._group('qname', queues)
+
+    def by_func(self, queues=None):
+        'Totals for each function'
+        return self._group('func', queues)
+
+    def latency(self, since=None, field='func', queues=None):
+        '''
+        Wait and run time percentiles from the histograms
+
+        :param since: only use the histograms of periods that end after this
+            datetime, by default all of the histograms that did not expire
+        :param field: 'func' or 'qname', the field to group by
+        :returns: a dict of {name: {'wait': percentiles, 'run': percentiles}},
+            see `percentiles`
+        '''
+        if self.latency_collection is None:
+            return {}
+
+        query = {}
+        if since is not None:
+            query['period'] = {'$gt': since - timedelta(seconds=self.period)}
+        if queues:
+            query['qname'] = {'$in': list(queues)}
+
+        merged = {}
+        for doc in self.latency_collection.find(query):
+            for name in ('wait', 'run'):
+                if not doc.get(name):
+                    continue
+                hist = merged.setdefault(doc[field], {}).setdefault(name, {'buckets': {}, 'max': None})
+                for index, count in doc[name].items():
+                    hist['buckets'][int(index)] = hist['buckets'].get(int(index), 0) + count
+                if doc.get(name + '_max') is not None:
+                    hist['max'] = max(hist['max'], doc[name + '_max']) if hist['max'] is not None \
+                        else doc[name + '_max']
+
+        return {key: {name: percentiles(hist['buckets'], hist['max']) for name, hist in hists.items()}
+                for key, hists in merged.items()}
+
+
+def summarize(doc):
+    '''
+    Add the `waiting` and `running` job counts, the average `wait` and
+    `duration`, the average seconds spent in each phase (`phase_avgs`) and the
+    waiting jobs at each priority (`waiting_by_priority`) to a counter document
+    '''
+    doc = dict(doc)
+    counts = dict((counter, doc.get(counter, 0)) for counter in COUNTERS)
+    done = counts['finished'] + counts['failed']
+    doc['waiting'] = counts['enqueued'] + counts['requeued'] - counts['popped'] - counts['cancelled']
+    doc['running'] = counts['popped'] - counts['requeued'] - done
+    doc['wait'] = counts['wait_sum'] / counts['popped'] if counts['popped'] else None
+    doc['duration'] = counts['run_sum'] / done if done else None
+    phases, phase_counts = doc.get('phases') or {}, doc.get('phase_counts') or {}
+    doc['phase_avgs'] = dict((phase, phases[phase] / phase_counts[phase])
+                             for phase in phases if phase_counts.get(phase))
+    doc['waiting_by_priority'] = dict((int(priority), count)
+                                      for priority, count in (doc.get('priorities') or {}).items() if count > 0)
+    return doc
@@ -0,0 +1,33 @@
+'''
+Coroutines for the asyncio tests
+
+Only imported on Python 3.7+, this module is a syntax error on older versions.
+'''
+import asyncio
+import logging
+
+log = logging.getLogger('mtq.test')
+
+
+async def coroutine_func(*args, **kwargs):
+    log.info('Running coroutine_func')
+    await asyncio.sleep(0.01)
+    return args, kwargs
+
+
+async def coroutine_func_slow(*args, **kwargs):
+    await asyncio.sleep(10)
+
+
+async def enqueue_each(conn, queue, n):
+    'enqueue n jobs concurrently'
+    jobs = await asyncio.gather(*[queue.enqueue('call-me', i) for i in range(n)])
+    await conn.close()
+    return jobs
+
+
+async def enqueue_many(conn, queue, n):
+    'enqueue n jobs with one call'
+    result = await queue.enqueue_many('call-me', [(i,) for i in range(n)])
+    await conn.close()
+    return result
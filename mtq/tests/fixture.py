@@ -2,6 +2,7 @@ import unittest
 import pymongo
 import mtq
 import logging
+import time
 
 log = logging.getLogger('mtq.test')
 log.setLevel(logging.INFO)
@@ -17,6 +18,19 @@ def test_func_fail(*args, **kwargs):
     raise Exception()
 
 
+def test_func_sleep(*args, **kwargs):
+    log.info('Sleeping in test_func_sleep')
+    time.sleep(0.3)
+    return args, kwargs
+
+
+def test_func_loop(*args, **kwargs):
+    log.info('Running until the job times out')
+    while 1:
+        mtq.check_timeout()
+        time.sleep(0.01)
+
+
 class MTQTestCase(unittest.TestCase):
     connection = None
 
@@ -0,0 +1,82 @@
+from mtq.tests.fixture import MTQTestCase
+import mtq.tests.fixture
+import mock
+import sys
+import unittest
+
+# asyncio support needs contextvars and async def
+HAVE_ASYNCIO = sys.version_info >= (3, 7)
+if HAVE_ASYNCIO:
+    import asyncio
+    from mtq.aio import AsyncMTQConnection
+    from mtq.tests.aio_fixture import coroutine_func, coroutine_func_slow, enqueue_each, enqueue_many
+
+
+@unittest.skipIf(not HAVE_ASYNCIO, 'asyncio support requires Python 3.7+')
+class TestAsyncioPool(MTQTestCase):
+
+    def test_asyncio_pool(self):
+        q = self.factory.queue('q1')
+        for i in range(5):
+            q.enqueue_call(coroutine_func, args=(i,))
+        q.enqueue_call(mtq.tests.fixture.test_func, args=(1,))
+        q.enqueue_call(mtq.tests.fixture.test_func_fail)
+
+        worker = self.factory.new_worker(['q1'], silence=True)
+        worker.work(batch=True, pool='asyncio', concurrency=10)
+
+        self.assertEqual(self.factory.queue_collection.find({'finished': False}).count(), 0)
+        self.assertEqual(q.num_failed, 1)
+        self.assertEqual(self.factory.finished_jobs_collection.find().count(), 6)
+
+        # Each job only captured its own output
+        messages = [doc['message'] for doc in self.factory.logging_collection.find({'job_id': {'$exists': True}})]
+        self.assertEqual(len(messages), 7)
+        self.assertEqual(sum('Running coroutine_func' in message for message in messages), 5)
+        self.assertEqual(sum('Raising a test exception' in message for message in messages), 1)
+
+    def test_asyncio_pool_timeout(self):
+        q = self.factory.queue('q1')
+        q.enqueue_call(coroutine_func_slow, timeout=0.1)
+
+        worker = self.factory.new_worker(['q1'], silence=True)
+        worker.work(batch=True, pool='asyncio', concurrency=10)
+
+        self.assertEqual(q.num_failed, 1)
+
+    def test_apply_coroutine(self):
+        q = self.factory.queue('q1')
+        q.enqueue_call(coroutine_func, args=(1,))
+        job = q.pop()
+        self.assertEqual(job.apply(), ((1,), {}))
+
+
+@unittest.skipIf(not HAVE_ASYNCIO, 'asyncio support requires Python 3.7+')
+class TestAsyncEnqueue(MTQTestCase):
+
+    def test_enqueue_coalesced(self):
+        conn = AsyncMTQConnection(self.factory, window=0.01)
+        queue = conn.queue('q1')
+
+        with mock.patch.object(self.factory, 'insert_jobs', wraps=self.factory.insert_jobs) as insert_jobs:
+            jobs = asyncio.run(enqueue_each(conn, queue, 10))
+
+        self.assertEqual([list(job.args) for job in jobs], [[i] for i in range(10)])
+        self.assertEqual(insert_jobs.call_count, 1)
+        self.assertEqual(self.factory.queue('q1').count, 10)
+
+    def test_enqueue_many_backpressure(self):
+        conn = AsyncMTQConnection(self.factory, window=0, max_batch=3, max_pending=2)
+        queue = conn.queue('q1')
+
+        with mock.patch.object(self.factory, 'insert_jobs', wraps=self.factory.insert_jobs) as insert_jobs:
+            result = asyncio.run(enqueue_many(conn, queue, 10))
+
+        self.assertTrue(result.ok)
+        self.assertEqual(result.inserted, 10)
+        for call in insert_jobs.call_args_list:
+            self.assertLessEqual(len(call[0][0]), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -40,6 +40,62 @@ class TestQueue(MTQTestCase):
         job = q.pop('worker')
         self.assertTrue(job.finished())
 
+    def test_set_finished(self):
+        q = self.factory.queue('my-queue')
+        q.enqueue(mtq.tests.fixture.test_func, 1)
+        job = q.pop('worker')
+        self.assertTrue(job.doc['processed'])
+
+        job.set_finished()
+        job.set_finished()
+
+        self.assertIsNone(self.factory.get_job(job.id))
+        finished = list(self.factory.finished_jobs_collection.find({'_id': job.id}))
+        self.assertEqual(len(finished), 1)
+        self.assertTrue(finished[0]['finished'])
+        self.assertEqual(finished[0]['worker_id'], 'worker')
+
+    def test_set_finished_current_doc(self):
+        q = self.factory.queue('my-queue')
+        q.enqueue(mtq.tests.fixture.test_func, 1)
+        job = q.pop('worker')
+
+        # Written to the queue document after the job was popped
+        self.factory.queue_collection.update({'_id': job.id}, {'$set': {'last_error': {'attempt': 0}}})
+        job.set_finished()
+
+        finished = self.factory.finished_jobs_collection.find_one({'_id': job.id})
+        self.assertEqual(finished['last_error'], {'attempt': 0})
+        self.assertTrue(finished['finished'])
+
+    def test_set_finished_failed(self):
+        q = self.factory.queue('my-queue')
+        q.enqueue(mtq.tests.fixture.test_func, 1)
+        job = q.pop('worker')
+        job.set_finished(failed=True)
+
+        job = self.factory.get_job(job.id)
+        self.assertTrue(job.doc['failed'])
+        self.assertTrue(job.doc['finished'])
+
+    def test_collections_cached(self):
+        q = self.factory.queue('my-queue')
+        q.enqueue(mtq.tests.fixture.test_func, 1)
+        q.pop('worker').set_finished()
+        self.factory.logging_collection
+        warm = self.factory.metadata_commands
+
+        for _ in range(3):
+            q.enqueue(mtq.tests.fixture.test_func, 1)
+            q.pop('worker').set_finished()
+            self.factory.logging_collection
+
+        self.assertEqual(self.factory.metadata_commands, warm)
+
+        self.factory.invalidate_collections()
+        self.factory.finished_jobs_collection
+        self.assertGreater(self.factory.metadata_commands, warm)
+
     def test_call_str(self):
         job = mtq.Job(self.factory, {'execute':{'func_str':'fs', 'args':(), 'kwargs':{}}})
         self.assertEqual(job.call_str, 'fs()')
@@ -0,0 +1,129 @@
+from mtq.tests.fixture import MTQTestCase
+from mtq.log import BufferedWriter, LogFollower, MongoHandler
+from mtq.utils import setup_logging
+import logging
+import threading
+import unittest
+import mock
+
+from bson import ObjectId
+from datetime import datetime
+from pymongo.errors import ConnectionFailure
+
+
+class TestLog(MTQTestCase):
+
+    def test_buffered_writer(self):
+        collection = self.factory.logging_collection
+        writer = BufferedWriter(collection, max_records=3, max_age=60)
+
+        writer.write({'message': '1'})
+        writer.write({'message': '2'})
+        self.assertEqual(collection.find().count(), 0)
+        self.assertEqual(len(writer), 2)
+
+        writer.write({'message': '3'})
+        self.assertEqual(collection.find().count(), 3)
+
+        writer.write({'message': '4'})
+        writer.close()
+        self.assertEqual(collection.find().count(), 4)
+
+    def test_buffered_writer_drop(self):
+        collection = mock.Mock()
+        collection.full_name = 'mtq_testing.mq.log'
+        collection.insert.side_effect = ConnectionFailure('This is expected')
+        writer = BufferedWriter(collection, max_records=2, max_buffer=2)
+
+        with mock.patch('logging.Logger.warning') as warning:
+            for i in range(5):
+                writer.write({'message': str(i)})
+            self.assertEqual(writer.dropped, 3)
+
+            collection.insert.side_effect = None
+            writer.flush()
+            self.assertEqual(warning.call_count, 1)
+
+        self.assertEqual(len(collection.insert.call_args[0][0]), 2)
+
+    def test_buffered_writer_partial_flush(self):
+        collection = self.factory.logging_collection
+        writer = BufferedWriter(collection, max_records=10, max_age=60)
+
+        # The first document was written by a flush that failed part way
+        first = {'_id': ObjectId(), 'message': '1'}
+        writer.write(first)
+        writer.write({'message': '2'})
+        collection.insert(dict(first))
+
+        self.assertTrue(writer.flush())
+        self.assertEqual(len(writer), 0)
+        self.assertEqual(collection.find().count(), 2)
+
+    def test_setup_logging_threads(self):
+        def log_from_thread():
+            logging.getLogger('mtq.test').warning('from a thread')
+
+        collection = self.factory.logging_collection
+        for job_id, thread_filter in (('process', False), ('thread', True)):
+            with setup_logging(collection, job_id, thread_filter=thread_filter):
+                thread = threading.Thread(target=log_from_thread)
+                thread.start()
+                thread.join()
+
+        # Records of threads started by a job are only dropped by the thread pool
+        doc = collection.find_one({'job_id': 'process', 'eof': True})
+        self.assertIn('from a thread', doc['message'])
+        doc = collection.find_one({'job_id': 'thread', 'eof': True})
+        self.assertNotIn('from a thread', doc['message'])
+
+    def test_mongo_handler(self):
+        logger = logging.getLogger('mtq.test.handler')
+        hdlr = MongoHandler(self.factory.logging_collection, {'worker_id': 'abc'})
+        logger.addHandler(hdlr)
+        try:
+            logger.warning('this is buffered')
+            self.assertEqual(self.factory.logging_collection.find().count(), 0)
+            hdlr.flush()
+            self.assertEqual(self.factory.logging_collection.find({'worker_id': 'abc'}).count(), 1)
+        finally:
+            logger.removeHandler(hdlr)
+
+    def test_log_follower(self):
+        collection = self.factory.logging_collection
+        collection.insert({'job_id': 'a', 'message': 'a1\n'})
+        collection.insert({'job_id': 'b', 'message': 'b1\n'})
+        collection.insert({'job_id': 'c', 'message': 'c1\n'})
+        collection.insert({'job_id': 'a', 'message': 'a2\n', 'eof': True})
+        collection.insert({'job_id': 'b', 'message': 'b2\n', 'eof': True})
+
+        follower = self.factory.log_follower(job_ids=['a', 'b'])
+        lines = [doc['message'] for doc in follower.docs(follow=True)]
+        self.assertEqual(lines, ['a1\n', 'b1\n', 'a2\n', 'b2\n'])
+        self.assertEqual(follower.pending, set())
+
+    def test_log_follower_unordered_ids(self):
+        collection = self.factory.logging_collection
+        collection.insert({'job_id': 'a', 'message': 'a1\n'})
+
+        follower = LogFollower(collection, [('job_id', 'a')])
+        docs = follower.docs(follow=True)
+        self.assertEqual(next(docs)['message'], 'a1\n')
+
+        # Another host may generate a lower ObjectId than the last record seen
+        early_id = ObjectId.from_datetime(datetime(2000, 1, 1))
+        collection.insert({'_id': early_id, 'job_id': 'a', 'message': 'a2\n', 'eof': True})
+
+        self.assertEqual([doc['message'] for doc in docs], ['a2\n'])
+        self.assertEqual(follower.pending, set())
+
+    def test_log_follower_finished(self):
+        # Jobs that are not in the queue are finished
+        self.factory.logging_collection.insert({'job_id': 'a', 'message': 'a1\n'})
+        stream = self.factory.log_follower(job_ids=['a'])
+        lines = [doc['message'] for doc in stream.docs(follow=True)]
+        self.assertEqual(lines, ['a1\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+from mtq.tests.fixture import MTQTestCase
+import mtq.tests.fixture
+from mtq import metrics
+import unittest
+
+try:
+    from urllib.request import urlopen
+except ImportError:  # Python 2
+    from urllib2 import urlopen
+
+
+class TestRegistry(unittest.TestCase):
+
+    def test_exposition(self):
+        registry = metrics.Registry()
+        registry.inc('jobs_popped', queue='q1')
+        registry.inc('jobs_popped', 2, queue='q1')
+        registry.observe('pop_seconds', 0.5)
+        registry.observe('pop_seconds', 1.5)
+        registry.gauge('answer', lambda: 42)
+
+        text = registry.exposition()
+        self.assertIn('# TYPE mtq_jobs_popped_total counter\nmtq_jobs_popped_total{queue="q1"} 3\n', text)
+        self.assertIn('mtq_pop_seconds_count 2\nmtq_pop_seconds_sum 2.0\nmtq_pop_seconds_max 1.5\n', text)
+        self.assertIn('mtq_answer 42\n', text)
+
+    def test_serve(self):
+        registry = metrics.Registry()
+        registry.inc('pops')
+        server = metrics.serve(0, host='127.0.0.1', registry=registry)
+        try:
+            response = urlopen('http://127.0.0.1:%i/metrics' % server.server_address[1])
+            self.assertIn(b'mtq_pops_total 1', response.read())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestWorkerMetrics(MTQTestCase):
+
+    def setUp(self):
+        MTQTestCase.setUp(self)
+        metrics.registry.clear()
+
+    def test_worker_counters(self):
+        q = self.factory.queue('q1')
+        q.enqueue_call(mtq.tests.fixture.test_func)
+        q.enqueue_call(mtq.tests.fixture.test_func_fail)
+
+        worker = self.factory.new_worker(['q1'], silence=True)
+        worker.work(batch=True, pool='threads')
+
+        self.assertEqual(metrics.registry.get('jobs_popped', queue='q1'), 2)
+        self.assertEqual(metrics.registry.get('jobs_succeeded', queue='q1'), 1)
+        self.assertEqual(metrics.registry.get('jobs_failed', queue='q1'), 1)
+        self.assertEqual(metrics.registry.get('pops_empty'), 1)
+        self.assertEqual(metrics.registry.summary('pop_seconds')[0], 3)
+        self.assertIn('mtq_empty_pop_ratio', metrics.registry.exposition())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+from mtq.tests.fixture import MTQTestCase
+import mtq.tests.fixture
+from mtq.profiling import load_profiles, merge_profiles, profile_apply, should_profile
+import logging
+import mock
+import unittest
+
+from pymongo.errors import ConnectionFailure
+
+
+class TestProfiling(MTQTestCase):
+
+    def test_profile_job(self):
+        q = self.factory.queue('q1')
+        job = q.enqueue_call(mtq.tests.fixture.test_func, args=(1,), profile=True)
+        q.enqueue_call(mtq.tests.fixture.test_func, args=(2,))
+
+        worker = self.factory.new_worker(['q1'], silence=True)
+        worker.work(batch=True, pool='threads')
+
+        docs = load_profiles(self.factory.profile_collection, job_id=job.id)
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0]['func'], 'mtq.tests.fixture.test_func')
+
+        stats = merge_profiles(docs)
+        self.assertIn('test_func', [name for _, _, name in stats.stats])
+
+    def test_profile_sample(self):
+        q = self.factory.queue('q1')
+        for i in range(3):
+            q.enqueue_call(mtq.tests.fixture.test_func_fail, args=(i,))
+
+        worker = self.factory.new_worker(['q1'], silence=True, profile_sample=1.0)
+        worker.work(batch=True, pool='threads')
+
+        # Failed jobs are profiled too
+        docs = load_profiles(self.factory.profile_collection, func='mtq.tests.fixture.test_func_fail')
+        self.assertEqual(len(docs), 3)
+        merged = merge_profiles(docs)
+        func = [key for key in merged.stats if key[2] == 'test_func_fail'][0]
+        self.assertEqual(merged.stats[func][1], 3)
+
+    def test_profile_save_error(self):
+        job = self.factory.queue('q1').enqueue_call(mtq.tests.fixture.test_func, args=(1,))
+        collection = mock.Mock()
+        collection.insert.side_effect = ConnectionFailure('This is expected')
+
+        # The job still returns its result
+        with mock.patch.object(logging.getLogger('mq.Worker'), 'exception') as exception:
+            self.assertEqual(profile_apply(job, collection), ((1,), {}))
+        self.assertEqual(exception.call_count, 1)
+
+    def test_profile_enable_error(self):
+        job = self.factory.queue('q1').enqueue_call(mtq.tests.fixture.test_func, args=(1,))
+        collection = mock.Mock()
+
+        # Another thread is already profiling
+        with mock.patch('cProfile.Profile.enable', side_effect=ValueError('This is expected')):
+            self.assertEqual(profile_apply(job, collection), ((1,), {}))
+        self.assertFalse(collection.insert.called)
+
+    def test_should_profile(self):
+        job = self.factory.queue('q1').enqueue_call('not-profiled')
+        self.assertFalse(should_profile(job, None))
+        self.assertFalse(should_profile(job, 0))
+        self.assertTrue(should_profile(job, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,7 @@ Created on Aug 4, 2013
 from mtq.tests.fixture import MTQTestCase
 import mtq.tests.fixture
 from mtq.utils import now
+from datetime import timedelta
 import unittest
 from mtq.queue import QueueError
 
@@ -48,6 +49,58 @@ class TestQueue(MTQTestCase):
         with self.assertRaises(TypeError):
             q.enqueue_call('fine', kwargs='str')
 
+    def test_enqueue_many(self):
+        q = self.factory.queue('my-queue', ['tags'])
+        result = q.enqueue_many(mtq.tests.fixture.test_func, ((i,) for i in range(5)),
+                                kwargs={'a': 1}, chunk_size=2)
+
+        self.assertTrue(result.ok)
+        self.assertEqual(result.inserted, 5)
+        self.assertEqual(q.count, 5)
+        self.assertEqual(sorted(job.args[0] for job in q.jobs), [0, 1, 2, 3, 4])
+        self.assertEqual(q.jobs[0].kwargs, {'a': 1})
+        self.assertEqual(sorted(result.job_ids), sorted(job.id for job in q.jobs))
+
+    def test_enqueue_many_options(self):
+        q = self.factory.queue('my-queue')
+        later = now() + timedelta(minutes=5)
+        result = q.enqueue_many('call-me', [(1,), (2,)], on_lost='fail', retry={'max_attempts': 3},
+                                process_after=later, profile=True)
+
+        self.assertEqual(result.inserted, 2)
+        self.assertEqual(q.count, 0)
+        for job_id in result.job_ids:
+            doc = self.factory.get_job(job_id).doc
+            self.assertEqual(doc['on_lost'], 'fail')
+            self.assertEqual(doc['retry']['max_attempts'], 3)
+            self.assertTrue(doc['profile'])
+
+    def test_enqueue_many_partial_failure(self):
+        q = self.factory.queue('my-queue')
+        job = q.enqueue_call('call-me')
+
+        docs = [q.make_job_doc('call-me', (i,)) for i in range(3)]
+        docs[1]['_id'] = job.id
+        result = self.factory.insert_jobs(docs, chunk_size=2)
+
+        self.assertFalse(result.ok)
+        self.assertEqual(result.inserted, 2)
+        self.assertEqual([(e['chunk'], e['index']) for e in result.errors], [(0, 1)])
+        self.assertEqual(q.count, 3)
+
+    def test_connection_enqueue_many(self):
+        result = self.factory.enqueue_many([('q1', 'call-me', (1,)),
+                                            ('q2', 'call-me', (2,), {'a': 1})])
+        self.assertEqual(result.inserted, 2)
+        self.assertEqual(self.factory.queue('q1').count, 1)
+        self.assertEqual(self.factory.queue('q2').jobs[0].kwargs, {'a': 1})
+
+    def test_indexes(self):
+        self.factory.ensure_indexes()
+        info = self.factory.queue_collection.index_information()
+        for name, _ in mtq.connection.QUEUE_INDEXES:
+            self.assertIn(name, info)
+
     def test_enqueue(self):
         'Creating queues.'
         q = self.factory.queue('my-queue', ['tags'])
@@ -97,6 +150,78 @@ class TestQueue(MTQTestCase):
         job = q.pop('worker')
         self.assertIsNone(job)
 
+    def test_pop_priority(self):
+        q = self.factory.queue('my-queue')
+        q.enqueue_call('low1')
+        q.enqueue_call('high', priority=5)
+        q.enqueue_call('low2')
+
+        self.assertEqual(q.pop().func_name, 'high')
+        self.assertEqual(q.pop().func_name, 'low1')
+        self.assertEqual(q.pop().func_name, 'low2')
+
+    def test_age_priorities(self):
+        q = self.factory.queue('my-queue')
+        q.enqueue_call('old')
+        q.enqueue_call('new')
+        q.enqueue_in(timedelta(days=1), 'delayed')
+        old = now() - timedelta(minutes=10)
+        self.factory.queue_collection.update({'execute.func_str': {'$in': ['old', 'delayed']}},
+                                             {'$set': {'enqueued_at': old}}, multi=True)
+        self.factory.queue_collection.update({'execute.func_str': 'old'},
+                                             {'$set': {'process_after': old}})
+
+        # Jobs age from when they became due, not from when they were enqueued
+        self.assertEqual(self.factory.age_priorities(60, max_priority=10), 1)
+        # Aged jobs wait another interval before they are aged again
+        self.assertEqual(self.factory.age_priorities(60, max_priority=10), 0)
+
+        self.assertEqual(q.pop().func_name, 'old')
+
+    def test_enqueue_in(self):
+        q = self.factory.queue('my-queue')
+        q.enqueue_in(timedelta(minutes=5), 'later')
+        q.enqueue_at(now() - timedelta(seconds=1), 'now')
+
+        self.assertEqual(q.count, 1)
+        # Jobs that are already due are not reported, they may be blocked on a mutex
+        due = self.factory.next_due(['my-queue'], None)
+        self.assertAlmostEqual((due - now()).total_seconds(), 5 * 60, delta=5)
+
+        self.assertEqual(q.pop().func_name, 'now')
+        self.assertIsNone(q.pop())
+
+        due = self.factory.next_due(['my-queue'], None)
+        self.assertAlmostEqual((due - now()).total_seconds(), 5 * 60, delta=5)
+        self.assertIsNone(self.factory.next_due(['other-queue'], None))
+
+    def test_pop_items(self):
+        q = self.factory.queue('my-queue')
+        for i in range(5):
+            q.enqueue_call('call-me%i' % i, mutex={'key': 'key1', 'count': 2} if i < 3 else None)
+
+        jobs = self.factory.pop_items('worker', ['my-queue'], None, 4)
+        self.assertEqual([job.func_name for job in jobs], ['call-me0', 'call-me1', 'call-me3'])
+        self.assertEqual(q.count, 2)
+
+        jobs = self.factory.pop_items('worker', ['my-queue'], None, 4)
+        self.assertEqual([job.func_name for job in jobs], ['call-me4'])
+
+    def test_pop_failed(self):
+        q = self.factory.queue('my-queue')
+        q.enqueue_call('running')
+        q.enqueue_call('failed')
+        running = q.pop('worker')
+        failed = q.pop('worker')
+        failed.set_finished(failed=True)
+
+        # Jobs that are still running are not popped as failed jobs
+        job = self.factory.pop_item('worker', ['my-queue'], None, failed=True)
+        self.assertEqual(job.func_name, 'failed')
+
+        jobs = self.factory.pop_items('worker', ['my-queue'], None, 5, failed=True)
+        self.assertEqual([job.func_name for job in jobs], ['failed'])
+
     def test_mutex1(self):
         q = self.factory.queue('my-queue')
         q.enqueue_call('call-me1', mutex={'key': 'key1', 'count': 1})
@@ -136,6 +261,19 @@ class TestQueue(MTQTestCase):
         self.assertIsNotNone(job3)
         self.assertIsNone(job4)
 
+    def test_mutex_lease_expired(self):
+        q = self.factory.queue('my-queue')
+        q.enqueue_call('call-me1', mutex={'key': 'key1', 'count': 1})
+        q.enqueue_call('call-me2', mutex={'key': 'key1', 'count': 1})
+
+        self.assertIsNotNone(q.pop('worker'))
+        self.assertIsNone(q.pop('worker'))
+
+        # The worker running the first job died and its lease ran out
+        self.factory.mutex_collection.update({'_id': 'key1'},
+                                             {'$set': {'holders.0.expires': now() - timedelta(seconds=1)}})
+        self.assertIsNotNone(q.pop('worker'))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,54 @@
+from mtq.tests.fixture import MTQTestCase
+from mtq.utils import now
+from datetime import timedelta
+import unittest
+
+
+class TestReaper(MTQTestCase):
+
+    def dead_worker(self, jobs):
+        worker = self.factory.new_worker(['q1'])
+        with worker.register():
+            popped = [worker.pop_item() for _ in range(jobs)]
+        # The worker died without finishing its jobs
+        self.factory.worker_collection.update({'_id': worker.worker_id},
+                                              {'$set': {'working': True,
+                                                        'check-in': now() - timedelta(hours=1)}})
+        return worker, popped
+
+    def test_reap(self):
+        q = self.factory.queue('q1')
+        q.enqueue_call('requeue-me', mutex={'key': 'key1'})
+        q.enqueue_call('fail-me', on_lost='fail')
+        q.enqueue_call('not-started')
+
+        worker, _ = self.dead_worker(2)
+        self.assertEqual(q.count, 1)
+
+        result = self.factory.reaper(max_age=60).reap()
+        self.assertEqual(result, {'workers': 1, 'requeued': 1, 'failed': 1})
+
+        self.assertEqual(sorted(job.func_name for job in q.jobs), ['not-started', 'requeue-me'])
+        self.assertEqual(q.num_failed, 1)
+        self.assertEqual(self.factory.mutex_collection.find_one({'_id': 'key1'})['holders'], [])
+
+        doc = self.factory.worker_collection.find_one({'_id': worker.worker_id})
+        self.assertFalse(doc['working'])
+        self.assertTrue(doc['terminate'])
+
+        # Nothing left to reap
+        self.assertEqual(self.factory.reaper(max_age=60).reap()['workers'], 0)
+
+    def test_live_worker(self):
+        q = self.factory.queue('q1')
+        q.enqueue_call('running')
+        worker, _ = self.dead_worker(1)
+        self.factory.worker_collection.update({'_id': worker.worker_id},
+                                              {'$set': {'check-in': now()}})
+
+        self.assertEqual(self.factory.reaper(max_age=60).reap()['workers'], 0)
+        self.assertEqual(q.count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
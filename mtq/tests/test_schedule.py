@@ -0,0 +1,51 @@
+from mtq.tests.fixture import MTQTestCase
+from datetime import datetime, timedelta
+import time
+import unittest
+
+
+class TestScheduler(MTQTestCase):
+
+    def add_rule(self, rule, checked):
+        scheduler = self.factory.scheduler()
+        _id = scheduler.add_job(rule, 'mtq.tests.fixture.test_func', 'sched')
+        self.factory.schedule_collection.update({'_id': _id},
+                                                {'$set': {'created': checked, 'checked': checked}})
+        return scheduler, _id
+
+    def test_run_due(self):
+        n = datetime.utcnow().replace(microsecond=0)
+        scheduler, _ = self.add_rule('FREQ=MINUTELY', n - timedelta(minutes=3, seconds=30))
+        scheduler.reload_rules(full=True)
+
+        scheduler.run_due(n)
+        self.assertEqual(self.factory.queue('sched').count, 1)
+        self.assertEqual(scheduler.next_event, n + timedelta(seconds=30))
+
+        # Nothing is due until the next event
+        scheduler.run_due(n + timedelta(seconds=10))
+        self.assertEqual(self.factory.queue('sched').count, 1)
+
+    def test_reload_rules(self):
+        n = datetime.utcnow().replace(microsecond=0)
+        scheduler, _id = self.add_rule('FREQ=HOURLY', n)
+        scheduler.reload_rules(full=True)
+        self.assertEqual(scheduler.next_event, n + timedelta(hours=1))
+        rrule = scheduler.compile_rule(scheduler._rules[_id])
+
+        # Unchanged rules are not parsed again
+        scheduler.reload_rules()
+        self.assertIs(scheduler.compile_rule(scheduler._rules[_id]), rrule)
+
+        time.sleep(0.01)
+        scheduler.update_job(_id, rule='FREQ=MINUTELY')
+        scheduler.reload_rules()
+        self.assertEqual(scheduler.next_event, n + timedelta(minutes=1))
+
+        scheduler.remove_job(_id)
+        scheduler.reload_rules(full=True)
+        self.assertIsNone(scheduler.next_event)
+
+
+if __name__ == '__main__':
+    unittest.main()
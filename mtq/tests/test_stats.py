@@ -0,0 +1,137 @@
+from mtq.tests.fixture import MTQTestCase
+import mtq.tests.fixture
+from mtq.stats import bucket_index, bucket_limit, percentiles, SUB_BUCKETS, PHASES
+from mtq.utils import now, phase_stats
+from datetime import timedelta
+import unittest
+
+
+class TestStats(MTQTestCase):
+
+    def test_counters(self):
+        q = self.factory.queue('q1', tags=['tag1'])
+        q.enqueue_call(mtq.tests.fixture.test_func, args=(1,))
+        q.enqueue_call(mtq.tests.fixture.test_func_fail)
+        q.enqueue_many(mtq.tests.fixture.test_func, [(i,) for i in range(3)])
+        q.enqueue_call('cancel-me').cancel()
+
+        stats = self.factory.stats.by_queue()['q1']
+        self.assertEqual(stats['enqueued'], 6)
+        self.assertEqual(stats['waiting'], 5)
+        self.assertEqual(stats['tags'], set(['tag1']))
+
+        worker = self.factory.new_worker(['q1'], silence=True)
+        worker.work(batch=True, pool='threads')
+
+        stats = self.factory.stats.by_queue()['q1']
+        self.assertEqual(stats['waiting'], 0)
+        self.assertEqual(stats['running'], 0)
+        self.assertEqual(stats['finished'], 4)
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(stats['cancelled'], 1)
+        self.assertGreaterEqual(stats['wait'], 0)
+        self.assertGreaterEqual(stats['duration'], 0)
+
+        funcs = self.factory.stats.by_func()
+        self.assertEqual(funcs['mtq.tests.fixture.test_func']['finished'], 4)
+        self.assertEqual(funcs['mtq.tests.fixture.test_func_fail']['failed'], 1)
+
+    def test_waiting_by_priority(self):
+        q = self.factory.queue('q1')
+        q.enqueue_call('low1')
+        q.enqueue_call('low2')
+        q.enqueue_call('high', priority=5)
+        self.assertEqual(self.factory.stats.by_queue()['q1']['waiting_by_priority'], {0: 2, 5: 1})
+
+        q.pop()
+        self.factory.queue_collection.update({'execute.func_str': 'low1'},
+                                             {'$set': {'process_after': now() - timedelta(minutes=10)}})
+        self.factory.age_priorities(60, max_priority=10)
+        self.assertEqual(self.factory.stats.by_queue()['q1']['waiting_by_priority'], {0: 1, 1: 1})
+
+    def test_wait_delayed_job(self):
+        q = self.factory.queue('q1')
+        q.enqueue_in(60, mtq.tests.fixture.test_func)
+        # The job was enqueued 10 minutes ago and became due just now
+        self.factory.queue_collection.update({}, {'$set': {'enqueued_at': now() - timedelta(minutes=10),
+                                                           'process_after': now()}})
+
+        worker = self.factory.new_worker(['q1'], silence=True)
+        worker.work(batch=True, pool='threads')
+
+        # The planned delay is not counted as waiting
+        stats = self.factory.stats.by_queue()['q1']
+        self.assertLess(stats['wait'], 60)
+        doc = self.factory.finished_jobs_collection.find_one()
+        self.assertLess(doc['timings']['wait'], 60)
+
+    def test_retry_counts_requeued(self):
+        q = self.factory.queue('q1', retry={'max_attempts': 2, 'delay': 0, 'jitter': False})
+        q.enqueue_call(mtq.tests.fixture.test_func_fail)
+
+        worker = self.factory.new_worker(['q1'], silence=True)
+        worker.work(batch=True, pool='threads')
+
+        stats = self.factory.stats.by_queue()['q1']
+        self.assertEqual(stats['popped'], 2)
+        self.assertEqual(stats['requeued'], 1)
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(stats['waiting'], 0)
+        self.assertEqual(stats['running'], 0)
+
+    def test_latency(self):
+        q = self.factory.queue('q1')
+        for i in range(10):
+            q.enqueue_call(mtq.tests.fixture.test_func, args=(i,))
+
+        worker = self.factory.new_worker(['q1'], silence=True)
+        worker.work(batch=True, pool='threads')
+
+        latency = self.factory.stats.latency(since=now() - timedelta(minutes=1))
+        run = latency['mtq.tests.fixture.test_func']['run']
+        self.assertEqual(run['count'], 10)
+        self.assertLessEqual(run['p50'], run['p99'])
+        self.assertLessEqual(run['p99'], run['max'])
+
+        self.assertEqual(self.factory.stats.latency(since=now() + timedelta(hours=1)), {})
+
+    def test_phase_timings(self):
+        q = self.factory.queue('q1')
+        q.enqueue_call(mtq.tests.fixture.test_func, mutex={'key': 'key1'})
+
+        worker = self.factory.new_worker(['q1'], silence=True)
+        worker.work(batch=True, pool='threads')
+
+        doc = self.factory.finished_jobs_collection.find_one()
+        self.assertEqual(sorted(doc['timings']), ['import', 'log', 'mutex', 'run', 'wait'])
+
+        phases = self.factory.stats.by_func()['mtq.tests.fixture.test_func']['phase_avgs']
+        self.assertEqual(sorted(phases), ['finish', 'import', 'log', 'mutex', 'run', 'wait'])
+
+        exact = phase_stats(self.factory, PHASES)['mtq.tests.fixture.test_func']
+        self.assertEqual(sorted(exact), sorted(doc['timings']))
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_buckets(self):
+        for seconds in (0.0015, 0.1, 2.9, 60):
+            index = bucket_index(seconds)
+            self.assertTrue(bucket_limit(index - 1) <= seconds < bucket_limit(index))
+        self.assertEqual(bucket_index(0), 0)
+
+    def test_percentiles(self):
+        buckets = {}
+        for i in range(1, 101):
+            index = bucket_index(i / 100.)
+            buckets[index] = buckets.get(index, 0) + 1
+
+        result = percentiles(buckets, maximum=1.0)
+        self.assertEqual(result['count'], 100)
+        self.assertAlmostEqual(result['p50'], 0.5, delta=0.5 / SUB_BUCKETS)
+        self.assertAlmostEqual(result['p95'], 0.95, delta=0.95 / SUB_BUCKETS)
+        self.assertEqual(result['p99'], 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
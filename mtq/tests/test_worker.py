@@ -6,9 +6,17 @@ Created on Aug 5, 2013
 
 from mtq.tests.fixture import MTQTestCase
 import mtq
+import mtq.tests.fixture
 import unittest
 import mock
-
+import sys
+import time
+import mtq.errors
+from mtq.pool import ThreadPool
+from mtq.utils import now
+
+from bson import ObjectId
+from datetime import datetime
 from pymongo.errors import ConnectionFailure
 
 
@@ -143,6 +151,221 @@ class TestWorker(MTQTestCase):
         self.assertTrue(failed)
 
 
+    def test_prefork_pool(self):
+        q = self.factory.queue('q1')
+        q.enqueue_call(mtq.tests.fixture.test_func, args=(1,))
+        q.enqueue_call(mtq.tests.fixture.test_func_fail)
+        q.enqueue_call(mtq.tests.fixture.test_func, args=(2,))
+
+        worker = self.factory.new_worker(['q1'], silence=True)
+        worker.work(batch=True, pool='prefork', concurrency=2, max_jobs_per_child=1)
+
+        self.assertEqual(self.factory.queue_collection.find({'finished': False}).count(), 0)
+        self.assertEqual(q.num_failed, 1)
+        self.assertEqual(self.factory.finished_jobs_collection.find().count(), 2)
+
+    def test_thread_pool(self):
+        q = self.factory.queue('q1')
+        q.enqueue_call(mtq.tests.fixture.test_func, args=(1,))
+        q.enqueue_call(mtq.tests.fixture.test_func_fail)
+        q.enqueue_call(mtq.tests.fixture.test_func, args=(2,))
+
+        worker = self.factory.new_worker(['q1'], silence=True)
+        worker.work(batch=True, pool='threads', concurrency=2)
+
+        self.assertEqual(self.factory.queue_collection.find({'finished': False}).count(), 0)
+        self.assertEqual(q.num_failed, 1)
+        self.assertEqual(self.factory.finished_jobs_collection.find().count(), 2)
+
+        # Each job only captured its own output
+        messages = [doc['message'] for doc in self.factory.logging_collection.find({'job_id': {'$exists': True}})]
+        self.assertEqual(len(messages), 3)
+        self.assertEqual(sum('Raising a test exception' in message for message in messages), 1)
+
+    def test_thread_pool_timeout(self):
+        q = self.factory.queue('q1')
+        q.enqueue_call(mtq.tests.fixture.test_func_loop, timeout=0.2)
+
+        worker = self.factory.new_worker(['q1'], silence=True)
+        worker.work(batch=True, pool='threads', concurrency=2)
+
+        self.assertEqual(q.num_failed, 1)
+
+    def test_retry(self):
+        q = self.factory.queue('q1', retry={'max_attempts': 3, 'delay': 0, 'jitter': False})
+        q.enqueue_call(mtq.tests.fixture.test_func_fail)
+
+        worker = self.factory.new_worker(['q1'], silence=True)
+        worker.work(batch=True, pool='threads')
+
+        doc = self.factory.queue_collection.find_one()
+        self.assertEqual(doc['attempts'], 2)
+        self.assertTrue(doc['failed'])
+        self.assertEqual(doc['last_error']['type'], 'builtins.Exception' if sys.version_info[0] > 2
+                         else 'exceptions.Exception')
+
+    def test_retry_on(self):
+        q = self.factory.queue('q1')
+        q.enqueue_call(mtq.tests.fixture.test_func_fail, retry={'retry_on': [mtq.errors.Timeout]})
+        q.enqueue_call(mtq.tests.fixture.test_func_loop, timeout=0.1,
+                       retry={'max_attempts': 2, 'retry_on': [mtq.errors.Timeout], 'delay': 0})
+
+        worker = self.factory.new_worker(['q1'], silence=True)
+        worker.work(batch=True, pool='threads')
+
+        attempts = {doc['execute']['func_str']: doc['attempts'] for doc in self.factory.queue_collection.find()}
+        self.assertEqual(attempts, {'mtq.tests.fixture.test_func_fail': 0,
+                                    'mtq.tests.fixture.test_func_loop': 1})
+
+    def test_wait_for_delayed_job(self):
+        q = self.factory.queue('q1')
+        q.enqueue_in(2, 'test')
+
+        worker = self.factory.new_worker(['q1'])
+        notifier = mock.Mock()
+        with mock.patch.object(self.factory, 'notifier', return_value=notifier):
+            worker.wait_for_job()
+
+        # The worker sleeps until the job is due instead of max_idle seconds
+        timeout = notifier.wait.call_args[0][0]
+        self.assertLessEqual(timeout, 2)
+        self.assertGreater(timeout, 1)
+
+    def test_prefetch(self):
+        q = self.factory.queue('q1')
+        for i in range(3):
+            q.enqueue_call('test%i' % i)
+
+        worker = self.factory.new_worker(['q1'], prefetch=2)
+        with worker.register():
+            job = worker.pop_item()
+            self.assertEqual(job.func_name, 'test0')
+            self.assertEqual(q.count, 1)
+
+        # The prefetched job that was not started is back on the queue
+        self.assertEqual(sorted(job.func_name for job in q.jobs), ['test1', 'test2'])
+
+    def test_weighted_queues(self):
+        for qname in ['q1', 'q2']:
+            q = self.factory.queue(qname)
+            for i in range(10):
+                q.enqueue_call('test')
+
+        worker = self.factory.new_worker(['q1:3', 'q2'])
+        self.assertEqual(worker.queues, ['q1', 'q2'])
+        with worker.register():
+            for i in range(8):
+                worker.pop_item()
+
+        self.assertEqual(worker.dispatch_counts, {'q1': 6, 'q2': 2})
+
+    def test_weighted_queues_prefetch(self):
+        for qname in ['q1', 'q2']:
+            q = self.factory.queue(qname)
+            for i in range(20):
+                q.enqueue_call('test')
+
+        # Batches are claimed in proportion to the weights too
+        worker = self.factory.new_worker(['q1:5', 'q2'], prefetch=10)
+        with worker.register():
+            for i in range(12):
+                worker.pop_item()
+
+        self.assertEqual(worker.dispatch_counts, {'q1': 10, 'q2': 2})
+
+    def test_weighted_queues_fractional(self):
+        for qname in ['q1', 'q2']:
+            q = self.factory.queue(qname)
+            for i in range(10):
+                q.enqueue_call('test')
+
+        worker = self.factory.new_worker(['q1:0.5', 'q2'])
+        with worker.register():
+            for i in range(6):
+                worker.pop_item()
+
+        self.assertEqual(worker.dispatch_counts, {'q1': 2, 'q2': 4})
+
+    def test_weighted_queues_empty(self):
+        q = self.factory.queue('q2')
+        for i in range(3):
+            q.enqueue_call('test')
+
+        worker = self.factory.new_worker(['q1:3', 'q2'])
+        with worker.register():
+            for i in range(4):
+                worker.pop_item()
+
+        # An empty queue does not stop the worker from popping the others
+        self.assertEqual(worker.dispatch_counts, {'q2': 3})
+
+    def test_weighted_queues_colon_name(self):
+        worker = self.factory.new_worker(['project:tasks', 'project:build:2', 'q1:0'])
+        self.assertEqual(worker.queues, ['project:tasks', 'project:build', 'q1:0'])
+        self.assertEqual(worker.weights, {'project:build': 2})
+
+    def test_terminate_pool(self):
+        q = self.factory.queue('q1')
+        q.enqueue_call(mtq.tests.fixture.test_func_sleep)
+
+        worker = self.factory.new_worker(['q1'], silence=True)
+        worker.heartbeat = mock.Mock(alive=False)
+        # Shutdown is requested from the DB while the job is running
+        worker.check_in = mock.Mock(side_effect=[(False, 0)] + [(True, 0)] * 10)
+
+        with self.assertRaises(SystemExit):
+            worker.work(pool='threads')
+
+        # The running job was allowed to finish
+        self.assertEqual(worker.jobs_failed, 0)
+        self.assertEqual(self.factory.finished_jobs_collection.find().count(), 1)
+
+    def test_thread_pool_stop_requeues(self):
+        q = self.factory.queue('q1')
+        q.enqueue_call(mtq.tests.fixture.test_func_sleep)
+        q.enqueue_call('not-started')
+
+        worker = self.factory.new_worker(['q1'], silence=True)
+        with worker.register():
+            pool = ThreadPool(worker, concurrency=1)
+            pool.start()
+            for i in range(2):
+                pool.submit(worker.pop_item())
+            time.sleep(0.1)
+            results = pool.stop(timeout=0)
+
+        self.assertEqual([job.func_name for job, failed in results], ['mtq.tests.fixture.test_func_sleep'])
+        # The job that never started is back on the queue, it did not use up an attempt
+        doc = self.factory.queue_collection.find_one({'execute.func_str': 'not-started'})
+        self.assertFalse(doc['processed'])
+        self.assertFalse(doc['failed'])
+        self.assertEqual(doc['attempts'], 0)
+
+    def test_heartbeat(self):
+        q = self.factory.queue('q1')
+        q.enqueue_call('test', mutex={'key': 'key1'})
+
+        worker = self.factory.new_worker(['q1'], heartbeat_interval=0.05)
+        with worker.register():
+            job = worker.pop_item()
+            worker._running[job.id] = job
+            self.factory.mutex_collection.update({'_id': 'key1'},
+                                                 {'$set': {'holders.0.expires': now()}})
+            self.factory.worker_collection.update({'_id': worker.worker_id},
+                                                  {'$set': {'terminate': True, 'terminate_status': 3}})
+            time.sleep(0.3)
+            self.assertEqual(worker.heartbeat.terminate, (True, 3))
+
+            doc = self.factory.worker_collection.find_one({'_id': worker.worker_id})
+            self.assertEqual(doc['stats']['current_job'], job.id)
+            self.assertEqual(doc['stats']['running'], 1)
+
+            # The lease on the running job's mutex was renewed
+            mutex = self.factory.mutex_collection.find_one({'_id': 'key1'})
+            self.assertGreater(mutex['holders'][0]['expires'], now().replace(tzinfo=None))
+
+        self.assertFalse(worker.heartbeat.alive)
+
     def test_tags(self):
 
         worker = self.factory.new_worker(['q1', 'q2'], ['linux-64', 'hostname:host1'], silence=True)
@@ -178,6 +401,37 @@ class TestWorker(MTQTestCase):
 
         self.assertIsNone(worker.pop_item())
 
+    def test_notifier(self):
+        notifier = self.factory.notifier(['q1'], ['linux-64'])
+        self.assertFalse(notifier.wait(0.1))
+
+        self.factory.queue('q2').enqueue_call('test')
+        self.factory.queue('q1').enqueue_call('test', tags=['linux-65'])
+        self.assertFalse(notifier.wait(0.1))
+
+        self.factory.queue('q1').enqueue_call('test', tags=['linux-64'])
+        self.assertTrue(notifier.wait(5))
+        notifier.close()
+
+    def test_notifier_start(self):
+        notifier = self.factory.notifier(['q1'])
+        notifier.start()
+
+        # A job enqueued after the queue was checked and before waiting
+        self.factory.queue('q1').enqueue_call('test')
+        self.assertTrue(notifier.wait(5))
+        notifier.close()
+
+    def test_notifier_unordered_ids(self):
+        notifier = self.factory.notifier(['q1'])
+        self.assertFalse(notifier.wait(0.1))
+
+        # Another host may generate a lower ObjectId than the last signal seen
+        early_id = ObjectId.from_datetime(datetime(2000, 1, 1))
+        self.factory.signal_collection.insert({'_id': early_id, 'qname': 'q1', 'tags': []})
+        self.assertTrue(notifier.wait(5))
+        notifier.close()
+
     def test_unexpected_error_fail_fast(self):
 
         worker = self.factory.new_worker(['q1'], ['linux-64'], silence=True)
@@ -12,9 +12,18 @@ from bson.errors import InvalidId
 from bson.objectid import ObjectId
 from contextlib import contextmanager
 import io
+import os
+import threading
+import time
+from itertools import islice
 import pytz
 from mtq import errors
 
+try:
+    import asyncio
+except ImportError:  # Python 2
+    asyncio = None
+
 class ImportStringError(Exception):
     pass
 
@@ -125,26 +134,76 @@ class UnicodeFormatter(logging.Formatter):
             msg = msg.decode(errors='replace')
         return msg
 
+class ThreadFilter(logging.Filter):
+    '''
+    Only pass records logged from one thread
+
+    With the thread pool several jobs log to the root logger at once, each
+    job's handler keeps the records of its own thread.
+    '''
+    def __init__(self, ident=None):
+        logging.Filter.__init__(self)
+        self.ident = threading.current_thread().ident if ident is None else ident
+
+    def filter(self, record):
+        return record.thread == self.ident
+
+_job_local = threading.local()
+
+@contextmanager
+def job_deadline(timeout):
+    '''
+    Set the deadline that check_timeout tests for the job run in this thread
+    '''
+    previous = getattr(_job_local, 'deadline', None)
+    _job_local.deadline = time.time() + timeout if timeout else None
+    try:
+        yield
+    finally:
+        _job_local.deadline = previous
+
+def check_timeout():
+    '''
+    Raise mtq.errors.Timeout if the job running in this thread is past its timeout
+
+    Long running tasks should call this regularly, it is the only way a
+    job run by the thread pool can be reliably interrupted.
+    '''
+    deadline = getattr(_job_local, 'deadline', None)
+    if deadline is not None and time.time() > deadline:
+        raise errors.Timeout()
+
 mgs_template = """Job %s exited with exception:
 Job Log:
    | %s
 
 """
 @contextmanager
-def setup_logging(collection, job_id):
+def setup_logging(collection, job_id, writer=None, thread_filter=False):
     """
     Set up logging for worker.
     All log messages will be captured and saved into a document in the
     specified database collection.
     Additionally, the `job` logger will record start/end messages,
     with full logs exported only in the case of failure.
+
+    :param writer: a mtq.log.BufferedWriter for the collection, it is flushed
+        when the job ends (whether or not it failed)
+    :param thread_filter: only capture the records of the current thread, for
+        jobs that share the process with other jobs (the thread pool)
     """
+    from mtq.log import BufferedWriter
+
+    if writer is None:
+        writer = BufferedWriter(collection)
 
     # create a handler that will capture specified logs in memory
     record = io.StringIO()
     record_hndlr = logging.StreamHandler(record)
     record_hndlr.setFormatter(UnicodeFormatter())
     record_hndlr.setLevel(logging.INFO)
+    if thread_filter:
+        record_hndlr.addFilter(ThreadFilter())
 
     # configure root logger to capture all messages
     rootLogger = logging.getLogger()
@@ -176,12 +235,28 @@ def setup_logging(collection, job_id):
         log_entry = {
             'job_id': job_id,
             'message': record.getvalue(),
-            'timestamp': now()
+            'timestamp': now(),
+            'eof': True,
         }
-        collection.insert(log_entry)
+        writer.write(log_entry)
+        writer.close()
 
 
 
+def is_coroutine(obj):
+    'test if obj is a coroutine object (always False on Python 2)'
+    return asyncio is not None and asyncio.iscoroutine(obj)
+
+def run_coroutine(coro):
+    '''
+    Run a coroutine to completion in a new event loop and return its result
+    '''
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
 def now():
     now = datetime.utcnow()
     return now.replace(tzinfo=pytz.utc)
@@ -190,6 +265,59 @@ def nulltime():
     dt = datetime.utcfromtimestamp(0)
     return dt.replace(tzinfo=pytz.utc)
 
+def current_rss():
+    '''
+    The resident set size of this process in bytes (or None if it can not be determined)
+    '''
+    try:
+        with open('/proc/self/statm') as fd:
+            pages = int(fd.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # Peak usage, in kilobytes on linux and bytes on OS X
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def chunked(iterable, chunk_size):
+    'yield lists of at most chunk_size items from iterable'
+    iterator = iter(iterable)
+    while 1:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def parse_queue_weights(queues):
+    '''
+    Split queue arguments of the form 'name:weight'
+
+    The suffix is only a weight if it is a positive number, so queue names
+    that contain ':' (e.g. 'project:tasks') are kept whole.
+
+    :returns: a list of queue names and a dict of {name: weight} for the
+        queues that were given a weight
+    '''
+    names, weights = [], {}
+    for queue in queues:
+        name, sep, weight = queue.rpartition(':')
+        try:
+            weight = float(weight)
+        except ValueError:
+            weight = None
+        if not sep or not name or weight is None or not 0 < weight < float('inf'):
+            names.append(queue)
+            continue
+        names.append(name)
+        weights[name] = weight
+    return names, weights
+
 def config_dict(filename):
     config = {}
     if filename:
@@ -212,6 +340,21 @@ def wait_times(conn):
     result = list(raw)
     return {item['_id']:item['wait'] for item in result}
 
+def priority_depths(conn):
+    '''
+    The number of waiting jobs in each priority band of each queue
+
+    :returns: a dict of {qname: {priority: count}}
+    '''
+    coll = conn.queue_collection
+    raw = coll.aggregate([{'$match':{'processed':False}},
+                          {'$group':{'_id':{'qname':'$qname', 'priority':'$priority'},
+                                     'count':{'$sum':1}}}], cursor={})
+    result = {}
+    for item in raw:
+        result.setdefault(item['_id']['qname'], {})[item['_id']['priority']] = item['count']
+    return result
+
 def job_stats(conn, group_by='$execute.func_str', since=None):
     coll = conn.queue_collection
     duration = { '$avg': { '$subtract':['$finished_at_', '$started_at_'] } }
@@ -245,6 +388,33 @@ def job_stats(conn, group_by='$execute.func_str', since=None):
     return {item.pop('_id'):item for item in result}
 
 
+def phase_stats(conn, phases, since=None):
+    '''
+    The average seconds spent in each phase by the jobs of each function,
+    from the `timings` of the jobs in the queue and finished jobs collections
+
+    :returns: a dict of {func: {phase: seconds}}
+    '''
+    group = {'_id': '$execute.func_str'}
+    for phase in phases:
+        field = '$timings.%s' % phase
+        group[phase] = {'$sum': field}
+        group[phase + '_count'] = {'$sum': {'$cond': [{'$eq': [{'$ifNull': [field, 'missing']}, 'missing']}, 0, 1]}}
+
+    match = {'finished': True, 'timings': {'$exists': True}}
+    if since:
+        match['finished_at'] = {'$gt': since}
+
+    totals = {}
+    for coll in (conn.queue_collection, conn.finished_jobs_collection):
+        for item in coll.aggregate([{'$match': match}, {'$group': group}], cursor={}):
+            total = totals.setdefault(item['_id'], {})
+            for key, value in item.items():
+                if key != '_id':
+                    total[key] = total.get(key, 0) + value
+
+    return {func: {phase: total[phase] / total[phase + '_count'] for phase in phases if total.get(phase + '_count')}
+            for func, total in totals.items()}
 
 
 def shutdown_worker(conn, worker_id=None):
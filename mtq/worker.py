@@ -1,19 +1,80 @@
+from collections import deque, Counter
 from contextlib import contextmanager
 from datetime import datetime
 import getpass
 import logging
-from multiprocessing import Process
+from multiprocessing import Process, Pipe
 import os
 import platform
 import signal
 import sys
+import threading
 import time
+from time import mktime
 import random
 
-from pymongo.errors import ConnectionFailure
+from pymongo.errors import ConnectionFailure, OperationFailure
 
+from mtq import metrics
+from mtq.defaults import _max_idle, _heartbeat_interval
 from mtq.log import MongoStream, MongoHandler
-from mtq.utils import handle_signals, now, setup_logging, nulltime
+from mtq.pool import POOLS
+from mtq.profiling import should_profile, profile_apply
+from mtq.retry import error_info
+from mtq.utils import handle_signals, now, setup_logging, nulltime, job_deadline, current_rss
+
+
+class Heartbeat(object):
+    '''
+    Check a worker in every `interval` seconds from a background thread
+
+    The heartbeat keeps running while the worker waits on a job, it records
+    live stats in the worker document, renews the mutex leases of the running
+    jobs and remembers if the worker was asked to terminate so the main loop
+    does not need a round-trip to find out.
+    '''
+    def __init__(self, worker, interval=_heartbeat_interval):
+        self.worker = worker
+        self.interval = interval
+        self.terminate = False, 0
+        #: Held while the heartbeat talks to mongo, take it to fork safely
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __repr__(self):
+        return '<mtq.Heartbeat interval=%s alive=%s>' % (self.interval, self.alive)
+
+    @property
+    def alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._stop.clear()
+        self.beat()
+        self._thread = threading.Thread(target=self._run, name='mtq-heartbeat')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.beat()
+            except Exception:
+                self.worker.logger.exception('Heartbeat failed')
+
+    def beat(self):
+        'Check in once'
+        with self.lock:
+            self.terminate = self.worker.check_in()
+            for job in self.worker.running_jobs:
+                self.worker.factory.renew_mutex(job.doc)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
 
 
 class Worker(object):
@@ -22,7 +83,9 @@ class Worker(object):
     '''
     def __init__(self, factory, queues=(), tags=(), priority=0,
                  poll_interval=1, exception_handler=None,
-                 log_worker_output=False, silence=False, extra_lognames=()):
+                 log_worker_output=False, silence=False, extra_lognames=(),
+                 notify=True, max_idle=_max_idle, prefetch=0, weights=None,
+                 heartbeat_interval=_heartbeat_interval, profile_sample=None):
         self.name = '%s.%s' % (platform.node(), os.getpid())
         self.extra_lognames = extra_lognames
 
@@ -33,10 +96,31 @@ class Worker(object):
         self._log_worker_output = log_worker_output
         self.factory = factory
         self.poll_interval = poll_interval
+        self.notify = notify
+        self.max_idle = max_idle
+        self._notifier = None
+        self._num_submitted = 0
+        self.prefetch = prefetch
+        self._prefetched = deque()
+
+        #: Per queue weights, when set jobs are dispatched by deficit round robin
+        self.weights = dict(weights or {})
+        self._deficits = dict.fromkeys(self.queues, 0)
+        self._drr_index = 0
+        #: The number of jobs popped from each queue
+        self.dispatch_counts = Counter()
+
+        self.heartbeat = Heartbeat(self, heartbeat_interval)
+        self._running = {}
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        #: The fraction of jobs to run under cProfile
+        self.profile_sample = profile_sample
 
         self.logger = logging.getLogger('mq.Worker')
 
         self._current = None
+        self._log_handler = None
         self._handler = exception_handler
         self._pre_call = None
         self._post_call = None
@@ -68,28 +152,57 @@ class Worker(object):
                                                  'check-in':datetime.fromtimestamp(0),
                                                  'working':True,
                                                  'queues': self.queues,
+                                                 'weights': self.weights,
                                                  'tags': self.tags,
                                                  'log_output': bool(self._log_worker_output),
                                                  'terminate': False,
                                                  'terminate_status': 0,
                                                  })
         if self._log_worker_output:
-            hdlr = MongoHandler(self.factory.logging_collection, {'worker_id':self.worker_id})
-            self.logger.addHandler(hdlr)
+            self._log_handler = MongoHandler(self.factory.logging_collection, {'worker_id':self.worker_id})
+            self.logger.addHandler(self._log_handler)
+        self.heartbeat.start()
         try:
             yield self.worker_id
         finally:
-            if self._log_worker_output:
-                self.logger.removeHandler(hdlr)
+            self.heartbeat.stop()
+            self.release_prefetched()
+
+            if self._log_handler is not None:
+                self.logger.removeHandler(self._log_handler)
+                self._log_handler.close()
+                self._log_handler = None
+                # Tell mtq-tail that this worker's log is complete
+                self.factory.logging_collection.insert({'worker_id': self.worker_id, 'message': '',
+                                                        'time': now(), 'eof': True})
 
             query = {'_id': self.worker_id}
             update = {'$set':{'finished':now(), 'working':False}}
             self.collection.update(query, update)
 
+    @property
+    def running_jobs(self):
+        'The jobs this worker is running'
+        return list(self._running.values())
+
+    def stats(self):
+        'Live stats recorded by the heartbeat'
+        running = self.running_jobs
+        return {'current_job': running[-1].id if running else None,
+                'running': len(running),
+                'jobs_done': self.jobs_done,
+                'jobs_failed': self.jobs_failed,
+                'rss': current_rss(),
+                }
+
     def check_in(self):
+        '''
+        Record that this worker is alive
 
+        :returns: a (should_exit, status) tuple
+        '''
         query = {'_id': self.worker_id}
-        update = {'$set':{'check-in':now(), 'working':True}}
+        update = {'$set':{'check-in':now(), 'working':True, 'stats': self.stats()}}
         worker_info = self.collection.find_and_modify(query, update)
         if worker_info:
             should_exit = worker_info.get('terminate', False)
@@ -97,18 +210,39 @@ class Worker(object):
             return should_exit, status
         return False, 0
 
-    def work(self, one=False, batch=False, failed=False, fail_fast=False):
+    def work(self, one=False, batch=False, failed=False, fail_fast=False,
+             pool='process', concurrency=1, max_jobs_per_child=None, max_rss=None):
         '''
         Main work function
 
         :param one: wait for the first job execute and then exit
         :param batch: work until the queue is empty, then exit
+        :param pool: 'process' to fork a new process for every job, or the
+            name of a pool in mtq.pool.POOLS to run jobs in long-lived workers
+        :param concurrency: number of jobs a pool runs at the same time
+        :param max_jobs_per_child: recycle a pool process after this many jobs
+        :param max_rss: recycle a pool process when it uses more than this many bytes
         '''
+        if pool == 'process':
+            job_pool = None
+        else:
+            job_pool = POOLS[pool](self, concurrency=concurrency,
+                                   max_jobs_per_child=max_jobs_per_child, max_rss=max_rss)
+
         with self.register():
+            if job_pool is not None:
+                job_pool.start()
             try:
-                self.start_main_loop(one, batch, failed, fail_fast)
+                self.start_main_loop(one, batch, failed, fail_fast, pool=job_pool)
             except KeyboardInterrupt:
                 self.logger.exception(None)
+                if job_pool is not None:
+                    self.logger.warn('Warm shutdown requested')
+                    for job, job_failed in job_pool.stop():
+                        self.finish_job(job, job_failed)
+                    job_pool = None
+                    return
+
                 if not self._current:
                     return
 
@@ -116,35 +250,160 @@ class Worker(object):
                 proc, job = self._current
                 proc.join(timeout=job.doc.get('timeout'))
                 return
+            except SystemExit:
+                # Shutdown requested from the DB, let the running jobs finish
+                if job_pool is not None:
+                    for job, job_failed in job_pool.stop():
+                        self.finish_job(job, job_failed)
+                    job_pool = None
+                raise
+            finally:
+                if job_pool is not None:
+                    # An unexpected error, do not wait for the running jobs
+                    for job, job_failed in job_pool.stop(timeout=0):
+                        self.finish_job(job, job_failed)
 
     def pop_item(self, pop_failed=False):
-        job = self.factory.pop_item(worker_id=self.worker_id,
-                                    queues=self.queues,
-                                    tags=self.tags,
-                                    failed=pop_failed,
-                                    )
+        with metrics.timer('pop_seconds'):
+            job = self._pop_item(pop_failed)
+
+        metrics.inc('pops')
+        if job is None:
+            metrics.inc('pops_empty')
+        else:
+            metrics.inc('jobs_popped', queue=job.qname)
+        return job
+
+    def _pop_item(self, pop_failed=False):
+        if pop_failed:
+            job = self.factory.pop_item(worker_id=self.worker_id,
+                                        queues=self.queues,
+                                        tags=self.tags,
+                                        priority=self.priority,
+                                        failed=pop_failed,
+                                        )
+        elif self.prefetch > 1:
+            job = self._pop_prefetched()
+        else:
+            jobs = self._claim(1)
+            job = jobs[0] if jobs else None
+
+        if job is not None:
+            self.dispatch_counts[job.qname] += 1
         return job
 
-    def start_main_loop(self, one=False, batch=False, pop_failed=False, fail_fast=False, max_retries=10):
+    def _claim_from(self, queues, n):
+        if n == 1:
+            job = self.factory.pop_item(self.worker_id, queues, self.tags, self.priority)
+            return [job] if job is not None else []
+        return self.factory.pop_items(self.worker_id, queues, self.tags, n, self.priority)
+
+    def _claim(self, n):
+        '''
+        Claim up to `n` jobs, following the queue weights if there are any
+
+        Weighted queues are served by deficit round robin: each visit to a
+        queue credits it with its weight and each job popped from it costs
+        one. A queue is only served while it has a whole job of credit, and
+        at most that many jobs are claimed from it at once, the fractional
+        remainder is kept for its next visit. A queue that is empty forfeits
+        its credit and the jobs are taken from any queue instead, so a pop
+        costs at most two queries however many queues there are.
+        '''
+        if not self.weights or len(self.queues) < 2:
+            return self._claim_from(self.queues, n)
+
+        while 1:
+            qname = self.queues[self._drr_index]
+            if self._deficits[qname] < 1:
+                self._deficits[qname] += self.weights.get(qname, 1)
+            allowed = min(n, int(self._deficits[qname]))
+            if allowed > 0:
+                break
+            self._drr_index = (self._drr_index + 1) % len(self.queues)
+
+        jobs = self._claim_from([qname], allowed)
+        if not jobs:
+            self._deficits[qname] = 0
+            jobs = self._claim_from(self.queues, allowed)
+
+        for job in jobs:
+            self._deficits[job.qname] -= 1
+
+        if self._deficits[qname] < 1:
+            self._drr_index = (self._drr_index + 1) % len(self.queues)
+
+        return jobs
+
+    def _pop_prefetched(self):
+        '''
+        Pop a job from the local buffer, claiming `prefetch` more jobs when it is empty
+        '''
+        if not self._prefetched:
+            self._prefetched.extend(self._claim(self.prefetch))
+        if not self._prefetched:
+            return None
+
+        job = self._prefetched.popleft()
+        # The job was claimed with the whole batch, it starts now
+        n = now()
+        job.doc['started_at'] = n
+        job.doc['started_at_'] = mktime(n.timetuple())
+        return job
+
+    def release_prefetched(self):
+        '''
+        Put jobs that were prefetched but not started back on the queue
+        '''
+        while self._prefetched:
+            self.requeue_job(self._prefetched.popleft())
+
+    def requeue_job(self, job):
+        '''
+        Put a job that was claimed but never started back on the queue
+
+        The job is not failed and does not use up a retry attempt.
+        '''
+        self._running.pop(job.id, None)
+        self.factory.release_mutex(job.doc)
+        self.factory.push_item(job.id)
+        self.factory.stats.requeued([job.doc])
+
+    def start_main_loop(self, one=False, batch=False, pop_failed=False, fail_fast=False, max_retries=10,
+                        pool=None):
         '''
         Start the main loop and process jobs
+
+        :param pool: a started pool from mtq.pool to run jobs in, if None
+            each job is run in a new process
         '''
         self.logger.info('Starting Main Loop mongo-host=%s mongo-db=%s' % (self.factory.db.connection.host,
                                                                            self.factory.db.name))
         self.logger.info('Starting Main Loop worker=%s _id=%s' % (self.name, self.worker_id))
         self.logger.info('Listening for jobs queues=[%s] tags=[%s]' % (', '.join(self.queues), ', '.join(self.tags)))
+        if not pop_failed:
+            self._start_notifier()
+
         retries = 0
         while 1:
             try:
-                should_exit, status = self.check_in()
+                if self.heartbeat.alive:
+                    should_exit, status = self.heartbeat.terminate
+                else:
+                    should_exit, status = self.check_in()
                 if should_exit:
                     self.logger.info("Shutdown Requested (from DB)")
                     raise SystemExit(status)
 
+                if pool is not None:
+                    if self._pool_step(pool, one, batch, pop_failed):
+                        break
+                    continue
+
                 job = self.pop_item(pop_failed=pop_failed)
                 if job is None:
                     if batch: break
-                    time.sleep(self.poll_interval)
+                    self.wait_for_job(pop_failed)
                     continue
 
                 self.process_job(job)
@@ -179,8 +438,105 @@ class Worker(object):
                 if one:
                     break
 
+        if self._notifier is not None:
+            self._notifier.close()
+            self._notifier = None
+
         self.logger.info('Exiting Main Loop')
 
+    def _pool_step(self, pool, one, batch, pop_failed):
+        '''
+        Collect finished jobs from the pool and hand it a new job if it has an idle process
+
+        :returns: True if the main loop should exit
+        '''
+        for job, failed in pool.collect(timeout=0):
+            self.finish_job(job, failed)
+
+        if pool.idle and not (one and self._num_submitted):
+            job = self.pop_item(pop_failed=pop_failed)
+            if job is not None:
+                self.logger.info('Popped Job _id=%s queue=%s tags=%s' % (job.id, job.qname, ', '.join(job.tags)))
+                self.logger.info(job.call_str)
+                self._running[job.id] = job
+                pool.submit(job)
+                self._num_submitted += 1
+                return False
+
+        if not pool.busy:
+            if batch or (one and self._num_submitted):
+                return True
+            self.wait_for_job(pop_failed)
+            return False
+
+        taking_jobs = pool.idle and not (batch or pop_failed or (one and self._num_submitted))
+        if taking_jobs and self._start_notifier() is not None:
+            # There are no jobs to start: wake up for a new job as well as for finished ones
+            results = pool.collect(timeout=0.05)
+            if not results:
+                self._wait_for_signal(self.poll_interval)
+                results = pool.collect(timeout=0)
+        else:
+            # Every process is busy, or no new jobs are taken
+            results = pool.collect(timeout=self.poll_interval)
+
+        for job, failed in results:
+            self.finish_job(job, failed)
+        return False
+
+    def wait_for_job(self, pop_failed=False):
+        '''
+        Block while there are no jobs to process
+
+        If notifications are enabled wait (up to max_idle seconds) for a
+        job to be enqueued, otherwise sleep for poll_interval seconds. Either
+        way the worker wakes up when the next delayed job becomes due.
+        '''
+        self.flush_log()
+
+        timeout = self.poll_interval if not self.notify or pop_failed else self.max_idle
+        if not pop_failed:
+            due = self.factory.next_due(self.queues, self.tags, self.priority)
+            if due is not None:
+                timeout = max(0, min(timeout, (due - now()).total_seconds()))
+
+        if pop_failed or self._start_notifier() is None:
+            time.sleep(timeout)
+            return
+
+        self._wait_for_signal(timeout)
+
+    def _start_notifier(self):
+        '''
+        Start following job notifications, the main loop does this before its
+        first pop so a job enqueued in between is not missed
+
+        :returns: the JobNotifier, or None if notifications are disabled or unavailable
+        '''
+        if not self.notify:
+            return None
+        if self._notifier is None:
+            try:
+                notifier = self.factory.notifier(self.queues, self.tags)
+                notifier.start()
+            except OperationFailure as err:
+                self._notifications_failed(err)
+                return None
+            self._notifier = notifier
+        return self._notifier
+
+    def _wait_for_signal(self, timeout):
+        'Wait up to `timeout` seconds for a job to be enqueued'
+        try:
+            self._notifier.wait(timeout)
+        except OperationFailure as err:
+            self._notifications_failed(err)
+
+    def _notifications_failed(self, err):
+        self.logger.warn('Could not wait for job notifications, falling back to polling (%s)', err)
+        self.notify = False
+        self._notifier = None
+
     def process_job(self, job):
         '''
         Process a single job in a multiprocessing.Process
@@ -188,9 +544,17 @@ class Worker(object):
         self.logger.info('Popped Job _id=%s queue=%s tags=%s' % (job.id, job.qname, ', '.join(job.tags)))
         self.logger.info(job.call_str)
 
-        proc = Process(target=self._process_job, args=(job,))
+        # The child sends its job's timings back over the pipe
+        timings_conn, child_conn = Pipe(duplex=False)
+        proc = Process(target=self._process_job, args=(job, child_conn))
         self._current = proc, job
-        proc.start()
+        self._running[job.id] = job
+        start = time.time()
+        with self.heartbeat.lock, metrics.timer('fork_seconds'):
+            # Do not fork while the heartbeat thread is using the mongo client
+            proc.start()
+        job.record_timing('fork', start)
+        child_conn.close()
         timeout = job.doc.get('timeout')
         if timeout:
             self.logger.info("Job started, timing out after %s seconds" % timeout)
@@ -200,6 +564,7 @@ class Worker(object):
         proc.join(timeout=job.doc.get('timeout'))
         if proc.is_alive():
             self.logger.error('Timeout occurred: interrupting job')
+            metrics.inc('jobs_timed_out')
             os.kill(proc.pid, signal.SIGALRM)
             # Give the process 2 min to finish
             proc.join(timeout=min(job.doc.get('timeout'), 2 * 60))
@@ -210,33 +575,100 @@ class Worker(object):
 
         self._current = None
 
-        failed = proc.exitcode != 0
+        try:
+            if timings_conn.poll():
+                job.timings.update(timings_conn.recv())
+        except (EOFError, IOError, OSError):
+            pass
+        finally:
+            timings_conn.close()
+
+        return self.finish_job(job, proc.exitcode != 0)
+
+    def finish_job(self, job, failed):
+        '''
+        Log the outcome of a job and mark it as finished
 
+        A failed job is rescheduled instead if its retry policy allows it
+        '''
+        self._running.pop(job.id, None)
+        self.jobs_done += 1
         if failed:
+            self.jobs_failed += 1
+
+        metrics.inc('jobs_failed' if failed else 'jobs_succeeded', queue=job.qname)
+
+        delay = job.retry() if failed else None
+        if delay is not None:
+            metrics.inc('jobs_retried', queue=job.qname)
+            self.logger.warn('Job %s failed, retrying in %.1f seconds (attempt %i)' % (job.doc['_id'], delay, job.attempts + 1))
+        elif failed:
             self.logger.error('Job %s failed' % (job.doc['_id']))
+            job.set_finished(failed)
         else:
             self.logger.info('Job %s finished successfully' % (job.doc['_id']))
+            job.set_finished(failed)
 
-        job.set_finished(failed)
+        self.flush_log()
 
-        return  failed
+        return failed
 
-    def _process_job(self, job):
+    def record_error(self, job, error):
         '''
+        Save the description of the exception that made a job fail, see mtq.retry.error_info
+        '''
+        self.factory.queue_collection.update({'_id': job.id}, {'$set': {'last_error': error}})
+
+    def flush_log(self):
+        'Write buffered worker log records to the db'
+        if self._log_handler is not None:
+            self._log_handler.flush()
+
+    def _process_job(self, job, conn=None):
+        '''
+        Run a job in this (forked) process
+
+        :param conn: the end of a pipe to send the job's timings to the worker
         '''
         handle_signals()
+        try:
+            self._run_job(job)
+        finally:
+            if conn is not None:
+                conn.send(job.timings)
+                conn.close()
 
-        with setup_logging(self.factory.logging_collection, job.id):
-            try:
-                self._pre(job)
-                job.apply()
-            except:
-                if self._handler:
-                    exc_type, exc_value, traceback = sys.exc_info()
-                    self._handler(job, exc_type, exc_value, traceback)
-                raise
-            finally:
-                self._post(job)
+    def _run_job(self, job, thread_filter=False):
+        '''
+        Run a job, recording its log output
+
+        :param thread_filter: only record the log output of this thread, see mtq.utils.setup_logging
+        '''
+        # The log phase is the time to set up the job's log handler and flush it
+        start = time.time()
+        done = None
+        try:
+            with setup_logging(self.factory.logging_collection, job.id, thread_filter=thread_filter), \
+                    job_deadline(job.doc.get('timeout')):
+                job.record_timing('log', start)
+                try:
+                    self._pre(job)
+                    if should_profile(job, self.profile_sample):
+                        profile_apply(job, self.factory.profile_collection, self.worker_id)
+                    else:
+                        job.apply()
+                except BaseException as exc:
+                    self.record_error(job, error_info(exc, job.attempts))
+                    if self._handler:
+                        exc_type, exc_value, traceback = sys.exc_info()
+                        self._handler(job, exc_type, exc_value, traceback)
+                    raise
+                finally:
+                    self._post(job)
+                    done = time.time()
+        finally:
+            if done is not None:
+                job.timings['log'] += time.time() - done
 
     def _pre(self, job):
         if self._pre_call: self._pre_call(job)
@@ -302,6 +734,11 @@ class WorkerProxy(object):
         'last check in time'
         return self.doc.get('check-in', nulltime())
 
+    @property
+    def stats(self):
+        'live stats recorded by the last heartbeat'
+        return self.doc.get('stats', {})
+
     def stream(self):
         collection = self.factory.logging_collection
 